@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
 import logging, time, datetime, signal
-import pprint as PP, os, sys, math
+import pprint as PP, os, sys, math, re, json, threading
 import execo as EX
 from execo.process import ProcessOutputHandler
 import execo_g5k as EX5
-from execo_g5k.api_utils import get_cluster_site
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+from g5k_api_cache import get_host_attributes, get_cluster_site
 from execo_engine import Engine, ParamSweeper, logger, sweep, slugify
 EX.logger.setLevel(logging.ERROR)
 logger.setLevel(logging.ERROR)
@@ -16,6 +17,28 @@ BOLD_MAGENTA	= "\x1B[35;1m"
 RED				= "\x1B[31m"
 
 OUT_FILE_FORMAT = 'events_per_sec_{0}W_{1}T'
+SERVER_PORT = 1200
+SERVER_READY_TIMEOUT = 60	# seconds to wait for the server to listen
+SERVER_RESULTS_TIMEOUT = 60	# seconds to wait for a warm server to write its results
+SUMMARY_FILE_FORMAT = 'throughput_{0}W_{1}T.json'
+PLACEMENT_FILE_FORMAT = 'placement_{0}W_{1}T.json'
+
+# Ramp-up mode: the throughput scales near-linearly from a number of
+# clients to a larger one if each added client adds at least
+# RAMPUP_LINEAR_RATIO times the per-client throughput (sum / n_clients)
+# of the smallest number of clients, and if the time per transition of
+# the median client is at most RAMPUP_LATENCY_FACTOR times that of the
+# smallest number of clients. Otherwise the larger number of clients
+# saturates the server. The knee is refined down to RAMPUP_MIN_STEP
+# clients.
+RAMPUP_LINEAR_RATIO = 0.75
+RAMPUP_LATENCY_FACTOR = 2.0
+RAMPUP_MIN_STEP = 10
+
+# Throughput line of a client, e.g. "1234.5 transitions/s". This is
+# the expected format of the TransitionsPerSecond output: if the clients
+# output another format, no line matches and a warning is logged.
+THROUGHPUT_RE = re.compile(r'([0-9]+(?:\.[0-9]+)?)\s*(?:transitions?|events?)\s*(?:/\s*s(?:ec)?|per\s+sec(?:ond)?)\b', re.I)
 
 # Setup signal handler
 def sighandler(signal, frame):
@@ -36,6 +59,18 @@ class active_data_tps(Engine):
 	
 	def __init__(self):
 		super(active_data_tps, self).__init__()
+		self.options_parser.add_option("-w", dest = "warm", action = "store_true", default = False,
+			help = "reserve once for the largest number of clients and keep the server warm, " + \
+			"stepping through the numbers of clients, each in its own measurement window")
+		self.options_parser.add_option("-a", dest = "rampup", action = "store_true", default = False,
+			help = "ramp the number of clients up within a single reservation and server, " + \
+			"from the smallest to the largest n_clients, until the throughput levels off, " + \
+			"then refine around the knee")
+		self.options_parser.add_option("-x", dest = "exclude_server", action = "store_true", default = False,
+			help = "do not run clients on the server node")
+		self.options_parser.add_option("-p", dest = "pin", action = "store_true", default = False,
+			help = "pin each client to a cpu with taskset (one per physical core first, then their " + \
+			"hyperthreads), and record the placement")
 	
 	def _updateStat(self, stat):
 		self.__class__._stat = ""
@@ -69,118 +104,37 @@ class active_data_tps(Engine):
 			'n_clients': [400, 450, 500, 550, 600],
 			'n_transitions': [10000]
 		}
-		cluster = 'griffon'
+		self.cluster = 'griffon'
 		sweeps = sweep(self.parameters)
 		sweeper = ParamSweeper(os.path.join(self.result_dir, "sweeps"), sweeps)
-		server_out_path = os.path.join(self.result_dir, "server.out")
+		self.server_out_path = os.path.join(self.result_dir, "server.out")
 		
 		self._updateStat(sweeper.stats())
 		
-		# Loop on the number of nodes
+		if self.options.rampup:
+			self._run_rampup()
+		elif self.options.warm:
+			self._run_warm(sweeper)
+		else:
+			self._run_cold(sweeper)
+		
+		print ""
+	
+	def _run_cold(self, sweeper):
+		# One reservation and one server per number of clients
 		while True:
 			# Taking the next parameter combinations
 			comb = sweeper.get_next()
 			if not comb: break
-
-			# Performing the submission on G5K
-			site = get_cluster_site(cluster)
-			self._log("Output will go to " + self.result_dir)
-			
-			n_nodes = int(math.ceil(float(comb['n_clients']) / EX5.get_host_attributes(cluster + '-1')['architecture']['smt_size'])) + 1
-			self._log("Reserving {0} nodes on {1}".format(n_nodes, site))
-			
-			resources = "{cluster=\\'" + cluster + "\\'}/nodes=" + str(n_nodes)
-			submission = EX5.OarSubmission(resources = resources, job_type = 'allow_classic_ssh', walltime ='00:10:00')
-			
-			job = EX5.oarsub([(submission, site)])
-			self.__class__._job = job
-			
-			# Sometimes oarsub fails silently
-			if job[0][0] is None:
-				print("\nError: no job was created")
-				sys.exit(1)
-				
-			# Wait for the job to start
-			self._log("Waiting for job {0} to start...\n".format(BOLD_MAGENTA + str(job[0][0]) + NORMAL))
-			EX5.wait_oar_job_start(job[0][0], job[0][1], prediction_callback = prediction)
-			nodes = EX5.get_oar_job_nodes(job[0][0], job[0][1])
-			
-			# Deploying nodes
-			#deployment = EX5.Deployment(hosts = nodes, env_file='path_to_env_file')
-			#run_deploy = EX5.deploy(deployment)
-			#nodes_deployed = run_deploy.hosts[0]
 			
-			# Copying active_data program on all deployed hosts
-			EX.Put([nodes[0]], '../dist/active-data-lib-0.1.2.jar', connexion_params = {'user': 'ansimonet'}).run()
-			EX.Put([nodes[0]], '../server.policy', connexion_params = {'user': 'ansimonet'}).run()
+			job, nodes = self._reserve(comb['n_clients'])
 			
 			# Loop on the number of requests per client process
 			while True:
-				# Split the nodes
-				clients = nodes[1:]
-				server = nodes[0] 
-				
-				self._log("Running experiment with {0} nodes and {1} transitions per client".format(len(clients), comb['n_transitions']))
-				
-				# Launching Server on one node
-				out_handler = FileOutputHandler(server_out_path)
-				launch_server = EX.Remote('java -jar active-data-lib-0.1.2.jar', [server], stdout_handler = out_handler, stderr_handler = out_handler).start()
-				self._log("Server started on " + server.address)
-				time.sleep(2)
-				
-				# Launching clients
-				rank=0
-				n_cores = EX5.get_host_attributes(clients[0])['architecture']['smt_size'];
-				cores = nodes * n_cores
-				cores = cores[0:comb['n_clients']] # Cut out the additional cores
-				
-				client_connection_params = {
-						'taktuk_gateway': 'lyon.grid5000.fr',
-						'host_rewrite_func': None
-				}
+				self._log("Running experiment with {0} nodes and {1} transitions per client".format(len(nodes) - 1, comb['n_transitions']))
+				launch_server = self._start_server(nodes[0])
+				self._run_comb(sweeper, comb, nodes, launch_server)
 				
-				self._log("Launching {0} clients...".format(len(cores)))
-				
-				client_cmd = "/usr/bin/env java -cp /home/ansimonet/active-data-lib-0.1.2.jar org.inria.activedata.examples.perf.TransitionsPerSecond " + \
-								"{0} {1} {2} {3} {4}".format(server.address, 1200, "{{range(len(cores))}}", len(cores), comb['n_transitions'])
-				client_out_handler = FileOutputHandler(os.path.join(self.result_dir, "clients.out"))
-				client_request = EX.TaktukRemote(client_cmd, cores, connexion_params = client_connection_params, \
-									stdout_handler = client_out_handler, stderr_handler = client_out_handler)
-				
-				client_request.run()
-				
-				if not client_request.ok():
-					# Some client failed, please panic
-					self._log("One or more client process failed. Enjoy reading their outputs.")
-					self._log("OUTPUT STARTS -------------------------------------------------\n")
-					for process in client_request.processes():
-						print("----- {0} returned {1}".format(process.host().address, process.exit_code()))
-						if not process.stdout() == "": print(GREEN + process.stdout() + NORMAL)
-						if not process.stderr() == "": print(RED + process.stderr() + NORMAL)
-						print("")
-					self._log("OUTPUT ENDS ---------------------------------------------------\n")
-					sweeper.skip(comb)
-					launch_server.kill()
-					launch_server.wait()
-				else:
-					# Waiting for server to end
-					launch_server.wait()
-				
-					# Getting log files
-					distant_path = OUT_FILE_FORMAT.format(len(cores), comb['n_transitions'])
-					local_path = distant_path
-					
-					EX.Get([server], distant_path).run()
-					
-					EX.Local('mv ' + distant_path + ' ' + os.path.join(self.result_dir, local_path)).run()
-					
-					EX.Get([server], 'client_*.out', local_location = self.result_dir)
-					EX.Remote('rm -f client_*.out', [server])
-					
-					self._log("Finishing experiment with {0} clients and {1} transitions per client".format(comb['n_clients'], comb['n_transitions']))
-					
-					sweeper.done(comb)
-					
 				sub_comb = sweeper.get_next (filtr = lambda r: filter(lambda s: s["n_clients"] == comb['n_clients'], r))
 				self._updateStat(sweeper.stats())
 				
@@ -191,30 +145,498 @@ class active_data_tps(Engine):
 					break
 				else: 
 					comb = sub_comb
+	
+	def _run_warm(self, sweeper):
+		# One reservation for the largest number of clients, and one
+		# server kept running as long as it does not exit by itself;
+		# the numbers of clients are stepped through in increasing order
+		if not sweeper.get_remaining(): return
+		remaining = sweeper.get_remaining()
+		job, nodes = self._reserve(max([comb['n_clients'] for comb in remaining]),
+			walltime = "%02d:%02d:00" % divmod(10 * len(remaining), 60))
+		launch_server = None
+		while True:
+			comb = sweeper.get_next(filtr = lambda r: sorted(r, key = lambda s: (s['n_clients'], s['n_transitions'])))
+			if not comb: break
+			
+			if launch_server is None or launch_server.ended():
+				launch_server = self._start_server(nodes[0])
+			else:
+				self._log("Server already running on " + nodes[0].address)
+			
+			self._log("Measurement window: {0} clients, {1} transitions per client".format(comb['n_clients'], comb['n_transitions']))
+			self._run_comb(sweeper, comb, nodes, launch_server, keep_server = True)
+			self._updateStat(sweeper.stats())
 		
-		print ""
+		if launch_server is not None and not launch_server.ended():
+			launch_server.kill()
+			launch_server.wait()
+		EX5.oar.oardel(job)
+		self.__class__._job = None
+	
+	def _run_rampup(self):
+		# One reservation for the largest number of clients, and one
+		# server kept running as long as it does not exit by itself; the
+		# numbers of clients are chosen by _find_knee
+		counts = sorted(set(self.parameters['n_clients']))
+		step = counts[1] - counts[0] if len(counts) > 1 else counts[0]
+		max_steps = len(counts) + int(math.ceil(math.log(max(float(step) / RAMPUP_MIN_STEP, 1), 2)))
+		job, nodes = self._reserve(counts[-1],
+			walltime = "%02d:%02d:00" % divmod(10 * max_steps * len(self.parameters['n_transitions']), 60))
+		self._server = None
+		steps = []
+		knees = {}
+		for n_transitions in self.parameters['n_transitions']:
+			knees[n_transitions] = self._find_knee(counts[0], counts[-1], step, n_transitions, nodes, steps)
+			with open(os.path.join(self.result_dir, "rampup.json"), 'w') as f:
+				json.dump({'steps': steps, 'knees': knees}, f, indent = 1)
+		
+		if self._server is not None and not self._server.ended():
+			self._server.kill()
+			self._server.wait()
+		EX5.oar.oardel(job)
+		self.__class__._job = None
+	
+	def _find_knee(self, low, high, step, n_transitions, nodes, steps):
+		"""Return the largest number of clients not saturating the server
+		
+		Steps from low to high clients by step, until a number of
+		clients saturates the server (see RAMPUP_LINEAR_RATIO), then
+		bisects between the last step that still scales near-linearly
+		and the first one that saturates. Each measurement is appended
+		to steps. Returns the last step if none saturates the server,
+		or None if nothing was measured with low clients.
+		"""
+		measured = {}
+		
+		def measure(n_clients):
+			if n_clients not in measured:
+				if self._server is None or self._server.ended():
+					self._server = self._start_server(nodes[0])
+				self._log("Ramp-up step: {0} clients, {1} transitions per client".format(n_clients, n_transitions))
+				comb = {'n_clients': n_clients, 'n_transitions': n_transitions}
+				stats = self._run_clients(comb, nodes, self._server, keep_server = True)
+				measured[n_clients] = stats
+				steps.append(dict(comb, stats = stats))
+				if stats is not None:
+					self._log("{0} clients: {1:.0f} transitions/s".format(n_clients, stats['sum']))
+			return measured[n_clients]
+		
+		base = measure(low)
+		if base is None or not base['sum']:
+			self._log("No throughput measured with {0} clients".format(low))
+			return None
+		
+		def saturated(smaller, larger):
+			# smaller is the last number of clients scaling near-linearly
+			before, after = measure(smaller), measure(larger)
+			if after is None or not after['sum']:
+				return True
+			added = float(after['sum'] - before['sum']) / (larger - smaller)
+			if added < RAMPUP_LINEAR_RATIO * base['sum'] / low:
+				return True
+			return bool(base['p50'] and after['p50']
+				and base['p50'] / after['p50'] > RAMPUP_LATENCY_FACTOR)
+		
+		last_ok = low
+		knee = None
+		n_clients = low + step
+		while n_clients <= high:
+			if saturated(last_ok, n_clients):
+				knee = n_clients
+				break
+			last_ok = n_clients
+			n_clients += step
+		if knee is None:
+			self._log("No saturation up to {0} clients".format(last_ok))
+			return last_ok
+		while knee - last_ok > RAMPUP_MIN_STEP:
+			middle = (last_ok + knee) // 2
+			if saturated(last_ok, middle):
+				knee = middle
+			else:
+				last_ok = middle
+		self._log("Server saturates above {0} clients ({1} transitions per client)".format(last_ok, n_transitions))
+		return last_ok
+	
+	def _reserve(self, n_clients, walltime = '00:10:00'):
+		"""Reserve, and wait for, the nodes of a server and n_clients clients, and copy the program on them"""
+		# Performing the submission on G5K
+		site = get_cluster_site(self.cluster)
+		self._log("Output will go to " + self.result_dir)
+		
+		n_nodes = int(math.ceil(float(n_clients) / get_host_attributes(self.cluster + '-1')['architecture']['smt_size'])) + 1
+		self._log("Reserving {0} nodes on {1}".format(n_nodes, site))
+		
+		resources = "{cluster=\\'" + self.cluster + "\\'}/nodes=" + str(n_nodes)
+		submission = EX5.OarSubmission(resources = resources, job_type = 'allow_classic_ssh', walltime = walltime)
+		
+		job = EX5.oarsub([(submission, site)])
+		self.__class__._job = job
+		
+		# Sometimes oarsub fails silently
+		if job[0][0] is None:
+			print("\nError: no job was created")
+			sys.exit(1)
+			
+		# Wait for the job to start
+		self._log("Waiting for job {0} to start...\n".format(BOLD_MAGENTA + str(job[0][0]) + NORMAL))
+		EX5.wait_oar_job_start(job[0][0], job[0][1], prediction_callback = prediction)
+		nodes = EX5.get_oar_job_nodes(job[0][0], job[0][1])
+		
+		# Deploying nodes
+		#deployment = EX5.Deployment(hosts = nodes, env_file='path_to_env_file')
+		#run_deploy = EX5.deploy(deployment)
+		#nodes_deployed = run_deploy.hosts[0]
+		
+		# Copying active_data program on all deployed hosts
+		EX.Put([nodes[0]], ['../dist/active-data-lib-0.1.2.jar', '../server.policy'], connexion_params = {'user': 'ansimonet'}).run()
+		return job, nodes
+	
+	def _start_server(self, server):
+		"""Launch the server on one node, and wait for it to listen"""
+		out_handler = FileOutputHandler(self.server_out_path)
+		launch_server = EX.Remote('java -jar active-data-lib-0.1.2.jar', [server], stdout_handler = out_handler, stderr_handler = out_handler).start()
+		ready = EX.Remote("for i in $(seq {0}); do ss -ltn | grep -q ':{1} ' && exit 0; sleep 0.1; done; exit 1".format(
+				SERVER_READY_TIMEOUT * 10, SERVER_PORT), [server]).run()
+		if not ready.ok():
+			self._log("Server on {0} not listening on port {1} after {2}s".format(server.address, SERVER_PORT, SERVER_READY_TIMEOUT))
+		else:
+			self._log("Server started on " + server.address)
+		return launch_server
+	
+	def _topology(self, hosts):
+		"""Return the cpus of hosts, as a dict: keys = hosts, values = lists of (cpu, core, socket)
+		
+		The cpus are listed with lscpu on the hosts, or, if it fails,
+		derived from the Grid5000 API (without hyperthreads).
+		"""
+		if not hasattr(self, '_topologies'): self._topologies = {}
+		unknown = [ host for host in hosts if host not in self._topologies ]
+		if unknown:
+			lscpu = EX.Remote("lscpu -p=CPU,CORE,SOCKET", unknown).run()
+			for process in lscpu.processes():
+				cpus = [ tuple(int(field or 0) for field in line.split(',')) for line in process.stdout().splitlines()
+					if line and not line.startswith('#') ]
+				if process.ok() and cpus:
+					self._topologies[process.host()] = cpus
+			for host in unknown:
+				if host not in self._topologies:
+					architecture = get_host_attributes(host)['architecture']
+					n_cores, n_sockets = architecture['smt_size'], architecture['smp_size']
+					self._topologies[host] = [ (cpu, cpu, cpu * n_sockets // n_cores) for cpu in range(n_cores) ]
+		return dict((host, self._topologies[host]) for host in hosts)
+	
+	def _client_slots(self, nodes, n_clients):
+		"""Return the placement of n_clients clients, as a list of dicts (host, cpu, core, socket)
+		
+		Clients are spread round robin over the nodes (excluding the
+		server node if -x). On each node, they are placed on one cpu
+		per physical core, alternating sockets, then on the other
+		hyperthreads of the cores.
+		"""
+		hosts = nodes[1:] if self.options.exclude_server else nodes
+		topology = self._topology(hosts)
+		per_host = []
+		for host in hosts:
+			# rank of each core in its socket, and of each cpu in its core
+			socket_cores = {}
+			for (cpu, core, socket) in topology[host]:
+				socket_cores.setdefault(socket, set()).add(core)
+			core_rank = dict(((socket, core), rank) for (socket, cores) in socket_cores.items()
+				for (rank, core) in enumerate(sorted(cores)))
+			threads = {}
+			ordered = []
+			for (cpu, core, socket) in sorted(topology[host]):
+				thread = threads.get((socket, core), 0)
+				threads[(socket, core)] = thread + 1
+				ordered.append(((thread, core_rank[(socket, core)], socket), {'host': host, 'cpu': cpu, 'core': core, 'socket': socket}))
+			per_host.append([ slot for (key, slot) in sorted(ordered, key = lambda o: o[0]) ])
+		slots = []
+		for i in range(max([ len(cpus) for cpus in per_host ])):
+			slots.extend([ cpus[i] for cpus in per_host if i < len(cpus) ])
+		if len(slots) < n_clients:
+			self._log("Only {0} cpus for {1} clients, some cpus run several clients".format(len(slots), n_clients))
+			slots = (slots * int(math.ceil(float(n_clients) / len(slots))))
+		return slots[0:n_clients]
+	
+	def _run_comb(self, sweeper, comb, nodes, launch_server, keep_server = False):
+		"""Run the clients of a combination, and mark it done or skipped"""
+		if self._run_clients(comb, nodes, launch_server, keep_server) is None:
+			sweeper.skip(comb)
+		else:
+			sweeper.done(comb)
+	
+	def _run_clients(self, comb, nodes, launch_server, keep_server = False):
+		"""Run the clients of a combination, and get the results
+		
+		If keep_server, the server is left running after the clients
+		end, and its results file is fetched as soon as it is written
+		(within SERVER_RESULTS_TIMEOUT seconds).
+		
+		Returns the throughput aggregates (see `ThroughputHandler.stats`),
+		or None if a client or the server failed, or if the results
+		file could not be fetched.
+		"""
+		server = nodes[0] 
+		
+		# Launching clients
+		slots = self._client_slots(nodes, comb['n_clients'])
+		cores = [ slot['host'] for slot in slots ]
+		cpus = [ slot['cpu'] for slot in slots ]
+		with open(os.path.join(self.result_dir, PLACEMENT_FILE_FORMAT.format(len(cores), comb['n_transitions'])), 'w') as f:
+			json.dump([ dict(slot, host = slot['host'].address, rank = rank) for (rank, slot) in enumerate(slots) ], f)
+		
+		client_connection_params = {
+				'taktuk_gateway': 'lyon.grid5000.fr',
+				'host_rewrite_func': None
+		}
+		
+		# Removing the results of a previous run, not to fetch them instead
+		distant_path = OUT_FILE_FORMAT.format(len(cores), comb['n_transitions'])
+		local_path = distant_path
+		EX.Remote('rm -f ' + distant_path, [server]).run()
+		
+		self._log("Launching {0} clients...".format(len(cores)))
+		
+		client_cmd = ("taskset -c {{cpus}} " if self.options.pin else "") + \
+						"/usr/bin/env java -cp /home/ansimonet/active-data-lib-0.1.2.jar org.inria.activedata.examples.perf.TransitionsPerSecond " + \
+						"{0} {1} {2} {3} {4}".format(server.address, SERVER_PORT, "{{range(len(cores))}}", len(cores), comb['n_transitions'])
+		client_out_handler = FileOutputHandler(os.path.join(self.result_dir, "clients.out"))
+		throughput_handler = ThroughputHandler(client_out_handler, n_clients = len(cores), display = self._log)
+		client_request = EX.TaktukRemote(client_cmd, cores, connexion_params = client_connection_params, \
+							stdout_handler = throughput_handler, stderr_handler = client_out_handler)
+		# the i-th process is the client of index i
+		throughput_handler.client_index = dict((process, index) for (index, process) in enumerate(client_request.processes()))
+		
+		client_request.run()
+		client_out_handler.close()
+		stats = throughput_handler.write_summary(os.path.join(self.result_dir,
+			SUMMARY_FILE_FORMAT.format(len(cores), comb['n_transitions'])))
+		if not stats['samples']:
+			self._log("No throughput line of the clients matched {0!r}, see clients.out".format(THROUGHPUT_RE.pattern))
+		
+		if not client_request.ok():
+			# Some client failed, please panic
+			self._log("One or more client process failed. Enjoy reading their outputs.")
+			self._log("OUTPUT STARTS -------------------------------------------------\n")
+			for process in client_request.processes():
+				print("----- {0} returned {1}".format(process.host().address, process.exit_code()))
+				if not process.stdout() == "": print(GREEN + process.stdout() + NORMAL)
+				if not process.stderr() == "": print(RED + process.stderr() + NORMAL)
+				print("")
+			self._log("OUTPUT ENDS ---------------------------------------------------\n")
+			launch_server.kill()
+			launch_server.wait()
+			return None
+		else:
+			if keep_server:
+				# Waiting for the server to write its results
+				written = EX.Remote("for i in $(seq {0}); do test -s {1} && exit 0; sleep 0.1; done; exit 1".format(
+						SERVER_RESULTS_TIMEOUT * 10, distant_path), [server]).run()
+				if not written.ok():
+					self._log("Server on {0} did not write {1} within {2}s".format(server.address, distant_path, SERVER_RESULTS_TIMEOUT))
+					return None
+			else:
+				# Waiting for server to end
+				launch_server.wait()
+			if launch_server.ended() and not launch_server.ok():
+				self._log("Server on {0} exited with an error".format(server.address))
+				return None
+			
+			# Getting log files
+			get = EX.Get([server], distant_path).run()
+			if not get.ok():
+				self._log("Could not get {0} from {1}".format(distant_path, server.address))
+				return None
+			
+			move = EX.Local('mv ' + distant_path + ' ' + os.path.join(self.result_dir, local_path)).run()
+			if not move.ok():
+				self._log("Could not move {0} to {1}".format(distant_path, self.result_dir))
+				return None
+			
+			EX.Get([server], 'client_*.out', local_location = self.result_dir)
+			EX.Remote('rm -f client_*.out', [server])
+			
+			self._log("Finishing experiment with {0} clients and {1} transitions per client".format(comb['n_clients'], comb['n_transitions']))
+			return stats
 
 def prediction(timestamp):
 	start = datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
 	active_data_tps._log("Waiting for job to start (prediction: {0})".format(start), False)
 
+class _pending_output(object):
+	# strings queued by a FileOutputHandler for its writer thread
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.drained = threading.Condition(self.lock)
+		self.wake = threading.Event()
+		self.strings = []
+		self.size = 0
+		self.closed = False
+
+def _write_loop(out_file, pending, flush_interval):
+	# FileOutputHandler writer thread
+	while True:
+		pending.wake.wait(flush_interval)
+		with pending.lock:
+			pending.wake.clear()
+			strings = pending.strings
+			pending.strings = []
+			pending.size = 0
+			closed = pending.closed
+			pending.drained.notify_all()
+		if strings:
+			out_file.write("".join(strings))
+			out_file.flush()
+		if closed:
+			out_file.close()
+			return
+
 class FileOutputHandler(ProcessOutputHandler):
-	__file = None
+	"""Appends the output of processes to a file, through a background writer thread
+	
+	The execo I/O thread only appends the strings to a list. The
+	writer thread writes them in batches, when max_buffer bytes are
+	pending, every flush_interval seconds, when a process reaches eof,
+	and on close. If max_pending bytes are pending, the I/O thread
+	waits for the writer.
+	"""
 	
-	def __init__(self, path):
-		super(ProcessOutputHandler, self).__init__()
-		self.__file = open(path, 'a')
+	def __init__(self, path, max_buffer = 65536, flush_interval = 1.0, max_pending = 16 * 1024 * 1024):
+		super(FileOutputHandler, self).__init__()
+		self.max_buffer = max_buffer
+		self.max_pending = max_pending
+		self.__pending = _pending_output()
+		self.__timestamp = (None, None)
+		# the writer does not reference the handler, so that the handler
+		# is closed when garbage collected
+		self.__writer = threading.Thread(target = _write_loop, name = "FileOutputHandler " + path,
+			args = (open(path, 'a'), self.__pending, flush_interval))
+		self.__writer.daemon = True
+		self.__writer.start()
 	
 	def __del__(self):
-		self.__file.flush()
-		self.__file.close()
+		self.close()
+	
+	def close(self):
+		"""Write all pending strings, and close the file"""
+		with self.__pending.lock:
+			self.__pending.closed = True
+		self.__pending.wake.set()
+		self.__writer.join()
+	
+	def _timestamp(self):
+		# strftime only once per second
+		now = int(time.time())
+		if self.__timestamp[0] != now:
+			self.__timestamp = (now, time.strftime("[%d-%m-%y %H:%M:%S] ", time.localtime(now)))
+		return self.__timestamp[1]
+	
+	def _write(self, string, flush):
+		pending = self.__pending
+		with pending.lock:
+			pending.strings.append(string)
+			pending.size += len(string)
+			while pending.size >= self.max_pending and not pending.closed:
+				pending.wake.set()
+				pending.drained.wait()
+			flush = flush or pending.size >= self.max_buffer
+		if flush:
+			pending.wake.set()
+	
+	def read(self, process, string, eof=False, error=False):
+		self._write(string, eof or error)
+	
+	def read_line(self, process, string, eof=False, error=False):
+		self._write(self._timestamp() + string, eof or error)
+
+def percentile(sorted_values, p):
+	"""Return the p-th percentile of a sorted list, interpolated between the closest ranks
+	
+	The 50th percentile is the median: the mean of the two middle
+	values of an even number of values.
+	"""
+	if not sorted_values: return None
+	rank = p / 100.0 * (len(sorted_values) - 1)
+	lower = int(math.floor(rank))
+	upper = min(lower + 1, len(sorted_values) - 1)
+	return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+class ThroughputHandler(ProcessOutputHandler):
+	"""Parses the clients' transitions/sec lines as they are output, and keeps running aggregates
+	
+	The latest throughput of each client is kept in memory. At most
+	every display_interval seconds, the sum, percentiles and
+	stragglers (clients below straggler_ratio times the median) are
+	passed to the display function. The output is also forwarded to
+	another handler (e.g. a FileOutputHandler).
+	
+	Stragglers are identified by their index in client_index (a dict:
+	keys = processes, values = client indexes), as several clients
+	may run on the same host, or else by their host address.
+	"""
+	
+	def __init__(self, forward = None, n_clients = None, display = None, display_interval = 1.0, straggler_ratio = 0.5, client_index = None):
+		super(ThroughputHandler, self).__init__()
+		self.forward = forward
+		self.n_clients = n_clients
+		self.client_index = client_index
+		self.display = display
+		self.display_interval = display_interval
+		self.straggler_ratio = straggler_ratio
+		self.start = time.time()
+		self.rates = {}		# latest throughput per client
+		self.samples = 0
+		self.__lines = {}
+		self.__last_display = 0
+		self.__lock = threading.Lock()
 	
 	def read(self, process, string, eof=False, error=False):
-		self.__file.write(string)
-		self.__file.flush()
+		if self.forward is not None:
+			self.forward.read(process, string, eof, error)
+		lines = (self.__lines.pop(process, "") + string).split('\n')
+		if not (eof or error):
+			self.__lines[process] = lines.pop()
+		for line in lines:
+			self.read_line(process, line, eof, error)
 	
 	def read_line(self, process, string, eof=False, error=False):
-		self.__file.write(time.localtime().strftime("[%d-%m-%y %H:%M:%S"))
-		self.__file.write(' ')
-		self.__file.write(string)
-		self.__file.flush()
+		match = THROUGHPUT_RE.search(string)
+		if not match: return
+		with self.__lock:
+			self.rates[process] = float(match.group(1))
+			self.samples += 1
+			if self.display is None or time.time() - self.__last_display < self.display_interval: return
+			self.__last_display = time.time()
+			stats = self.stats()
+		self.display("{0}/{1} clients: {2:.0f} transitions/s (p10 {3:.0f}, p50 {4:.0f}), {5} stragglers".format(
+				stats['clients'], self.n_clients or '?', stats['sum'], stats['p10'], stats['p50'], len(stats['stragglers'])), False)
+	
+	def stats(self):
+		"""Return the current aggregates of the clients' throughputs"""
+		rates = sorted(self.rates.values())
+		median = percentile(rates, 50)
+		stragglers = [ self.client_index[process] if self.client_index else process.host().address
+			for (process, rate) in self.rates.items() if rate < self.straggler_ratio * median ]
+		return {
+			'clients': len(rates),
+			'samples': self.samples,
+			'duration': time.time() - self.start,
+			'sum': sum(rates),
+			'min': rates[0] if rates else None,
+			'p10': percentile(rates, 10),
+			'p50': median,
+			'p90': percentile(rates, 90),
+			'max': rates[-1] if rates else None,
+			'stragglers': sorted(stragglers)
+		}
+	
+	def write_summary(self, path):
+		"""Write the aggregates, as json, to path"""
+		with self.__lock:
+			stats = self.stats()
+		with open(path, 'w') as f:
+			json.dump(stats, f, indent = 1)
+		return stats
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""Compare the synchronous and the buffered FileOutputHandler of active_data_tps
+
+Simulates num_streams client processes (as the Taktuk clients of
+active_data_tps) whose output is read, as by the execo I/O thread, in
+a single thread, chunk after chunk, and funnelled into one file.
+
+- sync: write + flush for each chunk, strftime for each line (the
+  former FileOutputHandler).
+
+- buffered: active_data_tps.FileOutputHandler.
+
+For each, the time spent in the I/O thread (in the handler calls),
+and the total time until all the output is written, are shown. The
+cost of the sync handler grows with the cost of a write syscall, so
+directory should preferably be on the filesystem of the result dir
+(e.g. NFS home on a Grid5000 frontend).
+
+usage: bench_file_output_handler.py [num_streams] [chunks_per_stream] [chunk_size] [directory]
+"""
+
+import sys, os, time, tempfile
+from active_data_tps import FileOutputHandler
+
+class sync_file_output_handler(object):
+
+	def __init__(self, path):
+		self.__file = open(path, 'a')
+
+	def close(self):
+		self.__file.close()
+
+	def read(self, process, string, eof=False, error=False):
+		self.__file.write(string)
+		self.__file.flush()
+
+	def read_line(self, process, string, eof=False, error=False):
+		self.__file.write(time.strftime("[%d-%m-%y %H:%M:%S] ", time.localtime()))
+		self.__file.write(string)
+		self.__file.flush()
+
+def simulate(handler, num_streams, chunks_per_stream, chunk_size, by_line):
+	# feeds the handler with the output of num_streams processes, round robin
+	line = ("x" * (chunk_size - 1)) + "\n"
+	processes = [ object() for i in range(0, num_streams) ]
+	for chunk in range(0, chunks_per_stream):
+		eof = (chunk == chunks_per_stream - 1)
+		for process in processes:
+			if by_line:
+				handler.read_line(process, line, eof)
+			else:
+				handler.read(process, line, eof)
+
+if __name__ == "__main__":
+	num_streams = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	chunks_per_stream = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+	chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 80
+	print("%i streams, %i chunks of %i bytes per stream" % (num_streams, chunks_per_stream, chunk_size))
+	directory = tempfile.mkdtemp(dir = sys.argv[4] if len(sys.argv) > 4 else None)
+	for by_line in [ False, True ]:
+		for (name, handler_class) in [ ("sync", sync_file_output_handler), ("buffered", FileOutputHandler) ]:
+			path = os.path.join(directory, "%s_%s.out" % (name, by_line))
+			handler = handler_class(path)
+			start = time.time()
+			simulate(handler, num_streams, chunks_per_stream, chunk_size, by_line)
+			io_thread = time.time() - start
+			handler.close()
+			total = time.time() - start
+			size = os.path.getsize(path)
+			os.remove(path)
+			print("%-8s %-9s I/O thread %7.3fs, total %7.3fs, %i bytes" % (
+				name, "read_line" if by_line else "read", io_thread, total, size))
+	os.rmdir(directory)
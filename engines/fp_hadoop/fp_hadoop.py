@@ -1,10 +1,24 @@
-import os, time, datetime
+import os, sys, time, datetime, json, hashlib
+from execo import Remote, Host
 from execo.time_utils import timedelta_to_seconds, format_date
-from execo_g5k import get_cluster_site, get_oar_job_info, oardel, oarsub, \
-    get_planning, compute_slots, get_jobs_specs, get_oar_job_nodes, \
-    deploy, Deployment, get_host_attributes
+from execo_g5k import get_oar_job_info, oardel, oarsub, \
+    get_jobs_specs, get_oar_job_nodes, \
+    deploy, Deployment
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'lib'))
+from g5k_api_cache import get_host_attributes, get_cluster_site
+from g5k_planning_cache import planning_cache
 from execo_engine import Engine, logger, sweep, ParamSweeper
 
+_DEPLOYED_MARKER = '/root/.fp_hadoop_deployed'
+
+# parameters shaping the dataset: combinations differing only by the
+# other parameters use the same dataset
+_DATASET_PARAMETERS = ['sizes', 'zipf', 'pop_keys']
+
+def dataset_key(comb):
+    """Return the values of the parameters shaping the dataset of a combination"""
+    return tuple(comb[param] for param in _DATASET_PARAMETERS)
+
 class fp_hadoop(Engine):
 
     def __init__(self):
@@ -27,6 +41,10 @@ class fp_hadoop(Engine):
                     help="walltime for the reservation",
                     type="string",
                     default="3:00:00")
+        self.options_parser.add_option("-e", dest="env_file",
+                    help="kadeploy environment file",
+                    type="string",
+                    default="/home/mliroz/deploys/hadoop6.env")
 
     def xp(self, comb):
         comb_ok = False
@@ -47,6 +65,9 @@ class fp_hadoop(Engine):
         self.define_parameters()
         self.cluster = self.args[0]
         self.site = get_cluster_site(self.cluster)
+        # a single planning cache, for all the reservations of the run
+        self.planning = planning_cache(elements=[self.cluster],
+                                       out_of_chart=self.options.outofchart)
         if self.options.oar_job_id:
             self.oar_job_id = self.options.oar_job_id
         else:
@@ -66,10 +87,12 @@ class fp_hadoop(Engine):
                 # Retrieving the hosts and subnets parameters
                 self.hosts = get_oar_job_nodes(self.oar_job_id, self.frontend)
                 # Hosts deployment
-                deployed, undeployed = deploy(Deployment(self.hosts, 
-                    env_file="/home/mliroz/deploys/hadoop6.env"))
+                deployed, undeployed = self.deploy_hosts()
                 logger.info("%i deployed, %i undeployed" % (len(deployed), 
                                                             len(undeployed)))
+                if len(self.newly_deployed) > 0:
+                    # HDFS has been reinstalled
+                    self.forget_datasets()
                 if len(deployed) == 0:
                     break
                 # Configuration du systeme => look at the execo_g5k.topology module 
@@ -77,14 +100,16 @@ class fp_hadoop(Engine):
                 
                 ## SETUP FINISHED
                 
-                # Getting the next combination
-                comb = self.sweeper.get_next()
+                # Getting the next combination, preferably one whose
+                # dataset is already generated
+                comb = self.sweeper.get_next(self._dataset_order)
                 self.prepare_dataset(comb)
                 self.xp(comb)
-                # subloop over the combinations that have the same sizes
+                # subloop over the combinations that have the same dataset
                 while True:
                     newcomb = self.sweeper.get_next(lambda r:
-                            filter(lambda subcomb: subcomb['sizes'] == comb['sizes'], r))
+                            [subcomb for subcomb in r
+                             if dataset_key(subcomb) == dataset_key(comb)])
                     if newcomb:
                         try:
                             self.xp(newcomb)
@@ -104,6 +129,129 @@ class fp_hadoop(Engine):
                 else:
                     logger.info('Keeping job alive for debugging') 
 
+    def _env_hash(self):
+        """Return a hash of the kadeploy environment file (or of its path if unreadable)"""
+        try:
+            with open(self.options.env_file, 'rb') as f:
+                return hashlib.md5(f.read()).hexdigest()
+        except (IOError, OSError):
+            return hashlib.md5(self.options.env_file.encode()).hexdigest()
+
+    def _load_deployments(self):
+        """Load the (job id, host, env hash) of the hosts already deployed"""
+        filename = os.path.join(self.result_dir, 'deployments.json')
+        if not os.path.exists(filename):
+            return set()
+        with open(filename) as f:
+            return set(tuple(deployment) for deployment in json.load(f))
+
+    def _save_deployments(self):
+        with open(os.path.join(self.result_dir, 'deployments.json'), 'w') as f:
+            json.dump(sorted(self.deployments), f)
+
+    def deploy_hosts(self):
+        """Deploy the job hosts, skipping those already deployed with the environment
+
+        The hosts deployed in this job with this environment are
+        recorded in the result dir, and a marker file holding the job
+        id and environment hash is written on them. A host known as
+        deployed is only checked for its marker file, other hosts, and
+        hosts whose marker file is missing or different, are deployed.
+        """
+        if not hasattr(self, 'deployments'):
+            self.deployments = self._load_deployments()
+        env_hash = self._env_hash()
+        fingerprint = '%s %s' % (self.oar_job_id, env_hash)
+        hosts = [Host(host).address for host in self.hosts]
+        known = [host for host in hosts
+                 if (self.oar_job_id, host, env_hash) in self.deployments]
+        deployed = set()
+        if len(known) > 0:
+            check = Remote("grep -qxF '%s' %s" % (fingerprint, _DEPLOYED_MARKER),
+                           known, connection_params={'user': 'root'})
+            for p in check.processes:
+                p.nolog_exit_code = p.nolog_timeout = p.nolog_error = True
+                p.timeout = 30
+            check.run()
+            deployed.update(p.host.address for p in check.processes if p.ok)
+        to_deploy = [host for host in hosts if host not in deployed]
+        logger.info('%i hosts already deployed, %i to deploy',
+                    len(deployed), len(to_deploy))
+        undeployed = set()
+        if len(to_deploy) > 0:
+            newly_deployed, undeployed = deploy(
+                Deployment(to_deploy, env_file=self.options.env_file),
+                check_deployed_command=False)
+            if len(newly_deployed) > 0:
+                Remote("echo '%s' > %s" % (fingerprint, _DEPLOYED_MARKER),
+                       list(newly_deployed),
+                       connection_params={'user': 'root'}).run()
+            deployed.update(newly_deployed)
+        self.newly_deployed = set(host for host in to_deploy if host in deployed)
+        self.deployments.difference_update((self.oar_job_id, host, env_hash)
+                                           for host in undeployed)
+        self.deployments.update((self.oar_job_id, host, env_hash)
+                                for host in deployed)
+        self._save_deployments()
+        return deployed, undeployed
+
+    def _load_datasets(self):
+        """Load the manifest of the datasets generated in each job"""
+        filename = os.path.join(self.result_dir, 'datasets.json')
+        if not os.path.exists(filename):
+            return {}
+        with open(filename) as f:
+            return dict((int(job_id), set(tuple(key) for key in keys))
+                        for job_id, keys in json.load(f).items())
+
+    def _save_datasets(self):
+        with open(os.path.join(self.result_dir, 'datasets.json'), 'w') as f:
+            json.dump(dict((str(job_id), sorted(keys))
+                           for job_id, keys in self.datasets.items()), f)
+
+    def _job_datasets(self):
+        """Return the set of the dataset keys generated in the current job"""
+        if not hasattr(self, 'datasets'):
+            self.datasets = self._load_datasets()
+        return self.datasets.setdefault(self.oar_job_id, set())
+
+    def forget_datasets(self):
+        """Forget the datasets generated in the current job"""
+        self._job_datasets().clear()
+        self._save_datasets()
+
+    def _dataset_order(self, remaining):
+        """Order the combinations to maximise the reuse of the datasets
+
+        Combinations whose dataset is already generated come first,
+        then those whose dataset is shared by the most remaining
+        combinations.
+        """
+        generated = self._job_datasets()
+        counts = {}
+        for comb in remaining:
+            counts[dataset_key(comb)] = counts.get(dataset_key(comb), 0) + 1
+        return sorted(remaining, key=lambda comb: (
+                dataset_key(comb) not in generated,
+                -counts[dataset_key(comb)],
+                dataset_key(comb)))
+
+    def prepare_dataset(self, comb):
+        """Generate the dataset of a combination, unless already generated in the job"""
+        key = dataset_key(comb)
+        generated = self._job_datasets()
+        if key in generated:
+            logger.info('Reusing dataset %s', dict(zip(_DATASET_PARAMETERS, key)))
+            return
+        logger.info('Generating dataset %s', dict(zip(_DATASET_PARAMETERS, key)))
+        self.generate_dataset(comb)
+        generated.add(key)
+        self._save_datasets()
+
+    def generate_dataset(self, comb):
+        """Generate on HDFS the zipf dataset of the combination"""
+        pass
+
     def define_parameters(self):
         """Create the iterator that contains the parameters to be explored """
         self.parameters = {
@@ -120,27 +268,20 @@ class fp_hadoop(Engine):
         logger.info('Number of parameters combinations %s', len(self.sweeper.get_remaining()))
 
     def _get_nodes(self, starttime, endtime):
-        """ """
-        planning = get_planning(elements=[self.cluster],
-                                starttime=starttime,
-                                endtime=endtime,
-                                out_of_chart=self.options.outofchart)
-        slots = compute_slots(planning, self.options.walltime)
-        startdate = slots[0][0]
-        i_slot = 0
-        n_nodes = slots[i_slot][2][self.cluster]
-        while n_nodes < self.n_nodes:
-            logger.debug(slots[i_slot])
-            startdate = slots[i_slot][0]
-            n_nodes = slots[i_slot][2][self.cluster]
-            i_slot += 1
-            if i_slot == len(slots) - 1:
-                return False, False
-        return startdate, self.n_nodes
+        """Return the start date of the first slot with enough nodes on the cluster"""
+        slot = self.planning.find_first_slot(self.options.walltime,
+                                             {self.cluster: self.n_nodes},
+                                             starttime=starttime,
+                                             endtime=endtime)
+        if slot is None:
+            return False, False
+        logger.debug(slot)
+        return slot[0], self.n_nodes
 
     def make_reservation(self):
         """Perform a reservation of the required number of nodes"""
         logger.info('Performing reservation')
+        # only the new part of the window is retrieved at each step
         starttime = int(time.time() + timedelta_to_seconds(datetime.timedelta(minutes=1)))
         endtime = int(starttime + timedelta_to_seconds(datetime.timedelta(days=3,
                                                                  minutes=1)))
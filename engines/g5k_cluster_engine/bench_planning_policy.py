@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""Compare g5k_cluster_engine with and without the planning policy.
+
+Runs the same bag of tasks, shared by two fake clusters, on
+`fake_oar.fake_oar` whose background load is the recorded planning
+``planning_fixture.json`` (fakecluster0 fully busy for about four
+hours, fakecluster1 partly free), scaled down by time_scale. Reports
+the makespan and the number of tasks run on each cluster.
+
+usage: bench_planning_policy.py [num_tasks] [task_duration] [time_scale]
+"""
+
+import sys, os, time, tempfile, shutil
+from threading import Lock
+from execo_g5k import OarSubmission
+from g5k_cluster_engine import g5k_cluster_engine
+from fake_oar import fake_oar, load_planning
+
+class bench_engine(g5k_cluster_engine):
+
+    def __init__(self, num_tasks, task_duration, time_scale):
+        super(bench_engine, self).__init__()
+        self.oar = fake_oar(planning = load_planning(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "planning_fixture.json"),
+                time_scale))
+        self.task_duration = task_duration
+        self.remaining = num_tasks
+        self.lock = Lock()
+        self.tasks_per_cluster = {}
+
+    def get_clusters(self):
+        return [ "fakecluster0.fakesite", "fakecluster1.fakesite" ]
+
+    def get_job(self, cluster):
+        with self.lock:
+            if self.remaining == 0:
+                return None
+            self.remaining -= 1
+        return (OarSubmission(resources = "{cluster='%s'}/nodes=1" % (cluster,),
+                              walltime = int(self.task_duration * 2)),
+                cluster)
+
+    def worker(self, cluster, site, data, nodes, worker_index, oarsubmission, jobid):
+        time.sleep(self.task_duration)
+        with self.lock:
+            self.tasks_per_cluster[cluster] = self.tasks_per_cluster.get(cluster, 0) + 1
+
+def bench(num_tasks, task_duration, time_scale, planning):
+    result_dir = tempfile.mkdtemp(prefix = "bench_planning_policy_")
+    try:
+        engine = bench_engine(num_tasks, task_duration, time_scale)
+        args = [ "-c", result_dir, "-l", "WARNING", "-e",
+                 "-r", "4", "-t", "2", "-s", "1" ]
+        if planning:
+            args.extend([ "-g", "-G", "5", "-w", str(int(task_duration * 10)) ])
+        start = time.time()
+        engine.start(args)
+        return time.time() - start, engine.tasks_per_cluster
+    finally:
+        shutil.rmtree(result_dir)
+
+if __name__ == "__main__":
+    num_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    task_duration = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    time_scale = float(sys.argv[3]) if len(sys.argv) > 3 else 0.002
+    for planning in [ False, True ]:
+        makespan, tasks_per_cluster = bench(num_tasks, task_duration, time_scale, planning)
+        print("%-16s makespan = %7.2fs  tasks per cluster = %s" % (
+            "planning policy" if planning else "thresholds only", makespan,
+            ", ".join([ "%s: %i" % item for item in sorted(tasks_per_cluster.items()) ])))
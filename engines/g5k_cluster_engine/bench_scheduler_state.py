@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Micro-benchmark of a g5k_cluster_engine scheduling pass.
+
+Compares, for a large number of simulated workers, the cost of one
+scheduling pass with the former full rescan of all worker threads and
+with the incrementally maintained `g5k_cluster_engine._SchedulerState`.
+
+usage: bench_scheduler_state.py [num_workers] [num_clusters]
+"""
+
+import sys, timeit
+from g5k_cluster_engine import _SchedulerState
+
+class fake_worker(object):
+
+    def __init__(self, cluster, site):
+        self.cluster = cluster
+        self.site = site
+        self.waiting = True
+
+    def is_alive(self):
+        return True
+
+def rescan_pass(sites_clusters_threads, clusters_to_submit):
+    # former scheduling pass: rebuilds the view from all threads
+    for site in list(sites_clusters_threads.keys()):
+        for cluster in list(sites_clusters_threads[site].keys()):
+            sites_clusters_threads[site][cluster] = [
+                th
+                for th in sites_clusters_threads[site][cluster]
+                if th.is_alive() ]
+    all_involved_sites = set(sites_clusters_threads.keys())
+    all_involved_sites.update([ s for (c, s) in clusters_to_submit ])
+    for site in all_involved_sites:
+        all_involved_clusters = set()
+        if site in sites_clusters_threads:
+            all_involved_clusters.update(sites_clusters_threads[site].keys())
+        all_involved_clusters.update([ c for (c, s) in clusters_to_submit if s == site ])
+        for cluster in all_involved_clusters:
+            num_workers = len(sites_clusters_threads[site][cluster])
+            num_waiting = len([ th for th in sites_clusters_threads[site][cluster]
+                                if th.waiting ])
+
+def indexed_pass(state, clusters_to_submit):
+    all_involved_clusters = set(clusters_to_submit)
+    all_involved_clusters.update(state.clusters())
+    for (cluster, site) in all_involved_clusters:
+        (num_workers, num_waiting) = state.counts(cluster, site)
+
+if __name__ == "__main__":
+    num_workers = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    num_clusters = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    clusters = [ ("cluster%i" % (i,), "site%i" % (i % 8,)) for i in range(0, num_clusters) ]
+    sites_clusters_threads = {}
+    state = _SchedulerState()
+    for i in range(0, num_workers):
+        (cluster, site) = clusters[i % num_clusters]
+        worker = fake_worker(cluster, site)
+        sites_clusters_threads.setdefault(site, {}).setdefault(cluster, []).append(worker)
+        state.add(worker)
+        if i % 3 == 0:
+            state.started(worker)
+    clusters_to_submit = set(clusters)
+    number = 20
+    rescan = timeit.timeit(lambda: rescan_pass(sites_clusters_threads, clusters_to_submit), number = number) / number
+    indexed = timeit.timeit(lambda: indexed_pass(state, clusters_to_submit), number = number) / number
+    print("%i workers on %i clusters" % (num_workers, num_clusters))
+    print("rescan pass:  %9.3f ms" % (rescan * 1000,))
+    print("indexed pass: %9.3f ms (x%.0f)" % (indexed * 1000, rescan / indexed))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Measure the scheduling latency of g5k_cluster_engine on a fake oar.
+
+Runs the same bag of short tasks twice on `fake_oar.fake_oar`, once
+with the periodic scheduling loop, once in event driven mode (-e),
+and reports the makespan and the mean delay between a worker exit and
+the start of the next worker on the same cluster.
+
+usage: bench_scheduling.py [num_tasks] [task_duration] [schedule_delay] [pool|asyncio]
+"""
+
+import sys, time, tempfile, shutil
+from threading import Lock
+from g5k_cluster_engine import g5k_cluster_engine
+from fake_oar import fake_oar
+
+class bench_engine(g5k_cluster_engine):
+
+    def __init__(self, num_tasks, task_duration):
+        super(bench_engine, self).__init__()
+        self.oar = fake_oar(start_delay = 0.5)
+        self.task_duration = task_duration
+        self.remaining = dict([ (cluster, num_tasks) for cluster in self.get_clusters() ])
+        self.lock = Lock()
+        self.last_exit = {}
+        self.gaps = []
+
+    def get_clusters(self):
+        return [ "fakecluster%i.fakesite" % (i,) for i in range(0, 2) ]
+
+    def get_job(self, cluster):
+        with self.lock:
+            if self.remaining[cluster + ".fakesite"] == 0:
+                return None
+            self.remaining[cluster + ".fakesite"] -= 1
+        return (None, cluster)
+
+    def worker(self, cluster, site, data, nodes, worker_index, oarsubmission, jobid):
+        with self.lock:
+            if cluster in self.last_exit:
+                self.gaps.append(time.time() - self.last_exit.pop(cluster))
+        time.sleep(self.task_duration)
+        with self.lock:
+            self.last_exit[cluster] = time.time()
+
+def bench(num_tasks, task_duration, schedule_delay, event_driven, execution_backend):
+    result_dir = tempfile.mkdtemp(prefix = "bench_scheduling_")
+    try:
+        engine = bench_engine(num_tasks, task_duration)
+        args = [ "-c", result_dir, "-l", "WARNING",
+                 "-r", "1", "-t", "1", "-s", str(schedule_delay),
+                 "-b", execution_backend ]
+        if event_driven:
+            args.append("-e")
+        start = time.time()
+        engine.start(args)
+        makespan = time.time() - start
+        mean_gap = sum(engine.gaps) / max(len(engine.gaps), 1)
+        return makespan, mean_gap
+    finally:
+        shutil.rmtree(result_dir)
+
+if __name__ == "__main__":
+    num_tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    task_duration = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    schedule_delay = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    execution_backend = sys.argv[4] if len(sys.argv) > 4 else "pool"
+    for event_driven in [ False, True ]:
+        makespan, mean_gap = bench(num_tasks, task_duration, schedule_delay, event_driven, execution_backend)
+        print("%-12s makespan = %7.2fs  mean exit -> next start = %6.2fs" % (
+            "event driven" if event_driven else "periodic", makespan, mean_gap))
@@ -0,0 +1,170 @@
+from execo import Host
+from execo.time_utils import get_seconds
+from threading import Lock
+from g5k_cluster_engine import _planning_earliest_start
+import time, random, re, copy, json
+
+def load_planning(filename, time_scale = 1.0):
+    """Load a planning recorded in a json file.
+
+    The file contains a dict with keys ``date``: the date of the
+    recording, and ``planning``: the planning, as returned by
+    ``execo_g5k.planning.get_planning``. The dates of the planning are
+    shifted so that the recording date becomes now, and the durations
+    are multiplied by time_scale.
+    """
+    with open(filename) as f:
+        recorded = json.load(f)
+    now = time.time()
+    shift = lambda date: now + (date - recorded["date"]) * time_scale
+    planning = {}
+    for (site, site_planning) in recorded["planning"].items():
+        for (cluster, cluster_planning) in site_planning.items():
+            for (host, host_planning) in cluster_planning.items():
+                planning.setdefault(site, {}).setdefault(cluster, {})[host] = dict(
+                    [ (kind, [ (shift(start), shift(stop)) for (start, stop) in host_planning[kind] ])
+                      for kind in [ "busy", "free" ] ])
+    return planning
+
+class fake_oar(object):
+
+    """In-memory oar backend for `g5k_cluster_engine.g5k_cluster_engine`.
+
+    Replaces the real oar functions, so that the engine can run
+    locally, without any Grid5000 reservation: jobs are never
+    submitted to a real oar, they simply start ``start_delay`` seconds
+    after their submission, with the number of fake nodes they request
+    ("nodes=N" in their resources), or ``nodes_per_job``. If given a
+    planning (see `fake_oar.load_planning`), it is considered as the
+    background load of the clusters: jobs start at the earliest date
+    where the planning has enough free nodes for them and for the
+    other fake jobs of their cluster.
+
+    It also counts the calls to each oar function (in
+    ``fake_oar.calls``), to measure the load the engine would put on
+    the oar frontends.
+
+    Usage::
+
+      engine = my_engine()
+      engine.oar = fake_oar(start_delay = 2)
+      engine.start()
+    """
+
+    def __init__(self, start_delay = 5, nodes_per_job = None, submission_failure_rate = 0.0,
+                 planning = None):
+        """
+        :param start_delay: delay in seconds between a job submission
+          and its start. May be a callable taking the
+          ``execo_g5k.oar.OarSubmission`` and returning the delay.
+
+        :param nodes_per_job: number of nodes given to each job. If
+          None, the number of nodes requested by the job, or 1.
+
+        :param submission_failure_rate: probability (between 0 and 1)
+          for a job submission to fail.
+
+        :param planning: planning of the clusters. If given,
+          start_delay is ignored for the clusters of the planning.
+        """
+        self.start_delay = start_delay
+        self.nodes_per_job = nodes_per_job
+        self.submission_failure_rate = submission_failure_rate
+        self.planning = planning
+        self.calls = {"oarsub": 0, "oardel": 0, "get_oar_jobs_info": 0,
+                      "get_planning": 0}
+        self._jobs = {}
+        self._next_jobid = 1
+        self._lock = Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def oarsub(self, job_specs, frontend_connection_params = None, timeout = False, abort_on_error = False):
+        self._count("oarsub")
+        jobs = []
+        with self._lock:
+            for (submission, site) in job_specs:
+                if random.random() < self.submission_failure_rate:
+                    jobs.append((None, site))
+                    continue
+                jobid = self._next_jobid
+                self._next_jobid += 1
+                walltime = 3600
+                if submission != None and submission.walltime != None:
+                    walltime = get_seconds(submission.walltime)
+                num_nodes = self.nodes_per_job
+                if num_nodes == None:
+                    mo = None
+                    if submission != None and submission.resources != None:
+                        mo = re.search("nodes=(\\d+)", submission.resources)
+                    num_nodes = int(mo.group(1)) if mo else 1
+                cluster = None
+                if submission != None and submission.resources != None:
+                    mo = re.search("cluster='(\\w+)'", submission.resources)
+                    cluster = mo.group(1) if mo else None
+                cluster_planning = (self.planning or {}).get(site, {}).get(cluster)
+                if cluster_planning:
+                    now = time.time()
+                    cluster_jobs = [ (job["start_date"], job["start_date"] + job["walltime"], job["num_nodes"])
+                                     for job in self._jobs.values()
+                                     if job["cluster"] == cluster and not job["deleted"] ]
+                    start_date = _planning_earliest_start(cluster_planning, num_nodes, walltime, now, cluster_jobs)
+                    if start_date == None:
+                        start_date = now + 3600 * 24 * 365
+                elif callable(self.start_delay):
+                    start_date = time.time() + self.start_delay(submission)
+                else:
+                    start_date = time.time() + self.start_delay
+                self._jobs[jobid] = {"site": site,
+                                     "cluster": cluster,
+                                     "num_nodes": num_nodes,
+                                     "start_date": start_date,
+                                     "walltime": walltime,
+                                     "deleted": False}
+                jobs.append((jobid, site))
+        return jobs
+
+    def oardel(self, job_specs, frontend_connection_params = None, timeout = False):
+        self._count("oardel")
+        with self._lock:
+            for (jobid, site) in job_specs:
+                if jobid in self._jobs:
+                    self._jobs[jobid]["deleted"] = True
+
+    def _nodes(self, oar_job_id):
+        return [ Host("fake-%i-%i.%s.grid5000.fr" % (oar_job_id, i, self._jobs[oar_job_id]["site"]))
+                 for i in range(0, self._jobs[oar_job_id]["num_nodes"]) ]
+
+    def get_oar_jobs_info(self, oar_job_ids, frontend = None,
+                          frontend_connection_params = None, timeout = False):
+        self._count("get_oar_jobs_info")
+        now = time.time()
+        jobs_info = {}
+        for jobid in oar_job_ids:
+            job = self._jobs.get(jobid)
+            if not job:
+                continue
+            if job["deleted"]:
+                jobs_info[jobid] = {"state": "Error"}
+            elif now >= job["start_date"]:
+                jobs_info[jobid] = {"state": "Running",
+                                    "start_date": job["start_date"],
+                                    "walltime": job["walltime"],
+                                    "nodes": self._nodes(jobid)}
+            else:
+                jobs_info[jobid] = {"state": "Waiting",
+                                    "scheduled_start": job["start_date"]}
+        return jobs_info
+
+    def get_planning(self, elements = ['grid5000'], vlan = False, subnet = False, storage = False,
+                     out_of_chart = False, starttime = None, endtime = None,
+                     ignore_besteffort = True, queues = 'default'):
+        self._count("get_planning")
+        planning = {}
+        for (site, site_planning) in (self.planning or {}).items():
+            for (cluster, cluster_planning) in site_planning.items():
+                if cluster in elements or site in elements or 'grid5000' in elements:
+                    planning.setdefault(site, {})[cluster] = copy.deepcopy(cluster_planning)
+        return planning
@@ -1,30 +1,1066 @@
-from execo import Timer, sleep, format_date
-from execo_g5k import oarsub, oardel, get_cluster_site, wait_oar_job_start, get_oar_job_nodes
+from execo import Host, sleep, format_date
+from execo.time_utils import get_seconds
+from execo.config import make_connection_params
+from execo.exception import ProcessesFailed
+from execo.process import get_process
+from execo_g5k.config import g5k_configuration, default_frontend_connection_params
+from execo_g5k.oar import get_oarsub_commandline, oar_date_to_unixts, oar_duration_to_seconds
+from execo_g5k.planning import get_planning
+from execo_g5k.utils import get_frontend_host
 from execo_engine import Engine, logger
-from threading import Thread, Lock, current_thread
-import functools
+from threading import Thread, Lock, Event, local
+import functools, itertools, re, time, copy, os, sys, json, logging, bisect
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'lib'))
+from g5k_api_cache import get_cluster_site
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+try:
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    asyncio = None
+
+_current_worker = local()
+
+_log_levels = {}
+
+def _log_level(name):
+    # numeric level of an execo_engine.logger method name
+    if name not in _log_levels:
+        level = logging.getLevelName(name.upper())
+        _log_levels[name] = level if isinstance(level, int) else logging.ERROR
+    return _log_levels[name]
 
 class _WorkerLogger(object):
-    def __getattribute__(self, name):
-        th = current_thread()
-        prefix = "worker #%i %s@%s - job %s: %%s" % (
-            th.worker_index,
-            th.cluster,
-            th.site,
-            th.jobid)
-        return functools.partial(logger.__getattribute__(name), prefix)
+    def __getattr__(self, name):
+        # each logging method is built once, then cached
+        def log_method(message, *args, **kwargs):
+            _current_worker.worker.log(name, message, _current_worker.worker_index, *args, **kwargs)
+        setattr(self, name, log_method)
+        return log_method
 
 worker_log = _WorkerLogger()
-"""execo_engine.logger proxy for logging from a worker thread.
+"""execo_engine.logger proxy for logging from a worker.
 
 To be called as a logger, for example worker_log.debug(...). Prefixes
 the log message with information about the worker (worker number,
-cluster, site, oar job id). Limitation: takes a single string as
-argument, contrary to logger instances, whose log message can contain
-a string and an arbitrary number of args / kwargs to be formatted in
-the string.
+cluster, site, oar job id). As with logger instances, the log message
+can contain a string and an arbitrary number of args / kwargs to be
+formatted in the string, which is only done if the message is
+actually logged.
 """
 
+_OARSUB_SEPARATOR = "-- g5k_cluster_engine oarsub --"
+_OARSTAT_JOB_SEPARATOR = "-- g5k_cluster_engine job %i --"
+_OARSTAT_JOB_SEPARATOR_RE = re.compile("^-- g5k_cluster_engine job (\\d+) --\\s*$", re.MULTILINE)
+_OARSTAT_NODES_SEPARATOR = "-- g5k_cluster_engine nodes --"
+
+def _oarsubmission_num_nodes(oarsubmission):
+    # number of nodes requested by an oar submission, or None if it
+    # does not explicitely request a number of nodes
+    if oarsubmission == None or oarsubmission.resources == None:
+        return None
+    mo = re.search("nodes=(\\d+)", oarsubmission.resources)
+    if mo:
+        return int(mo.group(1))
+    return None
+
+def _oarsubmission_pack_key(oarsubmission):
+    # what must be identical in the submissions of payloads packed in
+    # the same job: everything but the number of nodes and the
+    # walltime
+    if oarsubmission == None:
+        return None
+    key = dict(vars(oarsubmission))
+    del key["walltime"]
+    if key["resources"] != None:
+        key["resources"] = re.sub("nodes=\\d+", "nodes=", key["resources"])
+    return key
+
+def _oarsubmission_walltime(oarsubmission):
+    # oar default walltime is one hour
+    if oarsubmission == None or oarsubmission.walltime == None:
+        return 3600
+    return get_seconds(oarsubmission.walltime)
+
+class _FreeHosts(object):
+
+    """Number of hosts of a cluster planning free for a walltime, at any date.
+
+    Built once from a cluster planning, as returned by
+    execo_g5k.planning.get_planning: each free interval of a host is
+    turned into the range of dates at which a job of walltime can
+    start in it, so that counting the free hosts at a date is a
+    bisection instead of a scan of the whole planning.
+    """
+
+    def __init__(self, cluster_planning, walltime):
+        ranges = [ (start, stop - walltime)
+                   for host_planning in cluster_planning.values()
+                   for (start, stop) in host_planning['free']
+                   if stop - walltime >= start ]
+        self.walltime = walltime
+        self._starts = sorted([ start for (start, _) in ranges ])
+        self._ends = sorted([ end for (_, end) in ranges ])
+
+    def count(self, date):
+        """Returns the number of hosts free from date for the walltime."""
+        # the free intervals of a host are disjoint: at most one range
+        # per host contains date
+        return bisect.bisect_right(self._starts, date) - bisect.bisect_left(self._ends, date)
+
+    def earliest_start(self, num_nodes, now, jobs = ()):
+        """Returns the earliest date from now at which num_nodes hosts are free for the walltime, or None.
+
+        jobs: list of tuples (start, stop, num_nodes) of jobs not in
+        the planning.
+        """
+        candidates = set(self._starts[bisect.bisect_right(self._starts, now):])
+        candidates.add(now)
+        candidates.update([ stop for (_, stop, _) in jobs if stop > now ])
+        for date in sorted(candidates):
+            num_busy = sum([ job_nodes for (start, stop, job_nodes) in jobs
+                             if start < date + self.walltime and stop > date ])
+            if self.count(date) - num_busy >= num_nodes:
+                return date
+        return None
+
+def _planning_earliest_start(cluster_planning, num_nodes, walltime, now, jobs = ()):
+    # earliest date, in a cluster planning as returned by
+    # execo_g5k.planning.get_planning, at which num_nodes hosts are
+    # free for walltime, or None if there is none in the planning.
+    # jobs: list of tuples (start, stop, num_nodes) of jobs not in the
+    # planning
+    return _FreeHosts(cluster_planning, walltime).earliest_start(num_nodes, now, jobs)
+
+def _parse_oar_job_info(stdout):
+    # same parsing as execo_g5k.oar.get_oar_job_info
+    job_info = dict()
+    start_date_result = re.search("^\s*startTime = (\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)\s*$", stdout, re.MULTILINE)
+    if start_date_result:
+        job_info['start_date'] = oar_date_to_unixts(start_date_result.group(1))
+    walltime_result = re.search("^\s*walltime = (\d+:\d?\d:\d?\d)\s*$", stdout, re.MULTILINE)
+    if walltime_result:
+        job_info['walltime'] = oar_duration_to_seconds(walltime_result.group(1))
+    scheduled_start_result = re.search("^\s*scheduledStart = (\d\d\d\d-\d\d-\d\d \d\d:\d\d:\d\d)\s*$", stdout, re.MULTILINE)
+    if scheduled_start_result:
+        job_info['scheduled_start'] = oar_date_to_unixts(scheduled_start_result.group(1))
+    state_result = re.search("^\s*state = (\w*)\s*$", stdout, re.MULTILINE)
+    if state_result:
+        job_info['state'] = state_result.group(1)
+    return job_info
+
+class real_clock(object):
+
+    """Default clock of `g5k_cluster_engine.g5k_cluster_engine`: real time.
+
+    All the dates, timers, and blocking waits of the engine go through
+    its clock, which can be replaced (before
+    `execo_engine.engine.Engine.start`) by another one, such as
+    `oar_simulator.virtual_clock`, to run the engine in simulated time.
+    A clock provides the current date, sleeps, and creates the events
+    and queues on which the engine threads wait, and starts these
+    threads.
+    """
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, delay):
+        sleep(delay)
+
+    def event(self):
+        return Event()
+
+    def queue(self):
+        return Queue()
+
+    def start_thread(self, thread):
+        thread.start()
+
+class g5k_oar(object):
+
+    """Default oar backend of `g5k_cluster_engine.g5k_cluster_engine`: the real execo_g5k oar functions.
+
+    Contrary to their execo_g5k counterparts, `g5k_oar.oarsub` and
+    `g5k_oar.oardel` group the jobs per site: the jobs of a site are
+    submitted (by batches of at most `g5k_oar.oarsub_batch_size`), or
+    deleted, through a single frontend connection.
+    `g5k_oar.get_oar_jobs_info` has no execo_g5k counterpart: it
+    retrieves the infos of several jobs of a site at once.
+    `g5k_oar.get_planning` is only used by the planning policy (option
+    -g).
+
+    Waiting jobs are polled by `_SitePoller` through
+    `g5k_oar.get_oar_jobs_info`, so no per-job wait or nodes retrieval
+    is needed.
+
+    Any other backend (for example `fake_oar.fake_oar`) must provide
+    the same methods (``oarsub``, ``oardel``, ``get_oar_jobs_info``,
+    ``get_planning``), with the same signatures and semantics.
+    """
+
+    get_planning = staticmethod(get_planning)
+
+    oarsub_batch_size = 20
+    """Maximum number of jobs submitted through a single frontend connection."""
+
+    def _frontend_process(self, cmd, site, frontend_connection_params, timeout):
+        if isinstance(timeout, bool) and timeout == False:
+            timeout = g5k_configuration.get('default_timeout')
+        p = get_process(cmd,
+                        host = get_frontend_host(site),
+                        connection_params = make_connection_params(frontend_connection_params,
+                                                                   default_frontend_connection_params))
+        p.timeout = timeout
+        p.shell = p.pty = True
+        return p
+
+    def _sites_indexes(self, job_specs, batch_size = None):
+        # indexes of the job specs of each site, in batches of at most
+        # batch_size job specs
+        sites_indexes = {}
+        for (index, (_, site)) in enumerate(job_specs):
+            sites_indexes.setdefault(site, []).append(index)
+        batches = []
+        for (site, indexes) in sites_indexes.items():
+            step = batch_size or len(indexes)
+            batches.extend([ (site, indexes[i:i + step]) for i in range(0, len(indexes), step) ])
+        return batches
+
+    def oarsub(self, job_specs, frontend_connection_params = None, timeout = False, abort_on_error = False):
+        """Submits jobs, in batches of at most ``oarsub_batch_size`` jobs per frontend connection.
+
+        The timeout (``default_timeout`` if not given) applies to each
+        submission: the timeout of a batch is scaled by its number of
+        submissions. Each failed submission is logged. If a batch
+        timed out, its submissions whose job id was not retrieved may
+        nevertheless have been done.
+        """
+        if isinstance(timeout, bool) and timeout == False:
+            timeout = g5k_configuration.get('default_timeout')
+        jobs = [ (None, site) for (_, site) in job_specs ]
+        processes = []
+        for (site, indexes) in self._sites_indexes(job_specs, self.oarsub_batch_size):
+            p = self._frontend_process(
+                " ; ".join([ "%s ; echo '%s'" % (get_oarsub_commandline(job_specs[index][0]), _OARSUB_SEPARATOR)
+                             for index in indexes ]),
+                site, frontend_connection_params,
+                timeout * len(indexes) if timeout != None else None)
+            p.indexes = indexes
+            processes.append(p)
+        for p in processes: p.start()
+        for p in processes: p.wait()
+        failed_processes = []
+        for p in processes:
+            outputs = p.stdout.split(_OARSUB_SEPARATOR)
+            for (i, index) in enumerate(p.indexes):
+                output = outputs[i] if i < len(outputs) else ""
+                mo = re.search("^OAR_JOB_ID=(\d+)\s*$", output, re.MULTILINE)
+                if mo:
+                    jobs[index] = (int(mo.group(1)), jobs[index][1])
+                else:
+                    logger.warning("oarsub of job %i/%i on %s failed%s: %s" % (
+                            i + 1, len(p.indexes), jobs[index][1],
+                            " (timeout, the job may have been submitted)" if p.timeouted else "",
+                            output.strip() or p.stderr.strip() or "no output"))
+            if None in [ jobs[index][0] for index in p.indexes ]:
+                failed_processes.append(p)
+        if len(failed_processes) > 0 and abort_on_error:
+            raise ProcessesFailed(failed_processes)
+        return jobs
+
+    def oardel(self, job_specs, frontend_connection_params = None, timeout = False):
+        processes = []
+        for (site, indexes) in self._sites_indexes(job_specs):
+            p = self._frontend_process(
+                "oardel " + " ".join([ "%i" % (job_specs[index][0],) for index in indexes ]),
+                site, frontend_connection_params, timeout)
+            p.nolog_exit_code = True
+            processes.append(p)
+        for p in processes: p.start()
+        for p in processes: p.wait()
+
+    def get_oar_jobs_info(self, oar_job_ids, frontend = None,
+                          frontend_connection_params = None, timeout = False):
+        """Return a dict whose keys are oar job ids and values are dicts of infos about these jobs.
+
+        All jobs must be on the same frontend, and their infos are
+        retrieved through a single frontend connection. Infos are the
+        same as those returned by ``execo_g5k.oar.get_oar_job_info``,
+        plus, for running jobs, ``nodes``: the list of
+        ``execo.host.Host`` of the job. Jobs for which no info could be
+        retrieved are missing from the returned dict.
+        """
+        p = self._frontend_process(
+            " ; ".join([ "echo '%(separator)s' ; oarstat -fj %(jobid)i ; "
+                         "if oarstat -sj %(jobid)i | grep -q Running ; then "
+                         "echo '%(nodes_separator)s' ; oarstat -pj %(jobid)i | oarprint network_address -f - | sort ; fi" % {
+                             'separator': _OARSTAT_JOB_SEPARATOR % (jobid,),
+                             'nodes_separator': _OARSTAT_NODES_SEPARATOR,
+                             'jobid': jobid }
+                         for jobid in oar_job_ids ]),
+            frontend, frontend_connection_params, timeout)
+        p.nolog_exit_code = p.nolog_timeout = p.nolog_error = True
+        p.run()
+        jobs_info = {}
+        chunks = _OARSTAT_JOB_SEPARATOR_RE.split(p.stdout)
+        for (jobid, output) in zip(chunks[1::2], chunks[2::2]):
+            (info_output, _, nodes_output) = output.partition(_OARSTAT_NODES_SEPARATOR)
+            job_info = _parse_oar_job_info(info_output)
+            if nodes_output:
+                job_info['nodes'] = [ Host(address) for address in re.findall("(\\S+)", nodes_output) ]
+            if len(job_info) > 0:
+                jobs_info[int(jobid)] = job_info
+        return jobs_info
+
+class _JobWatch(object):
+
+    """Start notification of an oar job, updated by a `_SitePoller`.
+
+    Callbacks are called from the poller thread, so they must not
+    block.
+    """
+
+    def __init__(self, jobid, prediction_callback = None, start_callback = None):
+        """
+        :param prediction_callback: function taking a unix timestamp
+          as parameter, called each time the job start prediction
+          changes.
+
+        :param start_callback: function taking the job infos (as
+          returned by `g5k_oar.get_oar_jobs_info`) as parameter,
+          called when the job has started, or failed to start. In this
+          case, the infos contain no ``nodes``.
+        """
+        self.jobid = jobid
+        self.prediction = None
+        self.prediction_callback = prediction_callback
+        self.start_callback = start_callback
+
+    def update(self, prediction, done = False, info = None):
+        if prediction != None and prediction != self.prediction:
+            self.prediction = prediction
+            if self.prediction_callback:
+                self.prediction_callback(prediction)
+        if done and self.start_callback:
+            self.start_callback(info)
+
+class _SitePoller(Thread):
+
+    """Single poller of the states of all jobs waiting to start on a site.
+
+    Instead of each worker polling its own job, a single thread per
+    site retrieves the infos of all pending jobs of the site at once
+    (`g5k_oar.get_oar_jobs_info`), and notifies their `_JobWatch`, so
+    that the polling load does not grow with the number of waiting
+    jobs. Polling periods are the same as those of
+    ``execo_g5k.oar.wait_oar_job_start``.
+    """
+
+    def __init__(self, oar, site, clock):
+        super(_SitePoller, self).__init__()
+        self.daemon = True
+        self.oar = oar
+        self.site = site
+        self.clock = clock
+        self._watches = {}
+        self._lock = Lock()
+        self._wakeup = clock.event()
+        self._stopped = False
+
+    def watch(self, jobid, prediction_callback = None, start_callback = None):
+        """Watch a job until its start. See `_JobWatch` for the callbacks."""
+        watch = _JobWatch(jobid, prediction_callback, start_callback)
+        with self._lock:
+            self._watches[jobid] = watch
+        self._wakeup.set()
+
+    def _poll(self):
+        with self._lock:
+            watches = dict(self._watches)
+        if len(watches) == 0:
+            return None
+        try:
+            jobs_info = self.oar.get_oar_jobs_info(list(watches.keys()), self.site)
+        except Exception as e:
+            logger.warning("unable to get state of oar jobs on %s: %s" % (self.site, e))
+            jobs_info = {}
+        now = self.clock.time()
+        delay = g5k_configuration.get('polling_interval')
+        for (jobid, watch) in watches.items():
+            info = jobs_info.get(jobid, {})
+            prediction = info.get('start_date', info.get('scheduled_start'))
+            if info.get('state') in [ 'Terminated', 'Error' ] or (
+                info.get('state') == 'Running' and info.get('nodes')):
+                with self._lock:
+                    del self._watches[jobid]
+                watch.update(prediction, True, info)
+                continue
+            watch.update(prediction)
+            if prediction != None:
+                if now >= prediction:
+                    delay = min(delay, g5k_configuration.get('tiny_polling_interval'))
+                else:
+                    delay = min(delay, prediction - now)
+        return delay
+
+    def run(self):
+        delay = None
+        while True:
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            delay = self._poll()
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+class _Worker(object):
+
+    """A worker: an oar job, and the get_job payloads run on its nodes.
+
+    Usually a single payload, run on all the job nodes. With node
+    packing, several payloads, each run on its own subset of the job
+    nodes.
+    """
+
+    def __init__(self, cluster, site, clock):
+        self.cluster = cluster
+        self.site = site
+        self.clock = clock
+        self.payloads = [] # list: tuples (worker_index, oarsubmission, data)
+        self.num_nodes = 0
+        self.oarsubmission = None
+        self.jobid = None
+        self.waiting = True
+        self.nodes = None
+        self.job_end = None
+        self.num_running = 0
+        self.events = {} # dict: keys = phases, values = timestamps
+        self.lock = Lock()
+
+    @property
+    def worker_index(self):
+        return self.payloads[0][0]
+
+    def can_pack(self, oarsubmission, num_nodes, max_nodes):
+        """Returns True if a payload can be packed in this worker's job.
+
+        Its submission must be the same as the submissions of the
+        worker's payloads, except for the number of nodes and the
+        walltime, and the job must not exceed max_nodes nodes.
+        """
+        return (self.num_nodes + num_nodes <= max_nodes
+                and _oarsubmission_pack_key(oarsubmission) == _oarsubmission_pack_key(self.payloads[0][1]))
+
+    def add_payload(self, worker_index, oarsubmission, data):
+        self.payloads.append((worker_index, oarsubmission, data))
+        self.num_nodes += _oarsubmission_num_nodes(oarsubmission) or 0
+        if len(self.payloads) == 1:
+            self.oarsubmission = oarsubmission
+        else:
+            # packed job: same submission as all payloads (see
+            # can_pack), but for all nodes and the longest walltime
+            self.oarsubmission = copy.copy(self.payloads[0][1])
+            self.oarsubmission.resources = re.sub("nodes=\\d+", "nodes=%i" % (self.num_nodes,),
+                                                  self.oarsubmission.resources)
+            self.oarsubmission.walltime = max([ _oarsubmission_walltime(payload[1])
+                                                for payload in self.payloads ])
+
+    def nodes_subsets(self):
+        """Returns the list of nodes of each payload.
+
+        If the job got less nodes than requested, the payloads for
+        which there are not enough nodes left get None, as for a
+        failed job.
+        """
+        if self.nodes == None or len(self.payloads) == 1:
+            return [ self.nodes ] * len(self.payloads)
+        subsets = []
+        offset = 0
+        for (worker_index, oarsubmission, _) in self.payloads:
+            num_nodes = _oarsubmission_num_nodes(oarsubmission)
+            if offset + num_nodes > len(self.nodes):
+                self.log("warning", "job got %i nodes instead of %i - not enough nodes left for payload",
+                         worker_index, len(self.nodes), self.num_nodes)
+                subsets.append(None)
+            else:
+                subsets.append(self.nodes[offset:offset + num_nodes])
+                offset += num_nodes
+        return subsets
+
+    def event(self, phase, date = None):
+        """Records the timestamp of a phase of the worker, now by default."""
+        self.events[phase] = date if date != None else self.clock.time()
+        return self.events[phase]
+
+    def log(self, name, message, worker_index = None, *args, **kwargs):
+        if not logger.isEnabledFor(_log_level(name)):
+            return
+        if worker_index == None:
+            worker_index = self.worker_index
+        if len(args) == 0:
+            (message, args) = ("%s", (message,))
+        getattr(logger, name)("worker #%i %s@%s - job %s: " + message,
+                              worker_index, self.cluster, self.site, self.jobid,
+                              *args, **kwargs)
+
+class thread_pool_backend(object):
+
+    """Execution backend running the workers on a bounded pool of reused threads.
+
+    A worker occupies a thread only while running client code
+    (`g5k_cluster_engine.g5k_cluster_engine.worker`): waiting for its
+    job start is a `_SitePoller` callback. Threads are created on
+    demand, up to ``size``, and then reused. If all threads are busy,
+    started workers wait for a free one, which the scheduler avoids by
+    not submitting more jobs than there are threads not running a
+    started worker.
+    """
+
+    def __init__(self, engine, size):
+        self.engine = engine
+        self.size = size
+        self._queue = engine.clock.queue()
+        self._lock = Lock()
+        self._num_threads = 0
+        self._num_idle = 0
+        self._num_pending = 0
+
+    def _thread_loop(self):
+        try:
+            while True:
+                func = self._queue.get()
+                with self._lock:
+                    self._num_pending -= 1
+                    self._num_idle -= 1
+                if func == None:
+                    return
+                func()
+                with self._lock:
+                    self._num_idle += 1
+        finally:
+            # also if func raised: the thread exits, and is replaced
+            # if functions are still pending
+            with self._lock:
+                self._num_threads -= 1
+                self._spawn()
+
+    def _spawn(self):
+        # starts a thread if there are more pending functions than idle
+        # threads. Called with the lock held
+        if self._num_pending > self._num_idle and self._num_threads < self.size:
+            th = Thread(target = self._thread_loop)
+            th.daemon = True
+            self._num_threads += 1
+            self._num_idle += 1
+            self.engine.clock.start_thread(th)
+
+    def _run(self, func):
+        with self._lock:
+            self._num_pending += 1
+            self._spawn()
+        self._queue.put(func)
+
+    def _job_started(self, worker, info):
+        self.engine._job_started(worker, info)
+        self._run(lambda: self.engine._run_worker(worker))
+
+    def start(self, worker):
+        """Handle a worker whose job has been submitted, until its exit."""
+        if not worker.jobid:
+            self._run(lambda: self.engine._run_worker(worker))
+        else:
+            self.engine._get_poller(worker.site).watch(
+                worker.jobid,
+                lambda ts: self.engine._job_prediction(worker, ts),
+                lambda info: self._job_started(worker, info))
+
+    def run(self, func):
+        """Run a function in the pool."""
+        self._run(func)
+
+    def stop(self):
+        with self._lock:
+            num_threads = self._num_threads
+            self.size = 0
+        for i in range(0, num_threads):
+            self._run(None)
+
+class asyncio_backend(object):
+
+    """Execution backend running the workers workflow on an asyncio event loop.
+
+    Each waiting worker costs an asyncio future, resolved by its
+    `_SitePoller`, instead of an OS thread. Client code
+    (`g5k_cluster_engine.g5k_cluster_engine.worker`), which is
+    blocking, is run in a bounded executor of ``size`` threads.
+    Requires asyncio (python 3).
+    """
+
+    def __init__(self, engine, size):
+        if not asyncio:
+            raise Exception("asyncio_backend requires asyncio and concurrent.futures")
+        self.engine = engine
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(ThreadPoolExecutor(size))
+        th = Thread(target = self._loop.run_forever)
+        th.daemon = True
+        th.start()
+
+    def _job_started(self, worker, info):
+        if worker.jobid:
+            self.engine._job_started(worker, info)
+        self._loop.run_in_executor(None, self.engine._run_worker, worker)
+
+    def _start(self, worker):
+        job_start = self._loop.create_future()
+        job_start.add_done_callback(lambda f: self._job_started(worker, f.result()))
+        if not worker.jobid:
+            job_start.set_result(None)
+        else:
+            self.engine._get_poller(worker.site).watch(
+                worker.jobid,
+                lambda ts: self.engine._job_prediction(worker, ts),
+                lambda info: self._loop.call_soon_threadsafe(job_start.set_result, info))
+
+    def start(self, worker):
+        """Handle a worker whose job has been submitted, until its exit."""
+        self._loop.call_soon_threadsafe(self._start, worker)
+
+    def run(self, func):
+        """Run a function in the executor."""
+        self._loop.call_soon_threadsafe(self._loop.run_in_executor, None, func)
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+def _read_records(filename):
+    # reads the pickled records of an append-only file, and truncates
+    # the file after the last valid record
+    records = []
+    if os.path.exists(filename):
+        with open(filename, "rb") as f:
+            while True:
+                offset = f.tell()
+                try:
+                    records.append(pickle.load(f))
+                except Exception:
+                    break
+        with open(filename, "ab") as f:
+            f.truncate(offset)
+    return records
+
+class _JobJournal(object):
+
+    """Append-only on-disk journal of the workers' jobs and payloads.
+
+    Each record is a pickled dict with keys ``state``, ``jobid``,
+    ``site``, ``cluster``, and for payload records, ``worker_index``,
+    ``oarsubmission``, ``data``. States are:
+
+    - ``submitted``: a payload has been submitted in a job.
+
+    - ``payload``: a payload is run in an already submitted job
+      (reservation reuse).
+
+    - ``done``: a payload has finished.
+
+    - ``deleted``: a job has been released.
+
+    Records are flushed and synced to disk as soon as written, so that
+    after a crash, the journal tells which jobs may still be running,
+    and which payloads they were running. A truncated last record
+    (crash while writing) is discarded.
+
+    If the data of a payload cannot be pickled, the payload is
+    recorded without its data, and cannot be resumed after a crash.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = Lock()
+        self._records = _read_records(filename)
+        self._file = open(filename, "ab")
+
+    def record(self, state, worker, worker_index = None, oarsubmission = None, data = None, jobid = None):
+        """Appends a record. jobid: the job id, if not the worker's one."""
+        record = { "state": state, "jobid": jobid if jobid != None else worker.jobid,
+                   "site": worker.site, "cluster": worker.cluster }
+        if worker_index != None:
+            record.update({ "worker_index": worker_index,
+                            "oarsubmission": oarsubmission,
+                            "data": data })
+        try:
+            pickled = pickle.dumps(record, 2)
+        except Exception as e:
+            worker.log("warning", "unable to journal payload data, the payload will not be recoverable: %s",
+                       worker_index, e)
+            del record["data"]
+            pickled = pickle.dumps(record, 2)
+        with self._lock:
+            self._file.write(pickled)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def max_worker_index(self):
+        """Returns the highest worker index in the journal, or -1."""
+        return max([ -1 ] + [ r["worker_index"] for r in self._records if "worker_index" in r ])
+
+    def unfinished_jobs(self):
+        """Returns the list of jobs not deleted.
+
+        Each job is a dict with keys ``jobid``, ``site``, ``cluster``,
+        ``payloads``: list of tuples (worker_index, oarsubmission,
+        data) of its unfinished payloads, ``num_lost``: number of its
+        unfinished payloads recorded without their data. The list of
+        payloads of a job is empty if all its payloads have finished,
+        but the job was not deleted (crash before its deletion).
+        """
+        jobs = {}
+        for r in self._records:
+            key = (r["jobid"], r["site"])
+            if r["state"] in [ "submitted", "payload" ]:
+                job = jobs.setdefault(key, { "jobid": r["jobid"], "site": r["site"],
+                                             "cluster": r["cluster"], "payloads": {} })
+                job["payloads"][r["worker_index"]] = (
+                    (r["worker_index"], r["oarsubmission"], r["data"]) if "data" in r else None)
+            elif r["state"] == "done" and key in jobs:
+                jobs[key]["payloads"].pop(r["worker_index"], None)
+            elif r["state"] == "deleted":
+                jobs.pop(key, None)
+        unfinished = []
+        for job in jobs.values():
+            payloads = list(job["payloads"].values())
+            job["num_lost"] = payloads.count(None)
+            job["payloads"] = sorted([ payload for payload in payloads if payload != None ],
+                                     key = lambda payload: payload[0])
+            unfinished.append(job)
+        return unfinished
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class _RuntimeHistory(object):
+
+    """History of the durations of the payloads, per cluster and features.
+
+    Durations are appended, as pickled tuples (cluster, features,
+    duration), to a file, so that the history is kept between runs of
+    the engine. Only the last max_samples durations of each cluster
+    and features are used.
+    """
+
+    max_samples = 100
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = Lock()
+        self._durations = {} # dict: keys = cluster, or (cluster, features), values = list of durations
+        for (cluster, features, duration) in _read_records(filename):
+            self._add(cluster, features, duration)
+        self._file = open(filename, "ab")
+
+    def _add(self, cluster, features, duration):
+        for key in [ cluster ] + ([ (cluster, features) ] if features != None else []):
+            durations = self._durations.setdefault(key, [])
+            durations.append(duration)
+            del durations[:-self.max_samples]
+
+    def add(self, cluster, features, duration):
+        pickled = pickle.dumps((cluster, features, duration), 2)
+        with self._lock:
+            self._add(cluster, features, duration)
+            self._file.write(pickled)
+            self._file.flush()
+
+    def predict(self, cluster, features, quantile):
+        """Returns the quantile of the durations of the payloads with the same features on the cluster.
+
+        If there is none, of all payloads on the cluster. None if
+        there is no history for this cluster.
+        """
+        with self._lock:
+            durations = self._durations.get((cluster, features)) or self._durations.get(cluster)
+            if not durations:
+                return None
+            durations = sorted(durations)
+        return durations[min(int(quantile * len(durations)), len(durations) - 1)]
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class _PlanningPolicy(object):
+
+    """Gantt aware submission policy.
+
+    Keeps a snapshot of the planning of the involved clusters,
+    retrieved with ``get_planning`` of the oar backend, and refreshed
+    every refresh_delay seconds. From this snapshot, it predicts the
+    start date of the next job of each cluster, taking into account
+    the jobs submitted since the snapshot. The free hosts of each
+    cluster (see `_FreeHosts`) are computed once per snapshot and
+    walltime.
+    """
+
+    def __init__(self, oar, refresh_delay, max_start_delay, clock):
+        self.oar = oar
+        self.clock = clock
+        self.refresh_delay = refresh_delay
+        self.max_start_delay = max_start_delay
+        self._planning = None
+        self._planning_date = None
+        self._clusters = set()
+        self._sites = {}
+        self._submitted = {}
+        self._walltimes = {}
+        self._free_hosts = {} # dict: keys = (cluster, walltime), values = _FreeHosts, or None if not in the planning
+
+    def refresh(self, clusters_sites):
+        clusters = set([ cluster for (cluster, _) in clusters_sites ])
+        self._sites.update(clusters_sites)
+        if (self._planning != None and clusters <= self._clusters
+            and self.clock.time() - self._planning_date < self.refresh_delay):
+            return
+        self._planning_date = self.clock.time()
+        self._clusters = clusters
+        self._submitted = {}
+        self._free_hosts = {}
+        try:
+            self._planning = self.oar.get_planning(elements = sorted(clusters))
+            logger.detail("planning of %s refreshed" % (", ".join(sorted(clusters)),))
+        except Exception as e:
+            logger.warning("unable to retrieve the planning of %s: %s" % (", ".join(sorted(clusters)), e))
+            if self._planning == None:
+                self._planning = {}
+
+    def _get_free_hosts(self, cluster, site, walltime):
+        key = (cluster, walltime)
+        if key not in self._free_hosts:
+            cluster_planning = self._planning.get(site, {}).get(cluster)
+            self._free_hosts[key] = _FreeHosts(cluster_planning, walltime) if cluster_planning else None
+        return self._free_hosts[key]
+
+    def submitted(self, cluster, oarsubmission):
+        """Tells the policy that a job has been submitted on a cluster."""
+        num_nodes = _oarsubmission_num_nodes(oarsubmission) or 1
+        walltime = _oarsubmission_walltime(oarsubmission)
+        free_hosts = self._get_free_hosts(cluster, self._sites.get(cluster), walltime)
+        start = self.clock.time()
+        if free_hosts != None:
+            start = free_hosts.earliest_start(num_nodes, start, self._submitted.get(cluster, []))
+        if start != None:
+            self._submitted.setdefault(cluster, []).append((start, start + walltime, num_nodes))
+        self._walltimes[cluster] = walltime
+
+    def predicted_start(self, cluster, site):
+        """Returns the predicted start date of the next job of a cluster.
+
+        Returns the current date if the cluster is not in the
+        planning, and None if the planning has no slot for the job.
+        """
+        now = self.clock.time()
+        free_hosts = self._get_free_hosts(cluster, site, self._walltimes.get(cluster, 3600))
+        if free_hosts == None:
+            return now
+        return free_hosts.earliest_start(1, now, self._submitted.get(cluster, []))
+
+    def order(self, clusters_sites):
+        """Returns the list of tuples (cluster, site, late), sorted by predicted start.
+
+        late is True if the predicted start is more than
+        max_start_delay seconds away.
+        """
+        now = self.clock.time()
+        predicted = []
+        for (cluster, site) in clusters_sites:
+            start = self.predicted_start(cluster, site)
+            late = start == None or start - now > self.max_start_delay
+            predicted.append((float("inf") if start == None else start, cluster, site, late))
+            logger.trace("predicted start on cluster %s@%s: %s" % (
+                    cluster, site, "none" if start == None else format_date(start)))
+        return [ (cluster, site, late) for (_, cluster, site, late) in sorted(predicted) ]
+
+class _PhaseMetrics(object):
+
+    """Durations of the phases of the workers, per cluster.
+
+    Phases are:
+
+    - ``queue_wait``: from the job submission to the job start (the
+      oar start date).
+
+    - ``nodes_retrieval``: from the job start to the retrieval of its
+      nodes by the engine.
+
+    - ``prediction_error``: job start minus its first start
+      prediction.
+
+    - ``work``: run time of the client code of a payload.
+
+    - ``release``: from the end of the last payload of a job to the
+      job deletion.
+    """
+
+    quantiles = [ 0.5, 0.9, 0.99 ]
+
+    def __init__(self):
+        self._durations = {} # dict: keys = (cluster, phase), values = list of durations
+        self._lock = Lock()
+        self.version = 0
+
+    def add(self, cluster, phase, duration):
+        with self._lock:
+            self._durations.setdefault((cluster, phase), []).append(duration)
+            self.version += 1
+
+    def summary(self):
+        """Returns a dict: keys = clusters, values = dict: keys = phases, values = dict of statistics."""
+        with self._lock:
+            durations = [ (key, sorted(values)) for (key, values) in self._durations.items() ]
+        summary = {}
+        for ((cluster, phase), values) in durations:
+            stats = { "count": len(values),
+                      "sum": sum(values),
+                      "mean": sum(values) / len(values),
+                      "max": values[-1] }
+            for q in self.quantiles:
+                stats["p%g" % (q * 100,)] = values[min(int(q * len(values)), len(values) - 1)]
+            summary.setdefault(cluster, {})[phase] = stats
+        return summary
+
+    def write(self, filename):
+        """Writes the summary, as json, to a file (atomically)."""
+        with open(filename + ".tmp", "w") as f:
+            json.dump(self.summary(), f, indent = 2, sort_keys = True)
+        os.rename(filename + ".tmp", filename)
+
+    def prometheus(self):
+        """Returns the summary in the prometheus text exposition format."""
+        lines = [ "# HELP g5k_cluster_engine_phase_seconds duration of the phases of the workers",
+                  "# TYPE g5k_cluster_engine_phase_seconds summary" ]
+        for (cluster, phases) in sorted(self.summary().items()):
+            for (phase, stats) in sorted(phases.items()):
+                labels = 'cluster="%s",phase="%s"' % (cluster, phase)
+                for q in self.quantiles:
+                    lines.append('g5k_cluster_engine_phase_seconds{%s,quantile="%g"} %f' % (
+                            labels, q, stats["p%g" % (q * 100,)]))
+                lines.append("g5k_cluster_engine_phase_seconds_sum{%s} %f" % (labels, stats["sum"]))
+                lines.append("g5k_cluster_engine_phase_seconds_count{%s} %i" % (labels, stats["count"]))
+        return "\n".join(lines) + "\n"
+
+def _metrics_server(metrics, port):
+    # http server serving the phase metrics in the prometheus text
+    # format, in a daemon thread
+    class handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args):
+            logger.trace("metrics server: " + format, *args)
+    server = HTTPServer(("", port), handler)
+    th = Thread(target = server.serve_forever)
+    th.daemon = True
+    th.start()
+    return server
+
+class _SchedulerState(object):
+
+    """Scheduler view of the alive workers, indexed by (cluster, site).
+
+    Instead of rescanning all worker threads at each scheduling pass,
+    the number of alive and waiting workers of each (cluster, site) is
+    updated by the workers themselves on each state change, so that a
+    scheduling pass costs O(clusters) instead of O(workers).
+    """
+
+    def __init__(self, on_change = None):
+        self._lock = Lock()
+        self._workers = {} # dict: keys = (cluster, site), values =
+                           # set: alive workers
+        self._num_waiting = {} # dict: keys = (cluster, site), values =
+                               # int: number of waiting workers
+        self._on_change = on_change
+
+    def _changed(self):
+        if self._on_change:
+            self._on_change()
+
+    def add(self, worker):
+        """Register a new worker, waiting for its job start."""
+        key = (worker.cluster, worker.site)
+        worker.waiting = True
+        with self._lock:
+            self._workers.setdefault(key, set()).add(worker)
+            self._num_waiting[key] = self._num_waiting.get(key, 0) + 1
+
+    def started(self, worker):
+        """Notify that a worker's job has started."""
+        with self._lock:
+            if worker.waiting:
+                worker.waiting = False
+                self._num_waiting[(worker.cluster, worker.site)] -= 1
+        self._changed()
+
+    def remove(self, worker):
+        """Notify that a worker has exited."""
+        key = (worker.cluster, worker.site)
+        with self._lock:
+            if worker in self._workers.get(key, ()):
+                self._workers[key].discard(worker)
+                if worker.waiting:
+                    worker.waiting = False
+                    self._num_waiting[key] -= 1
+                if len(self._workers[key]) == 0:
+                    del self._workers[key]
+                    del self._num_waiting[key]
+        self._changed()
+
+    def counts(self, cluster, site):
+        """Returns a tuple (number of alive workers, number of waiting workers) of a cluster."""
+        with self._lock:
+            return (len(self._workers.get((cluster, site), ())),
+                    self._num_waiting.get((cluster, site), 0))
+
+    def num_started(self):
+        """Returns the number of alive workers whose job has started, on all clusters."""
+        with self._lock:
+            return (sum([ len(workers) for workers in self._workers.values() ])
+                    - sum(self._num_waiting.values()))
+
+    def clusters(self):
+        """Returns the set of (cluster, site) having alive workers."""
+        with self._lock:
+            return set(self._workers.keys())
+
+    def workers(self):
+        """Returns a list of all alive workers."""
+        with self._lock:
+            return [ worker for workers in self._workers.values() for worker in workers ]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._workers)
+
 class g5k_cluster_engine(Engine):
 
     """execo engine automatizing the workflow of submitting jobs in parallel to Grid5000 clusters.
@@ -45,8 +1081,86 @@ class g5k_cluster_engine(Engine):
     `g5k_cluster_engine.g5k_cluster_engine.get_job`, which are called
     for the scheduling, and implement the client main "business" code
     inside `g5k_cluster_engine.g5k_cluster_engine.worker`
+
+    By default, the clusters are polled every schedule_delay. In
+    event driven mode (option -e), the scheduler is also woken up as
+    soon as a worker job starts, a worker exits or a job submission
+    fails, so that a finished worker is immediately replaced. The
+    schedule_delay is then only a fallback period.
+
+    Waiting jobs are not polled by their workers, but by a single
+    poller per site, which retrieves the state of all the site's
+    pending jobs at once. Workers are then run by an execution backend
+    (option -b): a bounded pool of reused threads (`thread_pool_backend`,
+    the default), or an asyncio event loop (`asyncio_backend`), in
+    which a waiting worker costs no thread at all.
+
+    With reservation reuse (option -u), a worker whose client code
+    has finished does not release its job immediately: it asks for the
+    next payload of its cluster whose submission is compatible with its
+    job, and whose expected duration fits in its nodes and remaining
+    walltime (see
+    `g5k_cluster_engine.g5k_cluster_engine.job_fits`),
+    and runs it on the same nodes, thus saving a whole queue wait. The
+    job is deleted once no compatible payload is left.
+
+    With node packing (option -k N), payloads requesting less than N
+    nodes, and whose submissions differ only by their number of nodes
+    and walltime, are packed in jobs of at most N nodes: each job is
+    split in disjoint subsets of nodes, on which the client code of
+    each payload is run concurrently. If the job gets less nodes than
+    requested, the payloads left without nodes are passed to
+    `g5k_cluster_engine.g5k_cluster_engine.worker` with nodes = None,
+    as for a failed job. The job is deleted when all its payloads
+    have finished.
+
+    With the planning policy (option -g), the engine reads, each
+    scheduling pass, a cached snapshot of the clusters' planning (see
+    `execo_g5k.planning.get_planning`), refreshed every -G seconds.
+    Clusters are then scheduled by order of predicted start of their
+    next job, so that payloads go first where they can start soonest,
+    and no job is submitted on a cluster if the predicted start of
+    its next job is more than -w seconds away, as long as another
+    cluster can start a job sooner. If all clusters are that late,
+    each one is kept with at most one waiting job.
+
+    The durations of the phases of the workers (see `_PhaseMetrics`)
+    are aggregated per cluster, and their percentiles written to file
+    ``phase_metrics.json`` in the result directory. With option -P,
+    they are also served in the prometheus text format on the given
+    port.
+
+    The durations of the payloads' client code are kept in a runtime
+    history (file ``runtime_history`` in the result directory, or
+    given with option -H to share it between experiments), from which
+    `g5k_cluster_engine.g5k_cluster_engine.predict_duration` predicts
+    the duration of a payload. `g5k_cluster_engine.g5k_cluster_engine.get_job`
+    can use it to request tight walltimes, which oar backfills more
+    easily, or to return the longest payloads first.
+
+    Jobs and payloads are recorded in a journal (file ``jobs_journal``
+    in the result directory). When the engine is restarted in the same
+    result directory (option -c), it re-attaches to the jobs of the
+    journal which are still waiting or running, and resumes their
+    workers, instead of resubmitting everything. Payloads whose job
+    has ended (error, walltime reached) are passed to
+    `g5k_cluster_engine.g5k_cluster_engine.worker` with nodes = None,
+    as any failed job, and the job is deleted. If the state of some
+    jobs cannot be retrieved, the engine aborts instead of deleting
+    jobs which may still be running.
+
+    All oar calls go through `g5k_cluster_engine.g5k_cluster_engine.oar`,
+    which can be replaced (before `execo_engine.engine.Engine.start`)
+    by another backend, such as `fake_oar.fake_oar`, to run the
+    engine locally. Likewise, all dates and timers go through
+    `g5k_cluster_engine.g5k_cluster_engine.clock`, which can be
+    replaced by a virtual clock, such as `oar_simulator.virtual_clock`,
+    to run the engine in simulated time.
     """
 
+    recover_attempts = 3
+    """Number of attempts to retrieve the state of the jobs of the journal, when recovering."""
+
     def __init__(self):
         super(g5k_cluster_engine, self).__init__()
         self.args_parser.add_argument(
@@ -58,126 +1172,396 @@ class g5k_cluster_engine(Engine):
         self.args_parser.add_argument(
             "-s", dest = "schedule_delay", type = int, default = 10,
             help = "delay between rescheduling worker jobs")
+        self.args_parser.add_argument(
+            "-e", dest = "event_driven", action = "store_true", default = False,
+            help = "reschedule as soon as a worker job starts, a worker exits or a job submission fails. schedule_delay is then only a fallback period")
+        self.args_parser.add_argument(
+            "-b", dest = "execution_backend", choices = [ "pool", "asyncio" ], default = "pool",
+            help = "execution backend of the workers. Default = %(default)s")
+        self.args_parser.add_argument(
+            "-p", dest = "pool_size", type = int, default = 64,
+            help = "maximum number of threads running workers. No job is submitted while as many workers have their job started. Default = %(default)s")
+        self.args_parser.add_argument(
+            "-u", dest = "reuse", action = "store_true", default = False,
+            help = "reuse the jobs of finished workers for the next compatible payloads of the same cluster")
+        self.args_parser.add_argument(
+            "-m", dest = "reuse_margin", type = int, default = 60,
+            help = "when reusing jobs, margin in seconds kept between the end of a payload's walltime and the end of the job. Default = %(default)s")
+        self.args_parser.add_argument(
+            "-k", dest = "pack_nodes", type = int, default = 0,
+            help = "pack payloads requesting less nodes in jobs of up to this number of nodes. Default = %(default)s (no packing)")
+        self.args_parser.add_argument(
+            "-g", dest = "planning", action = "store_true", default = False,
+            help = "schedule clusters according to the predicted start of their jobs in the clusters' planning")
+        self.args_parser.add_argument(
+            "-G", dest = "planning_refresh", type = int, default = 300,
+            help = "with the planning policy, delay in seconds between planning refreshes. Default = %(default)s")
+        self.args_parser.add_argument(
+            "-w", dest = "max_start_delay", type = int, default = 3600,
+            help = "with the planning policy, do not top up the waiting jobs of clusters whose next job would start in more than this number of seconds. Default = %(default)s")
+        self.args_parser.add_argument(
+            "-P", dest = "metrics_port", type = int, default = None,
+            help = "serve the phase metrics in the prometheus text format on this port")
+        self.args_parser.add_argument(
+            "-H", dest = "runtime_history", default = None,
+            help = "file of the runtime history of the payloads, may be shared between experiments. Default: runtime_history in the result directory")
+        self.oar = g5k_oar()
+        """oar backend used for all oar job submissions, job states polling, planning retrievals and deletions."""
+        self.clock = real_clock()
+        """clock used for all dates, timers and waits of the engine."""
+        self._reschedule = None
+        self._state = _SchedulerState(self._wake_scheduler)
+        self._clusters_sites = {}
+        self._pollers = {}
+        self._pollers_lock = Lock()
+        self._pending = {} # dict: keys = clusters, values = list: (oarsubmission, data) got from get_job, not yet run
+        self._get_job_lock = Lock()
+        self._worker_indexes = itertools.count()
+        self._planning = None
+        self._metrics = _PhaseMetrics()
+        self._history = None
+
+    def _wake_scheduler(self):
+        self._reschedule.set()
+
+    def _get_poller(self, site):
+        with self._pollers_lock:
+            if site not in self._pollers:
+                self._pollers[site] = _SitePoller(self.oar, site, self.clock)
+                self.clock.start_thread(self._pollers[site])
+            return self._pollers[site]
+
+    def _get_clusters_to_submit(self):
+        clusters_to_submit = set()
+        for clusterspec in self.get_clusters():
+            if clusterspec not in self._clusters_sites:
+                cluster, _, site = clusterspec.partition(".")
+                if site == "":
+                    site = get_cluster_site(cluster)
+                self._clusters_sites[clusterspec] = (cluster, site)
+            clusters_to_submit.add(self._clusters_sites[clusterspec])
+        return clusters_to_submit
+
+    def _get_job(self, cluster, nodes = None, job_end = None, job_oarsubmission = None):
+        # get_job is only called under a lock, as it may be called
+        # from workers reusing their job, and from the scheduler. When
+        # called for reusing a job (nodes given, with the job's end and
+        # submission), only returns a payload fitting in the job; a
+        # non fitting payload got from get_job is kept for the
+        # scheduler.
+        with self._get_job_lock:
+            pending = self._pending.setdefault(cluster, [])
+            for (i, (oarsubmission, data)) in enumerate(pending):
+                if not nodes or self.job_fits(cluster, oarsubmission, data, nodes,
+                                              job_end - self.clock.time() - self.args.reuse_margin,
+                                              job_oarsubmission):
+                    del pending[i]
+                    return (oarsubmission, data)
+            if nodes and len(pending) > 0:
+                return None
+            jobdata = self.get_job(cluster)
+            if (jobdata and nodes
+                and not self.job_fits(cluster, jobdata[0], jobdata[1], nodes,
+                                      job_end - self.clock.time() - self.args.reuse_margin,
+                                      job_oarsubmission)):
+                pending.append(jobdata)
+                return None
+            return jobdata
+
+    def _unget_job(self, cluster, jobdata):
+        with self._get_job_lock:
+            self._pending.setdefault(cluster, []).insert(0, jobdata)
+
+    def _new_workers(self, cluster, site, num_max_new_workers):
+        # without packing, one worker per payload. With packing,
+        # payloads are packed first fit in the workers' jobs
+        workers = []
+        while True:
+            if (len(workers) >= num_max_new_workers
+                and len([ w for w in workers if w.num_nodes < self.args.pack_nodes ]) == 0):
+                break
+            jobdata = self._get_job(cluster)
+            if not jobdata:
+                break
+            (oarsubmission, data) = jobdata
+            num_nodes = _oarsubmission_num_nodes(oarsubmission)
+            packable = num_nodes != None and num_nodes > 0 and num_nodes < self.args.pack_nodes
+            w = None
+            if packable:
+                for candidate in workers:
+                    if candidate.can_pack(oarsubmission, num_nodes, self.args.pack_nodes):
+                        w = candidate
+                        break
+            if not w:
+                if len(workers) >= num_max_new_workers:
+                    self._unget_job(cluster, jobdata)
+                    break
+                w = _Worker(cluster, site, self.clock)
+                workers.append(w)
+            w.add_payload(next(self._worker_indexes), oarsubmission, data)
+            if not packable:
+                # a worker with a non packable payload is full
+                w.num_nodes = max(w.num_nodes, self.args.pack_nodes)
+        for w in workers:
+            logger.detail(
+                "spawning worker %i on %s@%s (%i payloads)" % (
+                    w.worker_index, cluster, site, len(w.payloads)))
+            self._state.add(w)
+        return workers
+
+    def _submit(self, workers):
+        # all jobs picked during a scheduling pass are submitted at
+        # once, the oar backend grouping them per site
+        for site in set([ w.site for w in workers ]):
+            logger.detail("submit %i oar jobs on %s" % (
+                    len([ w for w in workers if w.site == site ]), site))
+        jobs = self.oar.oarsub([ (w.oarsubmission, w.site) for w in workers ])
+        for (w, (jobid, _)) in zip(workers, jobs):
+            w.jobid = jobid
+            if jobid:
+                w.event("submit")
+                for payload in w.payloads:
+                    self._journal.record("submitted", w, *payload)
+                if self._planning:
+                    self._planning.submitted(w.cluster, w.oarsubmission)
+                w.log("detail", "job submitted - wait job start")
+            self._executor.start(w)
+
+    def _recover(self):
+        # re-attach to the jobs of a previous run of the engine which
+        # are still alive, fail the payloads of dead jobs, and delete
+        # the jobs without unfinished payloads. Only jobs known to have
+        # ended are considered dead: if the state of a job with
+        # unfinished payloads cannot be retrieved, the recovery is
+        # aborted rather than deleting a job which may still be running
+        jobs = self._journal.unfinished_jobs()
+        if len(jobs) == 0:
+            return
+        logger.info("recovering %i jobs from journal %s" % (len(jobs), self._journal.filename))
+        self._worker_indexes = itertools.count(self._journal.max_worker_index() + 1)
+        jobs_to_check = [ job for job in jobs if len(job["payloads"]) > 0 ]
+        jobs_info = {}
+        for attempt in range(0, self.recover_attempts):
+            if attempt > 0:
+                self.clock.sleep(g5k_configuration.get('polling_interval'))
+            for site in set([ job["site"] for job in jobs_to_check ]):
+                missing = [ job["jobid"] for job in jobs_to_check
+                            if job["site"] == site and (job["jobid"], site) not in jobs_info ]
+                if len(missing) > 0:
+                    for (jobid, info) in self.oar.get_oar_jobs_info(missing, site).items():
+                        jobs_info[(jobid, site)] = info
+            missing = [ "%i@%s" % (job["jobid"], job["site"]) for job in jobs_to_check
+                        if (job["jobid"], job["site"]) not in jobs_info ]
+            if len(missing) == 0:
+                break
+            logger.warning("unable to get the state of jobs %s (attempt %i/%i)" % (
+                    ", ".join(missing), attempt + 1, self.recover_attempts))
+        else:
+            raise Exception("unable to get the state of jobs %s of journal %s, abort recovery" % (
+                    ", ".join(missing), self._journal.filename))
+        dead_jobs = []
+        for job in jobs:
+            w = _Worker(job["cluster"], job["site"], self.clock)
+            for payload in job["payloads"]:
+                w.add_payload(*payload)
+            w.jobid = job["jobid"]
+            info = jobs_info.get((job["jobid"], job["site"]), {})
+            if job["num_lost"] > 0:
+                logger.warning("job %i@%s: %i payloads journaled without their data are lost" % (
+                        w.jobid, w.site, job["num_lost"]))
+            if len(w.payloads) == 0 or (
+                info.get("state") in [ "Terminated", "Error" ]
+                or ("start_date" in info and "walltime" in info
+                    and info["start_date"] + info["walltime"] <= self.clock.time())):
+                if len(w.payloads) > 0:
+                    w.log("detail", "job ended during engine restart - %i payloads lost" % (len(w.payloads),))
+                else:
+                    logger.detail("job %i@%s: all payloads done, delete job" % (w.jobid, w.site))
+                dead_jobs.append((w, w.jobid))
+                w.jobid = None
+            else:
+                w.log("detail", "re-attach to job - %i payloads" % (len(w.payloads),))
+            if len(w.payloads) > 0:
+                self._state.add(w)
+                self._executor.start(w)
+        if len(dead_jobs) > 0:
+            self.oar.oardel([ (jobid, w.site) for (w, jobid) in dead_jobs ])
+            for (w, jobid) in dead_jobs:
+                self._journal.record("deleted", w, jobid = jobid)
 
     def run(self):
-        num_total_workers = 0
-        sites_clusters_threads = {} # dict: keys = sites, values =
-                                    # dict: keys = clusters, values =
-                                    # list: threads
+        self._reschedule = self.clock.event()
+        if self.args.execution_backend == "asyncio":
+            self._executor = asyncio_backend(self, self.args.pool_size)
+        else:
+            self._executor = thread_pool_backend(self, self.args.pool_size)
+        self._journal = _JobJournal(os.path.join(self.result_dir, "jobs_journal"))
+        if self.args.planning:
+            self._planning = _PlanningPolicy(self.oar, self.args.planning_refresh, self.args.max_start_delay,
+                                             self.clock)
+        self._history = _RuntimeHistory(self.args.runtime_history
+                                        or os.path.join(self.result_dir, "runtime_history"))
+        metrics_filename = os.path.join(self.result_dir, "phase_metrics.json")
+        metrics_version = self._metrics.version
+        metrics_server = None
+        if self.args.metrics_port != None:
+            metrics_server = _metrics_server(self._metrics, self.args.metrics_port)
         try:
+            self._recover()
             while True:
-                t = Timer()
-                clusters_to_submit = set()
-                for clusterspec in self.get_clusters():
-                    cluster, _, site = clusterspec.partition(".")
-                    if site == "":
-                        site = get_cluster_site(cluster)
-                    clusters_to_submit.add((cluster, site))
-                for site in sites_clusters_threads.keys():
-                    for cluster in sites_clusters_threads[site].keys():
-                        sites_clusters_threads[site][cluster] = [
-                            th
-                            for th in sites_clusters_threads[site][cluster]
-                            if th.is_alive() ]
-                        if len(sites_clusters_threads[site][cluster]) == 0:
-                            del sites_clusters_threads[site][cluster]
-                    if len(sites_clusters_threads[site]) == 0:
-                        del sites_clusters_threads[site]
-                all_involved_sites = set(sites_clusters_threads.keys())
-                all_involved_sites.update([ s for (c, s) in clusters_to_submit ])
-                no_submissions = True
-                for site in all_involved_sites:
-                    all_involved_clusters = set()
-                    if sites_clusters_threads.has_key(site):
-                        all_involved_clusters.update(sites_clusters_threads[site].keys())
-                    all_involved_clusters.update([ c for (c, s) in clusters_to_submit if s == site ])
-                    for cluster in all_involved_clusters:
-                        num_workers = 0
-                        num_waiting = 0
-                        if sites_clusters_threads.has_key(site) and sites_clusters_threads[site].has_key(cluster):
-                            num_workers = len(sites_clusters_threads[site][cluster])
-                            num_waiting = len([
-                                    th
-                                    for th in sites_clusters_threads[site][cluster]
-                                    if th.waiting ])
-                        num_max_new_workers = min(self.args.max_workers - num_workers,
-                                                  self.args.max_waiting - num_waiting)
-                        logger.trace(
-                            "rescheduling on cluster %s@%s: num_workers = %s / num_waiting = %s / num_max_new_workers = %s" %
-                            (cluster, site, num_workers, num_waiting, num_max_new_workers))
-                        if num_max_new_workers > 0:
-                            for worker_index in range(0, num_max_new_workers):
-                                jobdata = self.get_job(cluster)
-                                if not jobdata:
-                                    break
-                                no_submissions = False
-                                logger.detail(
-                                    "spawning worker %i on %s@%s" % (
-                                        num_total_workers,
-                                        cluster, site))
-                                (oarsubmission, data) = jobdata
-                                th = Thread(target = self.worker_start,
-                                            args = (cluster, site,
-                                                    oarsubmission, data,
-                                                    num_total_workers,))
-                                th.waiting = True
-                                th.daemon = True
-                                th.oarsublock = Lock()
-                                th.willterminate = False
-                                th.start()
-                                num_total_workers += 1
-                                if not sites_clusters_threads.has_key(site):
-                                    sites_clusters_threads[site] = {}
-                                if not sites_clusters_threads[site].has_key(cluster):
-                                    sites_clusters_threads[site][cluster] = []
-                                sites_clusters_threads[site][cluster].append(th)
-                if no_submissions and len(sites_clusters_threads) == 0:
+                self._reschedule.clear()
+                all_involved_clusters = self._get_clusters_to_submit()
+                all_involved_clusters.update(self._state.clusters())
+                if self._planning:
+                    self._planning.refresh(all_involved_clusters)
+                    clusters_order = self._planning.order(all_involved_clusters)
+                else:
+                    clusters_order = [ (cluster, site, False) for (cluster, site) in all_involved_clusters ]
+                all_late = len([ late for (_, _, late) in clusters_order if not late ]) == 0
+                # a started job without a free thread of the execution
+                # backend would hold its nodes doing nothing
+                free_threads = self.args.pool_size - self._state.num_started()
+                new_workers = []
+                for (cluster, site, late) in clusters_order:
+                    (num_workers, num_waiting) = self._state.counts(cluster, site)
+                    num_max_new_workers = min(self.args.max_workers - num_workers,
+                                              self.args.max_waiting - num_waiting,
+                                              free_threads - len(new_workers))
+                    if late and all_late:
+                        # next job would start too late everywhere: at most one waiting job
+                        num_max_new_workers = min(num_max_new_workers, 1 - num_waiting)
+                    elif late:
+                        num_max_new_workers = 0
+                    logger.trace(
+                        "rescheduling on cluster %s@%s: num_workers = %s / num_waiting = %s / free_threads = %s / num_max_new_workers = %s",
+                        cluster, site, num_workers, num_waiting, free_threads - len(new_workers), num_max_new_workers)
+                    if num_max_new_workers > 0:
+                        new_workers.extend(self._new_workers(cluster, site, num_max_new_workers))
+                if len(new_workers) > 0:
+                    self._submit(new_workers)
+                elif len(self._state) == 0:
                     break
-                sleep(self.args.schedule_delay)
+                if self._metrics.version != metrics_version:
+                    metrics_version = self._metrics.version
+                    self._metrics.write(metrics_filename)
+                if self.args.event_driven:
+                    self._reschedule.wait(self.args.schedule_delay)
+                else:
+                    self.clock.sleep(self.args.schedule_delay)
             logger.detail("no more combinations to explore. exit schedule loop")
         finally:
-            for site in sites_clusters_threads.keys():
-                for cluster in sites_clusters_threads[site].keys():
-                    for th in sites_clusters_threads[site][cluster]:
-                        with th.oarsublock:
-                            th.willterminate = True
-                            if th.jobid:
-                                logger.detail("cleaning: delete job %i of worker #%i on %s" % (
-                                        th.jobid, th.worker_index, site))
-                                oardel([(th.jobid, site)])
-                                th.jobid = None
-
-    def worker_start(self, cluster, site, oarsubmission, data, worker_index):
-        th = current_thread()
-        th.cluster = cluster
-        th.site = site
-        th.worker_index = worker_index
-        th.jobid = None
+            jobs = []
+            for w in self._state.workers():
+                with w.lock:
+                    if w.jobid:
+                        logger.detail("cleaning: delete job %i of worker #%i on %s" % (
+                                w.jobid, w.worker_index, w.site))
+                        jobs.append((w, w.jobid))
+                        w.jobid = None
+            if len(jobs) > 0:
+                self.oar.oardel([ (jobid, w.site) for (w, jobid) in jobs ])
+                for (w, jobid) in jobs:
+                    self._journal.record("deleted", w, jobid = jobid)
+            self._executor.stop()
+            with self._pollers_lock:
+                for poller in self._pollers.values():
+                    poller.stop()
+                    poller.join()
+            self._journal.close()
+            self._history.close()
+            self._metrics.write(metrics_filename)
+            if metrics_server:
+                metrics_server.shutdown()
+
+    def _job_prediction(self, worker, ts):
+        if "prediction" not in worker.events:
+            worker.event("prediction", ts)
+        worker.log("detail", "job start prediction: %s", None, format_date(ts))
+
+    def _job_started(self, worker, info):
+        self._state.started(worker)
+        worker.nodes = info.get('nodes')
+        if worker.nodes == None:
+            worker.log("detail", "job failed to start")
+        else:
+            job_start = worker.event("job_start", info.get('start_date'))
+            nodes_retrieved = worker.event("nodes")
+            if "submit" in worker.events:
+                self._metrics.add(worker.cluster, "queue_wait", job_start - worker.events["submit"])
+            if "prediction" in worker.events:
+                self._metrics.add(worker.cluster, "prediction_error", job_start - worker.events["prediction"])
+            self._metrics.add(worker.cluster, "nodes_retrieval", nodes_retrieved - job_start)
+            worker.job_end = (job_start
+                              + info.get('walltime', _oarsubmission_walltime(worker.oarsubmission)))
+            worker.log("detail", "job started - got %i nodes", None, len(worker.nodes))
+
+    def _run_worker(self, worker):
+        # each payload is run on its subset of nodes, the first one in
+        # the current thread, the others through the executor
+        if not worker.jobid:
+            worker.log("detail", "job submission failed")
+        payloads_nodes = list(zip(worker.payloads, worker.nodes_subsets()))
+        worker.num_running = len(payloads_nodes)
+        for (payload, nodes) in payloads_nodes[1:]:
+            self._executor.run(functools.partial(self._run_payload, worker, payload, nodes))
+        self._run_payload(worker, *payloads_nodes[0])
+
+    def _run_payload(self, worker, payload, nodes):
+        (worker_index, oarsubmission, data) = payload
+        _current_worker.worker = worker
         try:
-            with th.oarsublock:
-                if th.willterminate:
-                    return
-                worker_log.detail("submit oar job")
-                ((th.jobid, _),) = oarsub([(oarsubmission, site)])
-            if not th.jobid:
-                worker_log.detail("job submission failed")
-                self.worker(cluster, site, data, None, worker_index, oarsubmission, None)
-            worker_log.detail("job submitted - wait job start")
-            wait_oar_job_start(th.jobid, site,
-                               prediction_callback = lambda ts:
-                                   worker_log.detail("job start prediction: %s" % (format_date(ts),)))
-            th.waiting = False
-            worker_log.detail("job started - get job nodes")
-            nodes = get_oar_job_nodes(th.jobid, site)
-            worker_log.detail("got %i nodes" % (len(nodes),))
-            self.worker(cluster, site, data, nodes, worker_index, oarsubmission, th.jobid)
+            while True:
+                _current_worker.worker_index = worker_index
+                begin = self.clock.time()
+                try:
+                    self.worker(worker.cluster, worker.site, data, nodes,
+                                worker_index, oarsubmission, worker.jobid)
+                except Exception:
+                    worker.log("exception", "exception in worker", worker_index)
+                else:
+                    if nodes:
+                        self._record_duration(worker, worker_index, data, self.clock.time() - begin)
+                if nodes:
+                    self._metrics.add(worker.cluster, "work", worker.event("end") - begin)
+                if worker.jobid:
+                    self._journal.record("done", worker, worker_index)
+                if not (self.args.reuse and worker.jobid and nodes):
+                    break
+                jobdata = self._get_job(worker.cluster, nodes, worker.job_end, worker.oarsubmission)
+                if not jobdata:
+                    break
+                (oarsubmission, data) = jobdata
+                worker_index = next(self._worker_indexes)
+                self._journal.record("payload", worker, worker_index, oarsubmission, data)
+                worker.log("detail", "reuse job for next payload", worker_index)
         finally:
-            with th.oarsublock:
-                if th.jobid:
-                    worker_log.detail("delete oar job")
-                    oardel([(th.jobid, site)])
-                    th.jobid = None
-            worker_log.detail("exit")
+            _current_worker.worker = None
+            _current_worker.worker_index = None
+            with worker.lock:
+                worker.num_running -= 1
+                last = worker.num_running == 0
+            if last:
+                self._release(worker)
+
+    def _record_duration(self, worker, worker_index, data, duration):
+        # a failure of the runtime history is not a failure of the
+        # payload
+        try:
+            self._history.add(worker.cluster, self.duration_features(worker.cluster, data), duration)
+        except Exception:
+            worker.log("exception", "unable to record the payload duration in the runtime history", worker_index)
+
+    def _release(self, worker):
+        with worker.lock:
+            if worker.jobid:
+                worker.log("detail", "delete oar job")
+                self.oar.oardel([(worker.jobid, worker.site)])
+                self._journal.record("deleted", worker)
+                worker.jobid = None
+                if "end" in worker.events:
+                    self._metrics.add(worker.cluster, "release", worker.event("delete") - worker.events["end"])
+        worker.log("detail", "exit")
+        self._state.remove(worker)
 
     def get_clusters(self):
         """Returns an iterable of cluster names where it is planned to schedule jobs.
@@ -217,9 +1601,110 @@ class g5k_cluster_engine(Engine):
         called several times at each scheduling iteration, ie. each
         schedule_delay).
 
+        With reservation reuse (option -u), it is also called by
+        workers whose client code has finished, but never
+        concurrently.
+
         to be overriden in client code inheriting from this class"""
         return None
 
+    def predict_duration(self, cluster, data, quantile = 0.9):
+        """Returns the predicted duration in seconds of the client code of a payload, or None.
+
+        The prediction is the given quantile of the durations of the
+        previous payloads with the same features (see
+        `g5k_cluster_engine.g5k_cluster_engine.duration_features`) on
+        this cluster, or, if there is none, of all previous payloads
+        on this cluster. None if no payload has been run on this
+        cluster yet.
+
+        Can be called from
+        `g5k_cluster_engine.g5k_cluster_engine.get_job`, for example::
+
+          duration = self.predict_duration(cluster, comb)
+          if duration:
+              walltime = int(duration * 1.5) + 300
+
+        :param cluster: name of the cluster.
+
+        :param data: the payload's opaque client data.
+
+        :param quantile: the quantile of the durations (between 0 and
+          1). Default 0.9: a duration exceeded by only 10% of the
+          previous payloads.
+        """
+        if not self._history:
+            return None
+        return self._history.predict(cluster, self.duration_features(cluster, data), quantile)
+
+    def duration_features(self, cluster, data):
+        """Returns the features of a payload for the runtime history.
+
+        Payloads with the same features on a cluster are expected to
+        last the same time. Must return a hashable and picklable value,
+        or None if the payload has no specific features.
+
+        Default implementation: for a dict (such as an
+        ``execo_engine.sweep`` combination), the tuple of its sorted
+        items. Otherwise, the data itself. None (no specific features)
+        if this is not hashable (e.g. list values), or if the dict
+        keys cannot be sorted (keys of different types in python 3).
+        May be overriden in client code, for example to ignore the
+        parameters which have no influence on the duration."""
+        try:
+            features = tuple(sorted(data.items())) if isinstance(data, dict) else data
+            hash(features)
+            return features
+        except TypeError:
+            return None
+
+    def job_fits(self, cluster, oarsubmission, data, nodes, remaining_walltime, job_oarsubmission):
+        """Returns True if a payload can be run in the job of a finished worker.
+
+        Only called with reservation reuse (option -u), to decide
+        whether a payload returned by
+        `g5k_cluster_engine.g5k_cluster_engine.get_job` can reuse the
+        job of a finished worker of the same cluster, instead of being
+        submitted in a new job.
+
+        :param cluster: name of the cluster.
+
+        :param oarsubmission: the payload's ``execo_g5k.oar.OarSubmission``.
+
+        :param data: the payload's opaque client data.
+
+        :param nodes: nodes of the worker's job.
+
+        :param remaining_walltime: remaining walltime of the worker's
+          job, in seconds (minus the reuse margin).
+
+        :param job_oarsubmission: the ``execo_g5k.oar.OarSubmission``
+          of the worker's job.
+
+        Default implementation: True if the submission is the same as
+        the job's one, except for the number of nodes and the walltime
+        (same job type, properties, reservation, etc., as for node
+        packing), if it explicitely requests at most as many nodes as
+        the job has ("nodes=N" in its resources), and if the payload's
+        expected duration fits in the remaining walltime. The expected duration is the duration
+        predicted from the runtime history (see
+        `g5k_cluster_engine.g5k_cluster_engine.predict_duration`),
+        which, as the payload of the job has just finished, is known
+        for its cluster. Payload walltimes are not compared, as the
+        job's walltime is itself the walltime of its first payload:
+        an identical payload would never fit. If there is no
+        prediction, the payload's walltime (one hour if not given) is
+        used. May be overriden in client code."""
+        if _oarsubmission_pack_key(oarsubmission) != _oarsubmission_pack_key(job_oarsubmission):
+            return False
+        num_nodes = _oarsubmission_num_nodes(oarsubmission)
+        if num_nodes == None or num_nodes > len(nodes):
+            return False
+        expected_duration = self.predict_duration(cluster, data)
+        if expected_duration == None:
+            expected_duration = _oarsubmission_walltime(oarsubmission)
+        return expected_duration <= remaining_walltime
+
     def worker(self, cluster, site, data, nodes, worker_index, oarsubmission, jobid):
         """Worker code which will be called for each job running.
 
@@ -238,8 +1723,8 @@ class g5k_cluster_engine(Engine):
         submission / wait / nodes list retrieval failed.
 
         :param worker_index: an index incremented for each worker
-          instanciated. This index is unique during one run of the
-          engine.
+          instanciated (and for each payload run in a reused job).
+          This index is unique during one run of the engine.
 
         :param oarsubmission: the ``execo_g5k.oar.OarSubmission``
           which was used to submit this worker's job.
@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+
+"""Discrete-event oar simulator, to benchmark g5k_cluster_engine policies offline.
+
+usage: oar_simulator.py [engine options] [engine options] ...
+
+Runs the same simulated workload (see `random_workload` and
+`random_background_load`) with each given set of engine options, for
+example::
+
+  oar_simulator.py "-s 60" "-s 600" "-s 60 -e" "-s 60 -e -g"
+
+and reports, for each, the makespan, node-hours, and idle node-hours
+of the simulated jobs.
+"""
+
+from execo import Host
+from execo_g5k import OarSubmission
+from g5k_cluster_engine import g5k_cluster_engine, _oarsubmission_num_nodes, _oarsubmission_walltime
+from threading import Lock, Condition
+import sys, random, re, json, os, tempfile, shutil, heapq, itertools, collections
+
+class _waiter(object):
+    # a thread blocked on a virtual_clock
+    def __init__(self):
+        self.woken = False
+
+class _virtual_event(object):
+
+    """threading.Event counterpart, for a `virtual_clock`."""
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._flag = False
+        self._waiters = []
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        with self._clock._cond:
+            self._flag = True
+            for waiter in self._waiters:
+                self._clock._wake(waiter)
+            self._waiters = []
+
+    def clear(self):
+        with self._clock._cond:
+            self._flag = False
+
+    def wait(self, timeout = None):
+        with self._clock._cond:
+            if not self._flag and (timeout == None or timeout > 0):
+                waiter = _waiter()
+                self._waiters.append(waiter)
+                self._clock._block(waiter, timeout)
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            return self._flag
+
+class _virtual_queue(object):
+
+    """Queue.Queue counterpart (put and get only), for a `virtual_clock`."""
+
+    def __init__(self, clock):
+        self._clock = clock
+        self._items = collections.deque()
+        self._waiters = collections.deque()
+
+    def put(self, item):
+        with self._clock._cond:
+            self._items.append(item)
+            if len(self._waiters) > 0:
+                self._clock._wake(self._waiters.popleft())
+
+    def get(self):
+        with self._clock._cond:
+            while len(self._items) == 0:
+                waiter = _waiter()
+                self._waiters.append(waiter)
+                self._clock._block(waiter)
+            return self._items.popleft()
+
+class virtual_clock(object):
+
+    """Event driven virtual clock, for `g5k_cluster_engine.g5k_cluster_engine.clock`.
+
+    The virtual time only advances when all the threads of the engine
+    are blocked on the clock (sleeping, or waiting on an event or a
+    queue created by the clock): it then jumps to the date of the
+    earliest timer. The engine thus runs as a discrete-event
+    simulation: its run time depends on its number of events, not on
+    the simulated durations, and all its delays (schedule delay,
+    polling periods, walltimes) and metrics are in virtual seconds.
+
+    The thread creating the clock is counted as running. The other
+    threads must be started with `virtual_clock.start_thread`, so the
+    clock only works with the thread pool execution backend of the
+    engine (option -b pool, the default).
+    """
+
+    def __init__(self, start = 0.0):
+        """:param start: initial virtual date."""
+        self._date = float(start)
+        self._cond = Condition()
+        self._running = 1
+        self._timers = [] # heap of (date, sequence number, waiter)
+        self._sequence = itertools.count()
+
+    def time(self):
+        with self._cond:
+            return self._date
+
+    def _wake(self, waiter):
+        # called with the condition held
+        if not waiter.woken:
+            waiter.woken = True
+            self._running += 1
+            self._cond.notify_all()
+
+    def _advance(self):
+        # called with the condition held: if no thread is running,
+        # jumps to the earliest timer and wakes its thread
+        while self._running == 0 and len(self._timers) > 0:
+            (date, _, waiter) = heapq.heappop(self._timers)
+            if not waiter.woken:
+                self._date = max(self._date, date)
+                self._wake(waiter)
+        self._cond.notify_all()
+
+    def _block(self, waiter, timeout = None):
+        # called with the condition held: blocks the calling thread
+        # until the waiter is woken, by another thread, or by the
+        # clock after timeout virtual seconds
+        if timeout != None:
+            heapq.heappush(self._timers, (self._date + timeout, next(self._sequence), waiter))
+        self._running -= 1
+        while not waiter.woken:
+            if self._running == 0:
+                self._advance()
+                if not waiter.woken and self._running == 0:
+                    raise Exception("virtual clock deadlock: all threads are blocked, without timer")
+            if not waiter.woken:
+                self._cond.wait()
+
+    def sleep(self, delay):
+        with self._cond:
+            if delay > 0:
+                self._block(_waiter(), delay)
+
+    def event(self):
+        return _virtual_event(self)
+
+    def queue(self):
+        return _virtual_queue(self)
+
+    def start_thread(self, thread):
+        run = thread.run
+        def counted_run():
+            try:
+                run()
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._advance()
+        thread.run = counted_run
+        with self._cond:
+            self._running += 1
+        thread.start()
+
+class oar_simulator(object):
+
+    """oar backend of `g5k_cluster_engine.g5k_cluster_engine` simulating oar queues.
+
+    Models clusters of a given number of nodes, on which jobs are
+    scheduled by oar with conservative backfilling: in submission
+    order, each job gets the earliest start date where enough nodes
+    are free for its whole walltime, without delaying previously
+    submitted jobs. Jobs come from the engine, and from a background
+    load trace: list of tuples (submission date, cluster, number of
+    nodes, duration), which simulates the other users of the
+    clusters.
+
+    All dates and durations (background load, walltimes, job start
+    dates, statistics) are virtual seconds of a `virtual_clock`, which
+    must also be the clock of the engine, and which starts at date 0.
+
+    Usage::
+
+      simulator = oar_simulator({"graphene": ("nancy", 144)})
+      engine = my_engine()
+      engine.oar = simulator
+      engine.clock = simulator.clock
+      engine.start()
+    """
+
+    def __init__(self, clusters, background_load = (), clock = None):
+        """
+        :param clusters: dict: keys = cluster names, values = tuples
+          (site, number of nodes).
+
+        :param background_load: iterable of tuples (submission date,
+          cluster, number of nodes, duration). Dates can be negative,
+          for jobs already in the queues when the simulation starts.
+
+        :param clock: the `virtual_clock`. By default, a new one.
+        """
+        self.clusters = clusters
+        self.clock = clock or virtual_clock()
+        self.calls = {"oarsub": 0, "oardel": 0, "get_oar_jobs_info": 0,
+                      "get_planning": 0}
+        self._jobs = {}
+        self._background = sorted(background_load, key = lambda job: job[0])
+        self._next_jobid = 1
+        self._lock = Lock()
+
+    def now(self):
+        """Returns the current virtual date."""
+        return self.clock.time()
+
+    def _new_job(self, date, cluster, num_nodes, walltime, duration, engine):
+        jobid = self._next_jobid
+        self._next_jobid += 1
+        self._jobs[jobid] = {"cluster": cluster,
+                             "num_nodes": num_nodes,
+                             "walltime": walltime,
+                             "submission": date,
+                             "start": None,
+                             "end": None,
+                             "hosts": None,
+                             "started": False,
+                             "deleted": False,
+                             "engine": engine}
+        if duration != None:
+            self._jobs[jobid]["duration"] = duration
+        return jobid
+
+    def _job_end(self, job):
+        # end date of a placed job, taking its deletion into account
+        if job["end"] != None:
+            return job["end"]
+        return job["start"] + job.get("duration", job["walltime"])
+
+    def _schedule(self, date):
+        # (re)places all waiting jobs, in submission order
+        for cluster in self.clusters:
+            intervals = {} # dict: keys = hosts, values = list of (start, end)
+            waiting = []
+            for (jobid, job) in sorted(self._jobs.items()):
+                if job["cluster"] != cluster or job["deleted"] and not job["started"]:
+                    continue
+                if job["started"]:
+                    if self._job_end(job) > date:
+                        for host in job["hosts"]:
+                            intervals.setdefault(host, []).append((job["start"], self._job_end(job)))
+                else:
+                    waiting.append(job)
+            num_hosts = self.clusters[cluster][1]
+            for job in waiting:
+                candidates = [ date ] + sorted(set([ end for host_intervals in intervals.values()
+                                                     for (_, end) in host_intervals if end > date ]))
+                for start in candidates:
+                    free = [ host for host in range(0, num_hosts)
+                             if len([ 1 for (s, e) in intervals.get(host, [])
+                                      if s < start + job["walltime"] and e > start ]) == 0 ]
+                    if len(free) >= job["num_nodes"]:
+                        job["start"] = start
+                        job["hosts"] = free[0:job["num_nodes"]]
+                        break
+                else:
+                    job["start"] = None
+                    job["hosts"] = None
+                    continue
+                for host in job["hosts"]:
+                    intervals.setdefault(host, []).append((job["start"], job["start"] + job["walltime"]))
+
+    def _advance(self):
+        # processes all events up to the current virtual date: starts
+        # of jobs, and submissions of background jobs
+        now = self.now()
+        while True:
+            if len(self._background) > 0 and self._background[0][0] <= now:
+                date = self._background[0][0]
+            else:
+                date = now
+            for job in self._jobs.values():
+                if not job["started"] and not job["deleted"] and job["start"] != None and job["start"] <= date:
+                    job["started"] = True
+            if date == now and (len(self._background) == 0 or self._background[0][0] > now):
+                return now
+            (submission, cluster, num_nodes, duration) = self._background.pop(0)
+            self._new_job(submission, cluster, num_nodes, duration, duration, False)
+            self._schedule(date)
+
+    def _count(self, name):
+        self.calls[name] += 1
+
+    def oarsub(self, job_specs, frontend_connection_params = None, timeout = False, abort_on_error = False):
+        with self._lock:
+            self._count("oarsub")
+            now = self._advance()
+            jobs = []
+            for (submission, site) in job_specs:
+                mo = None
+                if submission != None and submission.resources != None:
+                    mo = re.search("cluster='(\\w+)'", submission.resources)
+                if mo:
+                    cluster = mo.group(1)
+                else:
+                    cluster = sorted([ c for c in self.clusters if self.clusters[c][0] == site ] + [ None ])[-1]
+                num_nodes = _oarsubmission_num_nodes(submission) or 1
+                if cluster not in self.clusters or num_nodes > self.clusters[cluster][1]:
+                    jobs.append((None, site))
+                    continue
+                walltime = _oarsubmission_walltime(submission)
+                jobs.append((self._new_job(now, cluster, num_nodes, walltime, None, True), site))
+            self._schedule(now)
+            return jobs
+
+    def oardel(self, job_specs, frontend_connection_params = None, timeout = False):
+        with self._lock:
+            self._count("oardel")
+            now = self._advance()
+            for (jobid, site) in job_specs:
+                job = self._jobs.get(jobid)
+                if job and not job["deleted"]:
+                    job["deleted"] = True
+                    if job["started"] and self._job_end(job) > now:
+                        job["end"] = now
+            self._schedule(now)
+
+    def _info(self, jobid, now):
+        job = self._jobs[jobid]
+        if job["started"]:
+            if self._job_end(job) <= now:
+                return {"state": "Terminated"}
+            return {"state": "Running",
+                    "start_date": job["start"],
+                    "walltime": job["walltime"],
+                    "nodes": self._nodes(jobid)}
+        if job["deleted"]:
+            return {"state": "Error"}
+        info = {"state": "Waiting"}
+        if job["start"] != None:
+            info["scheduled_start"] = job["start"]
+        return info
+
+    def _nodes(self, jobid):
+        job = self._jobs[jobid]
+        return [ Host("%s-%i.%s.grid5000.fr" % (job["cluster"], host + 1, self.clusters[job["cluster"]][0]))
+                 for host in job["hosts"] ]
+
+    def get_oar_jobs_info(self, oar_job_ids, frontend = None,
+                          frontend_connection_params = None, timeout = False):
+        with self._lock:
+            self._count("get_oar_jobs_info")
+            now = self._advance()
+            return dict([ (jobid, self._info(jobid, now)) for jobid in oar_job_ids if jobid in self._jobs ])
+
+    def get_planning(self, elements = ['grid5000'], vlan = False, subnet = False, storage = False,
+                     out_of_chart = False, starttime = None, endtime = None,
+                     ignore_besteffort = True, queues = 'default'):
+        with self._lock:
+            self._count("get_planning")
+            now = self._advance()
+            horizon = now + 4 * 7 * 24 * 3600
+            planning = {}
+            for (cluster, (site, num_hosts)) in self.clusters.items():
+                if cluster not in elements and site not in elements and 'grid5000' not in elements:
+                    continue
+                busy = dict([ (host, []) for host in range(0, num_hosts) ])
+                for job in self._jobs.values():
+                    if (job["cluster"] == cluster and job["start"] != None
+                        and (job["started"] or not job["deleted"])
+                        and self._job_end(job) > now):
+                        for host in job["hosts"]:
+                            end = self._job_end(job) if job["started"] else job["start"] + job["walltime"]
+                            busy[host].append((max(job["start"], now), end))
+                cluster_planning = {}
+                for (host, host_busy) in busy.items():
+                    free = []
+                    date = now
+                    for (start, end) in sorted(host_busy):
+                        if start > date:
+                            free.append((date, start))
+                        date = max(date, end)
+                    if date < horizon:
+                        free.append((date, horizon))
+                    cluster_planning["%s-%i.%s.grid5000.fr" % (cluster, host + 1, site)] = {
+                        "busy": sorted(host_busy),
+                        "free": free }
+                planning.setdefault(site, {})[cluster] = cluster_planning
+            return planning
+
+    def statistics(self):
+        """Returns statistics of the engine jobs, in virtual seconds.
+
+        Returns a dict with keys ``first_submission``, ``last_end``,
+        ``node_seconds`` (sum of the nodes times the run time of each
+        job), ``num_jobs``, ``queue_wait`` (sum of the waiting times of
+        the jobs).
+        """
+        with self._lock:
+            now = self._advance()
+            jobs = [ job for job in self._jobs.values() if job["engine"] ]
+            started = [ job for job in jobs if job["started"] ]
+            return {"first_submission": min([ job["submission"] for job in jobs ] + [ now ]),
+                    "last_end": max([ min(self._job_end(job), now) for job in started ] + [ 0 ]),
+                    "node_seconds": sum([ job["num_nodes"] * (min(self._job_end(job), now) - job["start"])
+                                          for job in started ]),
+                    "num_jobs": len(jobs),
+                    "queue_wait": sum([ job["start"] - job["submission"] for job in started ])}
+
+def random_background_load(clusters, load, duration, mean_job_duration = 3600, max_job_nodes = 16, seed = 0):
+    """Returns a random background load trace for `oar_simulator`.
+
+    :param clusters: same as for `oar_simulator`.
+
+    :param load: target fraction of the nodes used by the background
+      jobs.
+
+    :param duration: duration in virtual seconds of the trace. The
+      trace starts one mean_job_duration before 0, so that the clusters
+      are already loaded at the start of the simulation.
+    """
+    rand = random.Random(seed)
+    trace = []
+    for (cluster, (site, num_hosts)) in sorted(clusters.items()):
+        mean_job_nodes = (1 + min(max_job_nodes, num_hosts)) / 2.0
+        rate = load * num_hosts / (mean_job_nodes * mean_job_duration)
+        date = -mean_job_duration
+        while date < duration:
+            date += rand.expovariate(rate)
+            trace.append((date, cluster, rand.randint(1, min(max_job_nodes, num_hosts)),
+                          rand.expovariate(1.0 / mean_job_duration)))
+    return trace
+
+def random_workload(clusters, num_payloads, mean_duration = 1800, max_nodes = 4, seed = 0):
+    """Returns a random workload for `simulation_engine`: dict: keys = clusters, values = list of (number of nodes, duration, walltime)."""
+    rand = random.Random(seed)
+    workload = {}
+    for cluster in sorted(clusters):
+        for i in range(0, num_payloads):
+            duration = rand.uniform(0.5, 1.5) * mean_duration
+            workload.setdefault(cluster, []).append((rand.randint(1, max_nodes), duration, duration * 1.5))
+    return workload
+
+class simulation_engine(g5k_cluster_engine):
+
+    """g5k_cluster_engine running a simulated workload on an `oar_simulator`.
+
+    Each payload of the workload requests a number of nodes on its
+    cluster for a walltime, and its client code just waits for its
+    duration. The engine runs on the simulator's `virtual_clock`. After
+    `simulation_engine.start`, `simulation_engine.report` gives the
+    makespan, node-hours and idle node-hours of the simulation, in
+    virtual time. The report is also written to file
+    ``simulation.json`` in the result directory.
+    """
+
+    def __init__(self, simulator, workload):
+        """
+        :param simulator: the `oar_simulator`.
+
+        :param workload: dict: keys = clusters, values = list of
+          tuples (number of nodes, duration, walltime), in virtual
+          seconds.
+        """
+        super(simulation_engine, self).__init__()
+        self.oar = simulator
+        self.clock = simulator.clock
+        self.workload = dict([ (cluster, list(payloads)) for (cluster, payloads) in workload.items() ])
+        self.report = None
+        self._work_node_seconds = 0
+        self._num_failed = 0
+        self._lock = Lock()
+
+    def get_clusters(self):
+        return [ "%s.%s" % (cluster, self.oar.clusters[cluster][0]) for cluster in self.workload ]
+
+    def get_job(self, cluster):
+        with self._lock:
+            if len(self.workload[cluster]) == 0:
+                return None
+            (num_nodes, duration, walltime) = self.workload[cluster].pop(0)
+        return (OarSubmission(resources = "{cluster='%s'}/nodes=%i" % (cluster, num_nodes),
+                              walltime = walltime),
+                (num_nodes, duration, walltime))
+
+    def worker(self, cluster, site, data, nodes, worker_index, oarsubmission, jobid):
+        (num_nodes, duration, walltime) = data
+        if not nodes:
+            with self._lock:
+                self._num_failed += 1
+            return
+        self.clock.sleep(duration)
+        with self._lock:
+            self._work_node_seconds += len(nodes) * duration
+
+    def start(self, engineargs = None):
+        super(simulation_engine, self).start(engineargs)
+        statistics = self.oar.statistics()
+        self.report = {"makespan_hours": (statistics["last_end"] - statistics["first_submission"]) / 3600,
+                       "node_hours": statistics["node_seconds"] / 3600,
+                       "idle_node_hours": (statistics["node_seconds"] - self._work_node_seconds) / 3600,
+                       "queue_wait_hours": statistics["queue_wait"] / 3600,
+                       "num_jobs": statistics["num_jobs"],
+                       "num_failed": self._num_failed}
+        with open(os.path.join(self.result_dir, "simulation.json"), "w") as f:
+            json.dump(self.report, f, indent = 2, sort_keys = True)
+
+if __name__ == "__main__":
+    clusters = {"fakecluster0": ("fakesite", 32), "fakecluster1": ("fakesite", 16)}
+    options = sys.argv[1:] or [ "-r 20 -t 2 -s 60", "-r 20 -t 2 -s 600", "-r 20 -t 2 -s 60 -e",
+                                "-r 20 -t 5 -s 60 -e", "-r 20 -t 2 -s 60 -e -g" ]
+    for engine_options in options:
+        result_dir = tempfile.mkdtemp(prefix = "oar_simulator_")
+        try:
+            engine = simulation_engine(
+                oar_simulator(clusters, random_background_load(clusters, 0.7, 24 * 3600)),
+                random_workload(clusters, 40))
+            engine.start([ "-c", result_dir, "-l", "WARNING" ] + engine_options.split())
+            print("%-24s makespan = %6.2fh  node-hours = %7.1f  idle node-hours = %6.1f  queue wait = %7.1fh" % (
+                    engine_options, engine.report["makespan_hours"], engine.report["node_hours"],
+                    engine.report["idle_node_hours"], engine.report["queue_wait_hours"]))
+        finally:
+            shutil.rmtree(result_dir)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+"""Checks of `oar_simulator` and of g5k_cluster_engine on its virtual clock.
+
+usage: python -m unittest test_oar_simulator
+"""
+
+import unittest, tempfile, shutil
+from oar_simulator import oar_simulator, simulation_engine
+
+class test_oar_simulator(unittest.TestCase):
+
+    # 8 payloads of one node, lasting 1000 virtual seconds, on a
+    # cluster of 4 nodes without background load: two waves of 4 jobs
+
+    def simulate(self, engine_options):
+        result_dir = tempfile.mkdtemp(prefix = "test_oar_simulator_")
+        try:
+            simulator = oar_simulator({"fakecluster": ("fakesite", 4)})
+            engine = simulation_engine(simulator, {"fakecluster": [ (1, 1000, 1500) ] * 8})
+            engine.start([ "-c", result_dir, "-l", "WARNING", "-r", "4", "-t", "4" ] + engine_options)
+            return engine.report
+        finally:
+            shutil.rmtree(result_dir)
+
+    def test_event_driven(self):
+        # the second wave is submitted as soon as the first one ends
+        report = self.simulate([ "-s", "30", "-e" ])
+        self.assertEqual(report["num_jobs"], 8)
+        self.assertEqual(report["num_failed"], 0)
+        self.assertAlmostEqual(report["makespan_hours"] * 3600, 2000)
+
+    def test_schedule_delay(self):
+        # the second wave is submitted at the first scheduling pass
+        # after the end of the first one, at 1020 virtual seconds
+        report = self.simulate([ "-s", "30" ])
+        self.assertEqual(report["num_jobs"], 8)
+        self.assertAlmostEqual(report["makespan_hours"] * 3600, 2020)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""Checks of the planning policy of g5k_cluster_engine on the recorded planning ``planning_fixture.json``.
+
+In the fixture, relative to its recording date, fakecluster0 is fully
+busy, its 4 hosts being freed between 15000 and 16800 seconds, and
+fakecluster1 is partly free: fakecluster1-1 always, fakecluster1-2
+until 7200 then from 9000, fakecluster1-3 from 1800, fakecluster1-4
+from 2700 to 10800 then from 18000.
+
+usage: python -m unittest test_planning_policy
+"""
+
+import unittest, os, json
+from execo_g5k import OarSubmission
+from g5k_cluster_engine import _PlanningPolicy, _planning_earliest_start
+from fake_oar import fake_oar
+
+class fixed_clock(object):
+
+    def __init__(self, date):
+        self.date = date
+
+    def time(self):
+        return self.date
+
+class test_planning_policy(unittest.TestCase):
+
+    clusters_sites = [ ("fakecluster0", "fakesite"), ("fakecluster1", "fakesite") ]
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "planning_fixture.json")) as f:
+            recorded = json.load(f)
+        self.date = recorded["date"]
+        self.planning = recorded["planning"]["fakesite"]
+        self.clock = fixed_clock(self.date)
+
+    def policy(self, max_start_delay):
+        policy = _PlanningPolicy(fake_oar(planning = { "fakesite": self.planning }), 300, max_start_delay, self.clock)
+        policy.refresh(self.clusters_sites)
+        return policy
+
+    def earliest_start(self, cluster, num_nodes, walltime, jobs = ()):
+        start = _planning_earliest_start(self.planning[cluster], num_nodes, walltime, self.date,
+                                         [ (self.date + start, self.date + stop, job_nodes)
+                                           for (start, stop, job_nodes) in jobs ])
+        return None if start == None else start - self.date
+
+    def test_earliest_start(self):
+        self.assertEqual(self.earliest_start("fakecluster0", 1, 3600), 15000)
+        self.assertEqual(self.earliest_start("fakecluster0", 4, 3600), 16800)
+        self.assertEqual(self.earliest_start("fakecluster1", 2, 3600), 0)
+        self.assertEqual(self.earliest_start("fakecluster1", 3, 3600), 1800)
+        self.assertEqual(self.earliest_start("fakecluster1", 4, 3600), 2700)
+        # fakecluster1-4 is not free long enough before 18000
+        self.assertEqual(self.earliest_start("fakecluster1", 4, 3600, [ (2700, 6300, 1) ]), 18000)
+        self.assertEqual(self.earliest_start("fakecluster1", 5, 3600), None)
+
+    def test_order(self):
+        # -w 3600 (default): fakecluster0 is late
+        self.assertEqual(self.policy(3600).order(self.clusters_sites),
+                         [ ("fakecluster1", "fakesite", False), ("fakecluster0", "fakesite", True) ])
+        # -w 20000: no cluster is late
+        self.assertEqual(self.policy(20000).order(self.clusters_sites),
+                         [ ("fakecluster1", "fakesite", False), ("fakecluster0", "fakesite", False) ])
+
+    def test_submitted(self):
+        # a job of the 4 hosts of fakecluster1 is predicted from 2700 to
+        # 6300: the next job of fakecluster1 starts after it
+        policy = self.policy(3600)
+        policy.submitted("fakecluster1", OarSubmission(resources = "{cluster='fakecluster1'}/nodes=4",
+                                                       walltime = 3600))
+        self.assertEqual(policy.predicted_start("fakecluster1", "fakesite") - self.date, 6300)
+        self.assertEqual(policy.order(self.clusters_sites),
+                         [ ("fakecluster1", "fakesite", True), ("fakecluster0", "fakesite", True) ])
+        # a new snapshot forgets the submitted jobs
+        self.clock.date += 300
+        policy.refresh(self.clusters_sites)
+        self.assertEqual(policy.predicted_start("fakecluster1", "fakesite"), self.clock.date)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""Checks of the recovery of g5k_cluster_engine from its jobs journal, on `fake_oar.fake_oar`.
+
+usage: python -m unittest test_recovery
+"""
+
+import unittest, tempfile, shutil, os
+from execo_g5k import OarSubmission
+from g5k_cluster_engine import g5k_cluster_engine, _JobJournal, _Worker, real_clock
+from fake_oar import fake_oar
+
+class recovery_engine(g5k_cluster_engine):
+
+    def __init__(self, oar):
+        super(recovery_engine, self).__init__()
+        self.oar = oar
+        self.failed = []
+
+    def worker(self, cluster, site, data, nodes, worker_index, oarsubmission, jobid):
+        if not nodes:
+            self.failed.append(worker_index)
+
+class test_recovery(unittest.TestCase):
+
+    def setUp(self):
+        self.result_dir = tempfile.mkdtemp(prefix = "test_recovery_")
+        self.journal_filename = os.path.join(self.result_dir, "jobs_journal")
+        self.oar = fake_oar(start_delay = 0)
+        self.oarsubmission = OarSubmission(resources = "{cluster='fakecluster'}/nodes=1")
+        ((self.jobid, _),) = self.oar.oarsub([ (self.oarsubmission, "fakesite") ])
+
+    def tearDown(self):
+        shutil.rmtree(self.result_dir)
+
+    def journal(self, states):
+        # journal of a previous run: one payload in the fake job, with
+        # the given successive states
+        journal = _JobJournal(self.journal_filename)
+        w = _Worker("fakecluster", "fakesite", real_clock())
+        w.add_payload(0, self.oarsubmission, "data")
+        w.jobid = self.jobid
+        for state in states:
+            if state == "deleted":
+                journal.record(state, w)
+            else:
+                journal.record(state, w, 0, self.oarsubmission, "data")
+        journal.close()
+
+    def unfinished_jobs(self):
+        journal = _JobJournal(self.journal_filename)
+        journal.close()
+        return journal.unfinished_jobs()
+
+    def recover(self):
+        engine = recovery_engine(self.oar)
+        engine.start([ "-c", self.result_dir, "-l", "WARNING", "-e" ])
+        return engine
+
+    def test_unfinished_jobs(self):
+        self.journal([ "submitted", "done" ])
+        jobs = self.unfinished_jobs()
+        self.assertEqual([ (job["jobid"], job["payloads"]) for job in jobs ], [ (self.jobid, []) ])
+        self.journal([ "deleted" ])
+        self.assertEqual(self.unfinished_jobs(), [])
+
+    def test_done_not_deleted(self):
+        # crash between the end of the last payload and the job deletion
+        self.journal([ "submitted", "done" ])
+        engine = self.recover()
+        self.assertTrue(self.oar._jobs[self.jobid]["deleted"])
+        self.assertEqual(engine.failed, [])
+        self.assertEqual(self.unfinished_jobs(), [])
+
+    def test_ended_job(self):
+        # the job of an unfinished payload ended during the restart
+        self.journal([ "submitted" ])
+        self.oar.oardel([ (self.jobid, "fakesite") ])
+        engine = self.recover()
+        self.assertEqual(engine.failed, [ 0 ])
+        self.assertEqual(self.unfinished_jobs(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,17 @@
 #!/usr/bin/env python
 
-import os, math, sys
+import os, math, sys, re, json, hashlib, multiprocessing
 
 from pprint import pformat
 from tempfile import mkstemp
 from execo import Process
 from execo import logger as ex_log
 from execo.log import style
-from execo_g5k import get_site_clusters, OarSubmission, oardel, get_cluster_site, \
-    oarsub, wait_oar_job_start, get_oar_job_nodes, get_host_attributes, get_oar_job_info, \
+from execo_g5k import get_site_clusters, OarSubmission, oardel, \
+    oarsub, wait_oar_job_start, get_oar_job_nodes, get_oar_job_info, \
     g5k_configuration
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'lib'))
+from g5k_api_cache import get_host_attributes, get_cluster_site
 from execo_engine import Engine, logger, ParamSweeper, sweep, slugify, igeom
 
 
@@ -17,6 +19,12 @@ from execo_engine import Engine, logger, ParamSweeper, sweep, slugify, igeom
 g5k_configuration['oar_job_key_file'] = '/home/jrichard/.oar_key'
 #ex_log.setLevel('DEBUG')
 
+# Successive halving: at each rung, the datasize is divided by
+# HALVING_SIZE_RATIO, and the fastest 1 / HALVING_ETA of the candidates
+# go to the next rung
+HALVING_ETA = 4
+HALVING_SIZE_RATIO = 4
+
 
 def expRange(start, end, base=2):
     """
@@ -29,49 +37,117 @@ def expRange(start, end, base=2):
 class l2c_fft(Engine):
     workingPath = '/home/jrichard/l2c-fft-new-distrib/bin'
     genLadScript = '/home/jrichard/l2c-fft-new-distrib/src/utils/gen-lad/genPencil.py'
+    ladCachePath = '/home/jrichard/l2c-fft-new-distrib/lad-cache'
+
+    def __init__(self):
+        super(l2c_fft, self).__init__()
+        self.options_parser.add_option("-p", dest="prefetch",
+                    help="number of jobs submitted in advance for the next (cluster, cores) groups",
+                    type=int,
+                    default=1)
+        self.options_parser.add_option("-s", dest="halving",
+                    help="maximum number of successive halving rungs at reduced datasize, pruning the " + \
+                    "slowest px / transposition of each (cluster, cores) before running the " + \
+                    "others at full datasize (0: no pruning)",
+                    type=int,
+                    default=0)
 
     def run(self):
         """
             Main engine method to perform the experiment
         """
         self.define_parameters()
-        
-        while len(self.sweeper.get_remaining()) > 0:
-            # Getting the next combination
-            comb = self.sweeper.get_next()
-            logger.info(style.host(slugify(comb)) + ' has been started')
-            self.get_nodes(comb)
-
-            # If the job is broken, the program is stopped
-            if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error': 
-                break
+        remaining = list(self.sweeper.get_remaining())
+        groups = {}
+        for comb in remaining:
+            groups.setdefault((comb['cluster'], comb['cores'], comb['datasize']), []).append(comb)
+        self.prepare_lads(remaining +
+                          [dict(comb, datasize=datasize)
+                           for combs in groups.values()
+                           for datasize in self.halving_datasizes(combs[0]['datasize'], combs)
+                           for comb in combs])
+        # jobs submitted for each (cluster, cores) group
+        self.jobs = {}
 
-            try:
-                self.workflow(comb)
+        try:
+            while len(self.sweeper.get_remaining()) > 0:
+                # Submit the jobs of the current group and of the next
+                # ones, so that they wait in the queue while the current
+                # group is running
+                groups = self.remaining_groups()
+                group = groups[0]
+                self.prefetch_jobs(groups[:1 + self.options.prefetch])
 
-                # Process all combinations that can use the same submission
-                while True:
-                    # Find the next combination combinations that can use the same submission
-                    subcomb = self.sweeper.get_next(lambda r: 
-                        filter(lambda x: x['cores'] == comb['cores']
-                                        and x['cluster'] == comb['cluster'], r))
+                # Getting the next combination
+                comb = self.sweeper.get_next(lambda r:
+                    filter(lambda x: (x['cluster'], x['cores']) == group, r))
+                logger.info(style.host(slugify(comb)) + ' has been started')
+                self.get_nodes(comb)
 
-                    if not subcomb: 
-                        logger.info('No more combination for cluster=%s and cores=%s',
-                            comb['cluster'], comb['cores'])
-                        break
-                    else:
-                        logger.info(style.host(slugify(subcomb)) + ' has been started')
+                # If the job is broken, the program is stopped
+                if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error': 
+                    self.sweeper.cancel(comb)
+                    break
 
-                        if get_oar_job_info(self.oar_job_id, self.frontend)['state'] != 'Error':
-                            self.workflow(subcomb)
-                        else:
+                try:
+                    if self.options.halving:
+                        self.successive_halving(comb)
+                        continue
+
+                    self.workflow(comb)
+
+                    # Process all combinations that can use the same submission
+                    while True:
+                        # Find the next combination combinations that can use the same submission
+                        subcomb = self.sweeper.get_next(lambda r: 
+                            filter(lambda x: x['cores'] == comb['cores']
+                                            and x['cluster'] == comb['cluster'], r))
+
+                        if not subcomb: 
+                            logger.info('No more combination for cluster=%s and cores=%s',
+                                comb['cluster'], comb['cores'])
                             break
-            
-            # Whatever happens (errors, end of loop), the job is deleted
-            finally:
-                logger.info('Deleting job...')
-                oardel([(self.oar_job_id, self.frontend)])
+                        else:
+                            logger.info(style.host(slugify(subcomb)) + ' has been started')
+
+                            if get_oar_job_info(self.oar_job_id, self.frontend)['state'] != 'Error':
+                                self.workflow(subcomb)
+                            else:
+                                self.sweeper.cancel(subcomb)
+                                break
+                
+                # Whatever happens (errors, end of loop), the job is deleted
+                finally:
+                    logger.info('Deleting job...')
+                    oardel([self.jobs.pop(group)])
+
+        # Whatever happens, the jobs submitted in advance are deleted
+        finally:
+            if self.jobs:
+                logger.info('Deleting %i jobs submitted in advance...', len(self.jobs))
+                oardel(list(self.jobs.values()))
+                self.jobs = {}
+
+    def remaining_groups(self):
+        """
+            Return the (cluster, cores) groups of the remaining
+            combinations, in the order they are processed
+        """
+        return sorted(set((comb['cluster'], comb['cores'])
+                          for comb in self.sweeper.get_remaining()))
+
+    def prefetch_jobs(self, groups):
+        """
+            Submit the jobs of the given groups not submitted yet, and
+            delete the jobs of the groups no longer planned
+        """
+        for group in list(self.jobs):
+            if group not in groups:
+                logger.info('Deleting job of cluster=%s and cores=%s', *group)
+                oardel([self.jobs.pop(group)])
+        for group in groups:
+            if group not in self.jobs:
+                self.jobs[group] = self.submit_job(*group)
 
     def workflow(self, comb):
         """
@@ -80,40 +156,7 @@ class l2c_fft(Engine):
         """
         comb_ok = False
         try:
-            # Generate configuration file needed by MPI processes
-            logger.info("Generating assembly file...")
-            py = comb['cores'] / comb['px']
-            prepare = Process('cd %s && python %s %d %d %d %d %d %s app.lad' % 
-                (self.workingPath, self.genLadScript, comb['datasize'], comb['datasize'], 
-                    comb['datasize'], comb['px'], py, comb['transposition']))
-            prepare.shell = True
-            prepare.run()
-
-            # Generate the MPI host file
-            mfile = self.generate_machine_file()
-
-            # Start L2C
-            lad = "./app.lad"
-            logger.info("Computing...")
-            res = Process("export OAR_JOB_KEY_FILE=~/.oar_key ; cd %s && l2c_loader -M,-machinefile,%s --mpi -c %d %s" % (self.workingPath, mfile, comb['cores'], lad))
-            res.shell = True
-            res.stdout_handlers.append(os.path.join(self.result_dir, slugify(comb) + '.out'))
-            res.stdout_handlers.append(sys.stdout)
-            res.stderr_handlers.append(os.path.join(self.result_dir, slugify(comb) + '.err'))
-            res.stderr_handlers.append(sys.stderr)
-            res.run()
-            if not res.ok:
-                logger.error('Bad L2C termination')
-                raise Exception('Bad L2C termination')
-            if len(res.stderr) > 0: # WARNING: when L2C cannot find the LAD file or something strange like this
-                logger.warning('Not empty error output')
-
-            # Clean configuration files
-            logger.info("Removing assembly files...")
-            res = Process('cd %s && rm -f app.lad*' % self.workingPath)
-            res.shell = True
-            res.run()
-                
+            self.compute(comb)
             comb_ok = True
         except Exception:
             pass
@@ -128,6 +171,167 @@ class l2c_fft(Engine):
             logger.info(style.step('%s Remaining'),
                         len(self.sweeper.get_remaining()))
 
+    def compute(self, comb):
+        """
+            Launch the application for a combination, and return
+            its average time (None if not found in its output)
+        """
+        # Configuration file needed by MPI processes, generated in
+        # advance by prepare_lads
+        lad = self.prepare_lads([comb])[0]
+
+        # Generate the MPI host file
+        mfile = self.generate_machine_file()
+
+        # Start L2C
+        logger.info("Computing...")
+        res = Process("export OAR_JOB_KEY_FILE=~/.oar_key ; cd %s && l2c_loader -M,-machinefile,%s --mpi -c %d %s" % (self.workingPath, mfile, comb['cores'], lad))
+        res.shell = True
+        res.stdout_handlers.append(os.path.join(self.result_dir, slugify(comb) + '.out'))
+        res.stdout_handlers.append(sys.stdout)
+        res.stderr_handlers.append(os.path.join(self.result_dir, slugify(comb) + '.err'))
+        res.stderr_handlers.append(sys.stderr)
+        res.run()
+        if not res.ok:
+            logger.error('Bad L2C termination')
+            raise Exception('Bad L2C termination')
+        if len(res.stderr) > 0: # WARNING: when L2C cannot find the LAD file or something strange like this
+            logger.warning('Not empty error output')
+        times = re.findall(r'Avg time: ([0-9]*(?:\.[0-9]*)?)', res.stdout)
+        if not times:
+            return None
+        return float(times[0])
+
+    def halving_datasizes(self, datasize, combs):
+        """
+            Return the reduced datasizes of the successive halving
+            rungs of combs, from the smallest one, without duplicates:
+            there may be fewer rungs than requested for small datasizes
+        """
+        # the datasize may not be smaller than the process grid
+        smallest = max([max(comb['px'], comb['cores'] / comb['px']) for comb in combs])
+        sizes = []
+        for level in range(self.options.halving, 0, -1):
+            size = max(smallest, datasize / HALVING_SIZE_RATIO ** level)
+            if size < datasize and size not in sizes:
+                sizes.append(size)
+        return sizes
+
+    def successive_halving(self, comb):
+        """
+            Run the combinations of the (cluster, cores) group of comb:
+            each rung runs the candidates at a reduced datasize, and
+            keeps the fastest ones, the others are skipped; the
+            remaining candidates are run at full datasize
+        """
+        combs = [comb]
+        while True:
+            subcomb = self.sweeper.get_next(lambda r: 
+                filter(lambda x: x['cores'] == comb['cores']
+                                and x['cluster'] == comb['cluster'], r))
+            if not subcomb:
+                break
+            combs.append(subcomb)
+        for datasize in sorted(set(c['datasize'] for c in combs)):
+            candidates = [c for c in combs if c['datasize'] == datasize]
+            for reduced in self.halving_datasizes(datasize, candidates):
+                if len(candidates) <= 1:
+                    break
+                times = []
+                for candidate in candidates:
+                    if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error':
+                        for c in combs:
+                            if c in candidates or c['datasize'] > datasize:
+                                self.sweeper.cancel(c)
+                        return
+                    logger.info(style.host(slugify(candidate)) + ' measured at datasize %d', reduced)
+                    try:
+                        t = self.compute(dict(candidate, datasize=reduced))
+                    except Exception:
+                        t = None
+                    times.append((t is None, t, candidate))
+                times.sort(key=lambda x: (x[0], x[1]))
+                n_kept = max(1, int(math.ceil(len(candidates) / float(HALVING_ETA))))
+                for rank, (failed, t, candidate) in enumerate(times[n_kept:]):
+                    if failed:
+                        reason = 'failed at datasize %d' % (reduced,)
+                    else:
+                        reason = '%.3fs at datasize %d, rank %d of %d (kept %d)' % (
+                            t, reduced, n_kept + rank + 1, len(times), n_kept)
+                    self.prune(candidate, reason)
+                candidates = [candidate for (failed, t, candidate) in times[:n_kept]]
+            for candidate in candidates:
+                if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error':
+                    self.sweeper.cancel(candidate)
+                else:
+                    self.workflow(candidate)
+
+    def prune(self, comb, reason):
+        """
+            Skip a combination, recording why in pruned.json
+        """
+        logger.info(style.host(slugify(comb)) + ' has been pruned: %s', reason)
+        self.sweeper.skip(comb)
+        path = os.path.join(self.result_dir, 'pruned.json')
+        pruned = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                pruned = json.load(f)
+        pruned[slugify(comb)] = reason
+        with open(path, 'w') as f:
+            json.dump(pruned, f, indent=1, sort_keys=True)
+
+    def lad_key(self, comb):
+        """
+            Return the key of the assembly file of a combination:
+            a hash of the generator script and of its parameters
+        """
+        key = hashlib.sha1()
+        if os.path.exists(self.genLadScript):
+            with open(self.genLadScript, 'rb') as f:
+                key.update(f.read())
+        key.update(('%d %d %d %s' % (comb['datasize'], comb['px'],
+                                     comb['cores'] / comb['px'], comb['transposition'])).encode())
+        return key.hexdigest()
+
+    def prepare_lads(self, combs):
+        """
+            Generate, in parallel, the assembly files of the given
+            combinations not in the cache yet, and return their paths
+
+            Each assembly file is generated in its own directory of
+            ladCachePath, named by its key, so that it is generated
+            once and that several combinations can use it at once.
+        """
+        paths = []
+        todo = {}
+        for comb in combs:
+            directory = os.path.join(self.ladCachePath, self.lad_key(comb))
+            paths.append(os.path.join(directory, 'app.lad'))
+            if not os.path.exists(directory):
+                todo[directory] = comb
+        if todo:
+            logger.info("Generating %i assembly files...", len(todo))
+        pending = sorted(todo.items())
+        running = []
+        while pending or running:
+            while pending and len(running) < multiprocessing.cpu_count():
+                directory, comb = pending.pop()
+                # generated in a temporary directory, renamed when complete
+                prepare = Process('rm -rf %s.tmp && mkdir -p %s.tmp && cd %s.tmp && python %s %d %d %d %d %d %s app.lad && mv %s.tmp %s' % 
+                    (directory, directory, directory, self.genLadScript,
+                     comb['datasize'], comb['datasize'], comb['datasize'],
+                     comb['px'], comb['cores'] / comb['px'], comb['transposition'],
+                     directory, directory))
+                prepare.shell = True
+                prepare.nolog_exit_code = True
+                running.append((prepare.start(), comb))
+            prepare, comb = running.pop(0)
+            prepare.wait()
+            if not prepare.ok:
+                logger.error('Unable to generate the assembly file of %s', slugify(comb))
+        return paths
+
     def define_parameters(self):
         """
             Define the parametters used by the L2C application
@@ -145,21 +349,37 @@ class l2c_fft(Engine):
         self.sweeper = ParamSweeper(os.path.join(self.result_dir, "sweeps"), sweeps)        
         logger.info('Number of parameters combinations %s', len(self.sweeper.get_remaining()))
 
-    def get_nodes(self, comb):
+    def submit_job(self, cluster, cores):
         """
-            Perform a submission for a given comb and 
-            retrieve the submission node list
+            Perform a submission for a (cluster, cores) group,
+            and return the (job id, frontend)
         """
-        logger.info('Performing submission')
-        n_core = get_host_attributes(comb['cluster'] + '-1')['architecture']['smt_size']
-        submission = OarSubmission(resources="nodes=%d" % (max(1, comb['cores']/n_core), ), 
-                   sql_properties="cluster='%s'"%comb['cluster'],
+        logger.info('Performing submission for cluster=%s and cores=%s', cluster, cores)
+        n_core = get_host_attributes(cluster + '-1')['architecture']['smt_size']
+        submission = OarSubmission(resources="nodes=%d" % (max(1, cores/n_core), ), 
+                   sql_properties="cluster='%s'"%cluster,
                    job_type="besteffort", 
                    name="l2c_fft_eval")
-        self.oar_job_id, self.frontend = oarsub([(submission, get_cluster_site(comb['cluster']))])[0]
+        return oarsub([(submission, get_cluster_site(cluster))])[0]
+
+    def get_nodes(self, comb):
+        """
+            Wait for the submission of a given comb and 
+            retrieve the submission node list
+        """
+        group = (comb['cluster'], comb['cores'])
+        if group not in self.jobs:
+            self.jobs[group] = self.submit_job(*group)
+        self.oar_job_id, self.frontend = self.jobs[group]
+        if get_oar_job_info(self.oar_job_id, self.frontend)['state'] in ['Error', 'Terminated']:
+            # besteffort job submitted in advance, and killed meanwhile
+            logger.info('Job %s ended before use, submitting again', self.oar_job_id)
+            self.jobs[group] = self.submit_job(*group)
+            self.oar_job_id, self.frontend = self.jobs[group]
         logger.info("Waiting for job start")
         wait_oar_job_start(self.oar_job_id, self.frontend)
         logger.info("Retrieving hosts list")
+        n_core = get_host_attributes(comb['cluster'] + '-1')['architecture']['smt_size']
         nodes = get_oar_job_nodes(self.oar_job_id, self.frontend)
         self.hosts = [host for host in nodes for i in range(n_core)]
 
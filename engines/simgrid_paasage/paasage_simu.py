@@ -1,18 +1,19 @@
 #!/usr/bin/env python
 # encoding=utf8
 
-import os, time, datetime
+import os, sys, time
 import xml.etree.ElementTree as ET
 
 from threading import Thread
 from execo import Put, Remote, Get, sleep, default_connection_params, Host
 from execo.log import style
 from execo import logger as ex_log
-from execo.time_utils import timedelta_to_seconds
-from execo_g5k import get_host_attributes, get_planning, compute_slots, \
-    find_first_slot, distribute_hosts, get_jobs_specs, \
+from execo_g5k import find_first_slot, distribute_hosts, get_jobs_specs, \
     wait_oargrid_job_start, oargridsub, oargriddel, get_oargrid_job_nodes, \
-    Deployment, deploy, get_oargrid_job_info, get_host_cluster, get_cluster_site, get_host_site, get_g5k_sites
+    Deployment, deploy, get_oargrid_job_info, get_host_cluster, get_host_site, get_g5k_sites
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'lib'))
+from g5k_api_cache import get_host_attributes, get_cluster_site
+from g5k_planning_cache import planning_cache
 
 from execo_engine import Engine, logger, ParamSweeper, sweep, slugify
 
@@ -51,6 +52,8 @@ class paasage_simu(Engine):
             self.oargrid_job_id = self.options.oargrid_job_id
         else:
             self.oargrid_job_id = None
+        # a single planning cache, for all the reservations of the run
+        self.planning = planning_cache(elements=['grid5000'])
 
         try:
             # Creation of the main iterator which is used for the first control loop.
@@ -167,10 +170,7 @@ class paasage_simu(Engine):
     def make_reservation(self):
         """ """
         logger.info('Performing reservation')
-        starttime = int(time.time() + timedelta_to_seconds(datetime.timedelta(minutes=1)))
-        planning = get_planning(elements=['grid5000'],
-                            starttime=starttime)
-        slots = compute_slots(planning, self.options.walltime)
+        slots = self.planning.compute_slots(self.options.walltime)
         wanted = {"grid5000": 0}
         start_date, end_date, resources = find_first_slot(slots, wanted)
         wanted['grid5000'] = min(resources['grid5000'], self.options.n_nodes)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""Compare cold and warm slot searches with `g5k_planning_cache.planning_cache`.
+
+Replays the slot search of fp_hadoop.make_reservation (a 3 days window,
+widened 3 days at a time until enough nodes are found) on a recorded
+planning dump (as written by ``g5k_planning_cache.py file elements``,
+or fake_oar's planning fixture), whose clusters are replicated to get
+a realistic number of hosts. The planning retrieval is simulated with
+a fixed latency.
+
+- cold: each search starts from an empty cache, as when calling
+  get_planning and compute_slots at each step.
+
+- warm: all searches share the same cache.
+
+Then compares, on the warm cache and a window of several months,
+first slot searches (for one cluster, and for several clusters at
+once) by scanning the slots, and with `planning_cache.find_first_slot`.
+
+usage: bench_planning_cache.py [dump] [replicas] [latency] [num_searches]
+"""
+
+import sys, os, time, json
+import g5k_planning_cache
+from g5k_planning_cache import planning_cache, _replace_window
+
+def load_dump(filename, replicas):
+    # loads a planning dump, shifted to now, with each cluster
+    # replicated, with shifted intervals
+    with open(filename) as f:
+        recorded = json.load(f)
+    shift = time.time() - recorded["date"]
+    planning = {}
+    for (site, site_planning) in recorded["planning"].items():
+        for (cluster, cluster_planning) in site_planning.items():
+            for replica in range(0, replicas):
+                offset = shift + (replica % 24) * 3600
+                for (host, host_planning) in cluster_planning.items():
+                    name = host.replace(cluster, "%s%i" % (cluster, replica), 1)
+                    planning.setdefault(site, {}).setdefault("%s%i" % (cluster, replica), {})[name] = dict(
+                        [ (kind, [ (s + offset, e + offset) for (s, e) in intervals ])
+                          for (kind, intervals) in host_planning.items() ])
+    return planning
+
+class recorded_fetch(object):
+
+    """get_planning replacement, answering from a recorded planning, with a fixed latency."""
+
+    def __init__(self, planning, latency):
+        self.planning = planning
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, elements, starttime, endtime, out_of_chart = False, queues = 'default'):
+        self.calls += 1
+        time.sleep(self.latency)
+        planning = {}
+        for (site, site_planning) in self.planning.items():
+            for (cluster, cluster_planning) in site_planning.items():
+                for (host, host_planning) in cluster_planning.items():
+                    truncated = _replace_window({}, host_planning, starttime, endtime)
+                    # as get_planning: free outside of the known busy intervals
+                    truncated["free"] = []
+                    date = starttime
+                    for (s, e) in truncated["busy"]:
+                        if s > date:
+                            truncated["free"].append((date, s))
+                        date = max(date, e)
+                    if date < endtime:
+                        truncated["free"].append((date, endtime))
+                    planning.setdefault(site, {}).setdefault(cluster, {})[host] = truncated
+        return planning
+
+def scan(slots, resources):
+    # first slot search by scanning the slots
+    for slot in slots:
+        if all([ slot[2].get(element, 0) >= n for (element, n) in resources.items() ]):
+            return slot
+    return None
+
+def search(cache, cluster, n_nodes, walltime):
+    # fp_hadoop.make_reservation slot search
+    window = 3 * 24 * 3600
+    starttime = int(time.time() + 60)
+    endtime = starttime + window
+    while True:
+        slot = cache.find_first_slot(walltime, { cluster: n_nodes }, starttime = starttime, endtime = endtime)
+        if slot:
+            return slot[0]
+        if endtime - starttime > 6 * 7 * 24 * 3600:
+            return None
+        endtime += window
+
+if __name__ == "__main__":
+    dump = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "engines", "g5k_cluster_engine", "planning_fixture.json")
+    replicas = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    num_searches = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+    g5k_planning_cache.cache_dir = None
+    fetch = recorded_fetch(load_dump(dump, replicas), latency)
+    clusters = sorted([ cluster for site_planning in fetch.planning.values() for cluster in site_planning ])
+    num_hosts = sum([ len(cluster_planning) for site_planning in fetch.planning.values()
+                      for cluster_planning in site_planning.values() ])
+    print("%i clusters, %i hosts, planning retrieval latency %.2fs" % (len(clusters), num_hosts, latency))
+    warm_cache = planning_cache(clusters, fetch = fetch)
+    for (name, get_cache) in [ ("cold", lambda: planning_cache(clusters, fetch = fetch)),
+                               ("warm", lambda: warm_cache) ]:
+        fetch.calls = 0
+        start = time.time()
+        for i in range(0, num_searches):
+            search(get_cache(), clusters[i % len(clusters)], 4, 2 * 3600)
+        duration = time.time() - start
+        print("%s: %7.3fs per search, %5.1f planning retrievals per search" % (
+                name, duration / num_searches, float(fetch.calls) / num_searches))
+    starttime = int(time.time() + 60)
+    endtime = starttime + 12 * 7 * 24 * 3600
+    slots = warm_cache.compute_slots(2 * 3600, starttime = starttime, endtime = endtime)
+    queries = [ dict([ (clusters[(i + j) % len(clusters)], 1 + (i % 8)) for j in range(0, 1 + i % 3) ])
+                for i in range(0, 100) ]
+    print("%i slots over 12 weeks, %i first slot searches" % (len(slots), len(queries)))
+    for (name, find) in [ ("scan", lambda resources: scan(slots, resources)),
+                          ("indexed", lambda resources: warm_cache.find_first_slot(
+                    2 * 3600, resources, starttime = starttime, endtime = endtime)) ]:
+        start = time.time()
+        found = [ find(resources) for resources in queries ]
+        duration = time.time() - start
+        print("%s: %9.6fs per search" % (name, duration / len(queries)))
+    assert found == [ scan(slots, resources) for resources in queries ]
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""Persistent cache of the Grid5000 Reference API, shared by the engines.
+
+The execo_g5k api functions used by the engines
+(``get_host_attributes``, ``get_cluster_site``, ...) may query the
+Reference API each time they are called. This module provides drop-in
+replacements, whose API resources are cached:
+
+- in memory, in a LRU of the last `max_memory_entries` resources.
+
+- on disk, in `cache_dir` (``$G5K_API_CACHE_DIR``, by default
+  ``~/.execo/g5k_api_cache_lru``), one json file per resource, with
+  its ETag and retrieval date.
+
+A resource cached for less than `ttl` seconds (``$G5K_API_CACHE_TTL``,
+by default one day) is used as is. An older one is revalidated with
+its ETag: if it has not changed, the API answers without content.
+If the API is unreachable, or in offline mode (``$G5K_API_CACHE_OFFLINE``
+set, or `offline` set to True), cached resources are used whatever
+their age, so that the engines can run from a pre-seeded cache (see
+`seed`).
+
+Engines import `g5k_api_cache` from the ``lib``
+directory of this repository::
+
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lib"))
+  from g5k_api_cache import get_host_attributes, get_cluster_site
+
+usage, to seed the cache with the resources of some clusters:
+g5k_api_cache.py cluster [cluster ...]
+"""
+
+from execo_g5k.api_utils import APIConnection, get_host_cluster, get_host_shortname
+from execo_engine import logger
+from collections import OrderedDict
+from threading import Lock
+import os, sys, time, json, re
+
+cache_dir = os.environ.get("G5K_API_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".execo", "g5k_api_cache_lru"))
+"""Directory of the on-disk cache."""
+
+ttl = int(os.environ.get("G5K_API_CACHE_TTL", 24 * 3600))
+"""Time in seconds during which a cached resource is used without revalidation."""
+
+offline = "G5K_API_CACHE_OFFLINE" in os.environ
+"""If True, never query the API, only use the cache."""
+
+max_memory_entries = 1024
+"""Maximum number of resources kept in memory."""
+
+_memory = OrderedDict() # dict: keys = paths, values = cache entries
+_lock = Lock()
+_fetch_lock = Lock()
+
+def _path_filename(path):
+    return os.path.join(cache_dir, re.sub("[^\\w.-]", "_", path) + ".json")
+
+def _read_entry(path):
+    with _lock:
+        if path in _memory:
+            entry = _memory.pop(path)
+            _memory[path] = entry
+            return entry
+    try:
+        with open(_path_filename(path)) as f:
+            entry = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    _remember(path, entry)
+    return entry
+
+def _remember(path, entry):
+    with _lock:
+        _memory.pop(path, None)
+        _memory[path] = entry
+        while len(_memory) > max_memory_entries:
+            _memory.popitem(last = False)
+
+def _write_entry(path, entry):
+    _remember(path, entry)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    filename = _path_filename(path)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(entry, f)
+    os.rename(filename + ".tmp", filename)
+
+def get_resource_attributes(path):
+    """Get generic resource (path on g5k api) attributes as a dict, through the cache."""
+    path = path.strip("/")
+    entry = _read_entry(path)
+    if entry and (offline or time.time() - entry["date"] < ttl):
+        return entry["data"]
+    if offline:
+        raise KeyError("g5k api resource %s not in cache %s (offline)" % (path, cache_dir))
+    with _fetch_lock:
+        # another thread may have fetched it meanwhile
+        entry = _read_entry(path)
+        if entry and time.time() - entry["date"] < ttl:
+            return entry["data"]
+        headers = { "ACCEPT": "application/json" }
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        try:
+            response = APIConnection(headers = headers).get(path)
+        except Exception as e:
+            if not entry:
+                raise
+            logger.warning("unable to revalidate g5k api resource %s, using cache: %s" % (path, e))
+            return entry["data"]
+        if response.status_code == 304:
+            logger.debug("g5k api resource %s not modified" % (path,))
+            entry["date"] = time.time()
+        else:
+            logger.debug("g5k api resource %s retrieved" % (path,))
+            entry = { "etag": response.headers.get("ETag"),
+                      "date": time.time(),
+                      "data": response.json() }
+        _write_entry(path, entry)
+        return entry["data"]
+
+def get_g5k_sites():
+    """Get the list of all sites."""
+    return [ site["uid"] for site in get_resource_attributes("sites")["items"] ]
+
+def get_site_clusters(site):
+    """Get the list of clusters of a site (whatever their queues)."""
+    return [ cluster["uid"] for cluster in get_resource_attributes("sites/%s/clusters" % (site,))["items"] ]
+
+def get_cluster_site(cluster):
+    """Get the site of a cluster."""
+    for site in get_g5k_sites():
+        if cluster in get_site_clusters(site):
+            return site
+    raise ValueError("unknown g5k cluster %s" % (cluster,))
+
+def get_cluster_attributes(cluster):
+    """Get the attributes of a cluster (as known to the g5k api) as a dict."""
+    return get_resource_attributes("sites/%s/clusters/%s" % (get_cluster_site(cluster), cluster))
+
+def get_cluster_hosts_attributes(cluster):
+    """Get the attributes of all hosts of a cluster, as a dict: keys = host short names."""
+    return dict([ (host["uid"], host) for host in get_resource_attributes(
+                "sites/%s/clusters/%s/nodes" % (get_cluster_site(cluster), cluster))["items"] ])
+
+def get_host_attributes(host):
+    """Get the attributes of a host (as known to the g5k api) as a dict.
+
+    All the hosts of a cluster are retrieved at once, so that getting
+    the attributes of every host of a cluster costs a single resource.
+    """
+    return get_cluster_hosts_attributes(get_host_cluster(host))[get_host_shortname(host)]
+
+def seed(clusters):
+    """Retrieve, and cache, the api resources of clusters, to use them offline."""
+    for cluster in clusters:
+        get_host_attributes(cluster + "-1")
+        get_cluster_attributes(cluster)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    seed(sys.argv[1:])
+    print("cached in %s" % (cache_dir,))
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+"""Cache of the Grid5000 planning, refreshed incrementally, shared by the engines.
+
+``execo_g5k.planning.get_planning`` retrieves the whole Gantt of the
+requested elements at each call, and ``compute_slots`` rescans it for
+each slot limit. `planning_cache` retrieves the Gantt once, and then:
+
+- only retrieves the time windows not retrieved yet, when a query
+  extends beyond them (for example when widening a search window).
+
+- every refresh_delay seconds, only re-retrieves the near future
+  (refresh_window seconds from now), where the planning changes.
+
+- every max_age seconds, re-retrieves the whole planning, so that no
+  part of it is older than max_age.
+
+- keeps the planning on disk (in ``$G5K_PLANNING_CACHE_DIR``, by
+  default ``~/.execo/g5k_planning_cache``), so that successive runs of
+  the engines share it, as long as it is not older than max_age.
+
+- answers `planning_cache.compute_slots` queries from memory, with a
+  single sweep over the hosts' free intervals. Slots computed from
+  now (no starttime given) are reused, until the planning changes, by
+  the next queries from now.
+
+- answers `planning_cache.find_first_slot` queries with `slot_arrays`,
+  numpy arrays of the slots, searched without python loops (if numpy
+  is not available, the slots are scanned).
+
+Engines import it from the ``lib`` directory of this repository, and
+keep a single instance for their whole run::
+
+  sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lib"))
+  from g5k_planning_cache import planning_cache
+
+usage, to dump the planning of some elements to a json file:
+g5k_planning_cache.py file element [element ...]
+"""
+
+from execo.time_utils import get_seconds
+from execo_engine import logger
+from threading import Lock
+import os, sys, time, json, re, bisect
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+cache_dir = os.environ.get("G5K_PLANNING_CACHE_DIR",
+                           os.path.join(os.path.expanduser("~"), ".execo", "g5k_planning_cache"))
+"""Directory of the on-disk cache. If None, the planning is only kept in memory."""
+
+_NON_HOSTS_RESOURCES = [ "vlans", "subnets", "storage" ]
+
+def _get_planning(elements, starttime, endtime, out_of_chart, queues):
+    from execo_g5k.planning import get_planning
+    return get_planning(elements = elements, starttime = starttime, endtime = endtime,
+                        out_of_chart = out_of_chart, queues = queues)
+
+def _el_plannings(planning):
+    # iterates over the (site, resource, element, element planning) of a planning
+    for (site, site_planning) in planning.items():
+        for (resource, resource_planning) in site_planning.items():
+            for (element, el_planning) in resource_planning.items():
+                yield (site, resource, element, el_planning)
+
+def _from_date(slots, date):
+    # the slots from date: the slot in progress at date is moved to
+    # start at date
+    i = max(bisect.bisect_right([ slot[0] for slot in slots ], date) - 1, 0)
+    if i < len(slots) and slots[i][0] < date:
+        return [ [ date, date + slots[i][1] - slots[i][0], slots[i][2] ] ] + slots[i + 1:]
+    return slots[i:]
+
+def _replace_window(el_planning, new_el_planning, start, end):
+    # replaces the intervals of el_planning in [start, end] by those
+    # of new_el_planning, and merges contiguous intervals
+    intervals = []
+    for kind in [ "busy", "free" ]:
+        for (s, e) in el_planning.get(kind, []):
+            if s < start:
+                intervals.append((s, min(e, start), kind))
+            if e > end:
+                intervals.append((max(s, end), e, kind))
+        for (s, e) in new_el_planning.get(kind, []):
+            if e > start and s < end:
+                intervals.append((max(s, start), min(e, end), kind))
+    merged = { "busy": [], "free": [] }
+    for (s, e, kind) in sorted(intervals):
+        if s >= e:
+            continue
+        if len(merged[kind]) > 0 and merged[kind][-1][1] >= s:
+            merged[kind][-1] = (merged[kind][-1][0], max(merged[kind][-1][1], e))
+        else:
+            merged[kind].append((s, e))
+    return merged
+
+class slot_arrays(object):
+
+    """Slots, as returned by `planning_cache.compute_slots`, in numpy arrays.
+
+    - starts, stops: sorted arrays of the slots start and stop dates.
+
+    - free: array of the number of free hosts of each element (column
+      `slot_arrays.column` of an element) for each slot.
+    """
+
+    def __init__(self, slots):
+        self.starts = np.array([ slot[0] for slot in slots ], dtype = np.int64)
+        self.stops = np.array([ slot[1] for slot in slots ], dtype = np.int64)
+        elements = sorted(set([ element for slot in slots for element in slot[2] ]))
+        self.column = dict([ (element, i) for (i, element) in enumerate(elements) ])
+        self.free = np.zeros((len(slots), len(elements)), dtype = np.int32)
+        for (i, slot) in enumerate(slots):
+            for (element, n) in slot[2].items():
+                self.free[i, self.column[element]] = n
+
+    def first_slot(self, resources, not_before = None):
+        """Returns the index of the first slot with enough free hosts, or None.
+
+        :param resources: dict: keys = Grid5000 elements (grid5000,
+          sites, clusters), values = number of hosts needed on each.
+
+        :param not_before: if given, only the slots starting at this
+          date or after are considered (found by binary search).
+        """
+        first = 0
+        if not_before != None:
+            first = int(np.searchsorted(self.starts, not_before))
+        feasible = np.ones(len(self.starts) - first, dtype = bool)
+        for (element, n) in resources.items():
+            if n <= 0:
+                continue
+            if element not in self.column:
+                return None
+            feasible &= self.free[first:, self.column[element]] >= n
+        i = int(np.argmax(feasible)) if len(feasible) > 0 else 0
+        if i >= len(feasible) or not feasible[i]:
+            return None
+        return first + i
+
+class planning_cache(object):
+
+    """Planning of Grid5000 elements, retrieved once, and refreshed incrementally.
+
+    Usage::
+
+      cache = planning_cache(['graphene', 'griffon'])
+      slots = cache.compute_slots('2:00:00')
+      start_date, end_date, resources = find_first_slot(slots, {'graphene': 4})
+    """
+
+    def __init__(self, elements = ['grid5000'], out_of_chart = False, queues = 'default',
+                 refresh_delay = 300, refresh_window = 3 * 24 * 3600, max_age = 3600,
+                 fetch = None):
+        """
+        :param elements: the Grid5000 elements, as for
+          ``execo_g5k.planning.get_planning``.
+
+        :param refresh_delay: delay in seconds after which the near
+          future of the planning is refreshed.
+
+        :param refresh_window: duration in seconds of the near future
+          which is refreshed.
+
+        :param max_age: delay in seconds after which the whole
+          planning, in memory or on disk, is expired and retrieved
+          again.
+
+        :param fetch: function with the same signature as
+          ``execo_g5k.planning.get_planning``, to retrieve the
+          planning. Default: ``execo_g5k.planning.get_planning``.
+        """
+        self.elements = sorted(elements)
+        self.out_of_chart = out_of_chart
+        self.queues = queues
+        self.refresh_delay = refresh_delay
+        self.refresh_window = refresh_window
+        self.max_age = max_age
+        self._fetch = fetch
+        self._planning = {}
+        self._start = None
+        self._end = None
+        self._refresh_date = None
+        self._retrieval_date = None
+        self._version = 0
+        self._slots = {}
+        self._slot_arrays = {}
+        self._lock = Lock()
+        self._load()
+
+    def _filename(self):
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, re.sub("[^\\w.-]", "_", "%s-%s-%s" % (
+                    "_".join(self.elements), self.out_of_chart, self.queues)) + ".json")
+
+    def _load(self):
+        filename = self._filename()
+        if not filename or not os.path.exists(filename):
+            return
+        try:
+            with open(filename) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if time.time() - cached.get("retrieval_date", 0) > self.max_age:
+            logger.detail("planning of %s in %s expired" % (", ".join(self.elements), filename))
+            return
+        self._planning = cached["planning"]
+        self._start = cached["start"]
+        self._end = cached["end"]
+        self._refresh_date = cached["refresh_date"]
+        self._retrieval_date = cached["retrieval_date"]
+        logger.detail("planning of %s loaded from %s" % (", ".join(self.elements), filename))
+
+    def _save(self):
+        filename = self._filename()
+        if not filename:
+            return
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(filename + ".tmp", "w") as f:
+            json.dump({ "planning": self._planning, "start": self._start, "end": self._end,
+                        "refresh_date": self._refresh_date, "retrieval_date": self._retrieval_date }, f)
+        os.rename(filename + ".tmp", filename)
+
+    def _retrieve(self, start, end):
+        # retrieves the planning of the window [start, end] and merges it
+        logger.detail("retrieve planning of %s from %s to %s" % (
+                ", ".join(self.elements), start, end))
+        fetch = self._fetch or _get_planning
+        new_planning = fetch(self.elements, starttime = int(start), endtime = int(end),
+                             out_of_chart = self.out_of_chart, queues = self.queues)
+        elements = set()
+        for (site, resource, element, new_el_planning) in _el_plannings(new_planning):
+            elements.add((site, resource, element))
+            el_planning = self._planning.setdefault(site, {}).setdefault(resource, {}).get(element, {})
+            self._planning[site][resource][element] = _replace_window(el_planning, new_el_planning, start, end)
+        for (site, resource, element, el_planning) in list(_el_plannings(self._planning)):
+            if (site, resource, element) not in elements:
+                self._planning[site][resource][element] = _replace_window(el_planning, {}, start, end)
+        self._version += 1
+        self._slots = {}
+        self._slot_arrays = {}
+
+    def update(self, starttime = None, endtime = None):
+        """Makes sure the cached planning covers [starttime, endtime], and is fresh.
+
+        :param starttime: default: now + one minute.
+
+        :param endtime: default: starttime + four weeks.
+        """
+        now = time.time()
+        if starttime == None:
+            starttime = int(now + 60)
+        if endtime == None:
+            endtime = int(starttime + 4 * 7 * 24 * 3600)
+        with self._lock:
+            modified = False
+            if self._start == None or self._end <= now or now - self._retrieval_date > self.max_age:
+                # nothing usable, or too old: the whole window is
+                # retrieved again
+                if self._start != None and self._end > now:
+                    (starttime, endtime) = (min(starttime, max(self._start, int(now + 60))),
+                                            max(endtime, self._end))
+                self._planning = {}
+                self._retrieve(starttime, endtime)
+                (self._start, self._end) = (starttime, endtime)
+                self._refresh_date = self._retrieval_date = now
+                modified = True
+            if starttime < self._start:
+                self._retrieve(starttime, self._start)
+                self._start = starttime
+                modified = True
+            if endtime > self._end:
+                self._retrieve(self._end, endtime)
+                self._end = endtime
+                modified = True
+            if now - self._refresh_date > self.refresh_delay:
+                start = max(self._start, int(now + 60))
+                self._retrieve(start, min(self._end, start + self.refresh_window))
+                self._refresh_date = now
+                modified = True
+            if modified:
+                self._save()
+
+    def get_planning(self, starttime = None, endtime = None):
+        """Returns the planning, in the same format as ``execo_g5k.planning.get_planning``.
+
+        It is truncated to [starttime, endtime] (same defaults as
+        `planning_cache.update`).
+        """
+        if starttime == None:
+            starttime = int(time.time() + 60)
+        if endtime == None:
+            endtime = int(starttime + 4 * 7 * 24 * 3600)
+        self.update(starttime, endtime)
+        planning = {}
+        with self._lock:
+            for (site, resource, element, el_planning) in _el_plannings(self._planning):
+                planning.setdefault(site, {}).setdefault(resource, {})[element] = _replace_window(
+                    {}, el_planning, starttime, endtime)
+        return planning
+
+    def compute_slots(self, walltime, excluded_elements = None, starttime = None, endtime = None):
+        """Returns the slots of the planning, as ``execo_g5k.planning.compute_slots``.
+
+        A slot is ``[ start, stop, freehosts ]``, where freehosts is a
+        dict of Grid5000 elements (grid5000, sites, clusters) with the
+        number of hosts free from start for walltime. Contrary to
+        ``execo_g5k.planning.compute_slots``, only hosts are counted
+        (no kavlan), and results are cached until the planning
+        changes. Without starttime, the slots computed from now are
+        reused by the next queries without starttime (and with the
+        same walltime, excluded_elements, endtime), from which the
+        past slots are removed.
+        """
+        if starttime == None:
+            now = int(time.time() + 60)
+            return _from_date(self._compute_slots(walltime, excluded_elements, now, endtime, True), now)
+        return self._compute_slots(walltime, excluded_elements, starttime, endtime, False)
+
+    def _compute_slots(self, walltime, excluded_elements, starttime, endtime, from_now):
+        # with from_now, starttime is the current date, which is not
+        # part of the cache key
+        walltime = get_seconds(walltime)
+        key = (walltime, tuple(sorted(excluded_elements or [])), None if from_now else starttime, endtime)
+        if endtime == None:
+            endtime = int(starttime + 4 * 7 * 24 * 3600)
+            with self._lock:
+                if self._end != None and endtime - self.refresh_delay <= self._end < endtime:
+                    # the default end drifts with now: not worth a
+                    # retrieval and a recomputation of the slots
+                    endtime = self._end
+        self.update(starttime, endtime)
+        excluded = key[1]
+        with self._lock:
+            version = self._version
+            if key in self._slots:
+                return self._slots[key]
+            planning = self._planning
+            events = []
+            limits = set()
+            elements = set([ "grid5000" ])
+            for (site, resource, element, el_planning) in _el_plannings(planning):
+                if resource in _NON_HOSTS_RESOURCES or site in excluded or resource in excluded or element in excluded:
+                    continue
+                elements.update([ site, resource ])
+                for (kind, intervals) in el_planning.items():
+                    for (s, e) in intervals:
+                        s = max(s, starttime)
+                        e = min(e, endtime)
+                        if s < e:
+                            limits.update([ s, e ])
+                            if kind == "free" and e - s >= walltime:
+                                # host free for walltime from any date in [s, e - walltime]
+                                events.append((s, 0, site, resource))
+                                events.append((e - walltime, 1, site, resource))
+        limits = sorted(limits)[:-1]
+        events.sort()
+        free = {}
+        slots = []
+        i = 0
+        for limit in limits:
+            while i < len(events) and (events[i][0] < limit or events[i][0] == limit and events[i][1] == 0):
+                (_, end, site, cluster) = events[i]
+                for element in [ "grid5000", site, cluster ]:
+                    free[element] = free.get(element, 0) + (-1 if end else 1)
+                i += 1
+            slots.append([ limit, limit + walltime, dict([ (element, free.get(element, 0)) for element in elements ]) ])
+        with self._lock:
+            if self._version == version:
+                self._slots[key] = slots
+        return slots
+
+    def find_first_slot(self, walltime, resources, excluded_elements = None, starttime = None, endtime = None):
+        """Returns the first slot of `planning_cache.compute_slots` with enough free hosts, or None.
+
+        :param resources: dict: keys = Grid5000 elements (grid5000,
+          sites, clusters), values = number of hosts needed on each.
+          Several elements may be given, for example several
+          clusters, in which case a slot is returned only if all of
+          them have enough free hosts.
+        """
+        from_now = starttime == None
+        if from_now:
+            starttime = int(time.time() + 60)
+        slots = self._compute_slots(walltime, excluded_elements, starttime, endtime, from_now)
+        if np == None:
+            for slot in _from_date(slots, starttime) if from_now else slots:
+                if all([ slot[2].get(element, 0) >= n for (element, n) in resources.items() if n > 0 ]):
+                    return slot
+            return None
+        key = (get_seconds(walltime), tuple(sorted(excluded_elements or [])),
+               None if from_now else starttime, endtime)
+        with self._lock:
+            arrays = self._slot_arrays.get(key)
+            if arrays == None or arrays[0] is not slots:
+                arrays = (slots, slot_arrays(slots))
+                if self._slots.get(key) is slots:
+                    self._slot_arrays[key] = arrays
+        not_before = None
+        if from_now and len(slots) > 0:
+            # search from the slot in progress now
+            not_before = slots[max(int(np.searchsorted(arrays[1].starts, starttime, side = "right")) - 1, 0)][0]
+        i = arrays[1].first_slot(resources, not_before)
+        if i == None:
+            return None
+        if slots[i][0] < starttime:
+            return _from_date(slots[i:i + 1], starttime)[0]
+        return slots[i]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+    cache_dir = None
+    cache = planning_cache(sys.argv[2:])
+    planning = cache.get_planning()
+    with open(sys.argv[1], "w") as f:
+        json.dump({ "date": int(time.time()), "planning": planning }, f)
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
+import os, sys
 from socket import getfqdn
-from execo_g5k.planning import get_planning, compute_slots, find_first_slot,\
-    get_jobs_specs, get_job_by_name
+from execo_g5k.planning import find_first_slot, get_jobs_specs, get_job_by_name
 from execo_g5k.api_utils import get_g5k_clusters
 from execo_g5k.oar import oarsub, get_oar_job_nodes
 from execo_g5k.kadeploy import Deployment, deploy
@@ -9,6 +9,8 @@ from execo.log import logger, style
 from execo.process import SshProcess
 from execo.config import default_connection_params
 from execo.action import Put
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'lib'))
+from g5k_planning_cache import planning_cache
 
 if "lyon" not in getfqdn():
     logger.error('Must be executed from Lyon')
@@ -25,9 +27,8 @@ default_connection_params['user'] = 'root'
 logger.info("Looking for a running job")
 job = get_job_by_name(job_name, sites)
 if not job[0]:
-    planning = get_planning(sites)
     blacklisted = ['talc', 'mbi']
-    slots = compute_slots(planning, walltime, excluded_elements=blacklisted)
+    slots = planning_cache(sites).compute_slots(walltime, excluded_elements=blacklisted)
     wanted = {'grid5000': 1}
     start_date, end_date, resources = find_first_slot(slots, wanted)
 
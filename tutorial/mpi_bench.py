@@ -1,10 +1,11 @@
 #!/usr/bin/env python
-import os
+import os, sys
 from itertools import takewhile, count
 from execo import SshProcess, Remote, Put, format_date
 from execo_g5k import oarsub, oardel, OarSubmission, \
-    get_oar_job_nodes, wait_oar_job_start, \
-    get_host_attributes, get_cluster_site, get_host_site
+    get_oar_job_nodes, wait_oar_job_start, get_host_site
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lib'))
+from g5k_api_cache import get_host_attributes, get_cluster_site
 from execo_engine import Engine, ParamSweeper, sweep, \
     slugify, logger
 